@@ -0,0 +1,921 @@
+# Micro-benchmarks for the spellbook client
+# Run with: python benchmark.py [benchmark name ...]  (runs every benchmark when none are named)
+import os
+import sys
+import threading
+import time
+import json
+import io
+import tempfile
+import random
+import contextlib
+import resource
+import tracemalloc
+import subprocess
+import statistics
+import hashlib
+import zmq
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import main
+
+MAIN_DIRECTORY = os.path.dirname(os.path.abspath(main.__file__))
+
+BENCH_PORT = 5599
+SOCKET_CALLS = 5000
+CODEC_LIST_SIZES = [10, 1000, 50000]
+CODEC_REPEATS = 5
+DICE_EXPRESSIONS = ["1d20", "8d6+3", "2d20kh1", "4d6dl1", "10d10+5d4-2"]
+DICE_BATCH = 100000
+API_PORT = 5598
+API_LATENCY = 0.02 # seconds the stand-in API waits before answering, like a real network round trip
+BATCH_COMMANDS = 200
+API_SPELLS = 320 # spells the stand-in API knows, about as many as the real one
+FAKE_SERVICE_PORTS = {'dice': 5600, 'bookmarks': 5601, 'spells': 5602, 'sort': 5603}
+WORKLOAD_CALLS = 200
+SPELLBOOK_SIZES = [1000, 10000, 100000]
+CHURN_OPERATIONS = 300
+MODEL_SPELLS = 10000
+SUGGEST_QUERIES = ["spel 12", "Spell 3O", "spll 250", "sepll 7", "xyzzy"]
+SUGGEST_REPEATS = 2000
+FILTER_SPELLS = 100000
+STARTUP_RUNS = 5
+SERVER_ENDPOINT = "tcp://127.0.0.1:5597"
+BULK_SPELLS = 100000
+COALESCE_CLIENTS = 32 # threads looking up the same spells at the same moment
+COALESCE_SPELLS = 20
+BULK_ONE_AT_A_TIME = 2000 # spells bookmarked one by one, for comparison with a bulk import
+SERVER_CLIENTS = 24
+SERVER_REQUESTS = 40 # per client
+SERVER_SPELLS = 80 # spells the clients look up, so many of their lookups overlap
+EAGER_IMPORTS = "import requests, zmq, zmq.asyncio\nfor name in ['numpy', 'msgpack']:\n    try:\n        __import__(name)\n    except ImportError:\n        pass\n"
+DAMAGE_SPELLS = 10000
+DAMAGE_QUERIES = [("slot", 5, ""), ("slot", 9, "damage=fire class=sorcerer"), ("character", 11, "level=0")]
+ENCOUNTER_TRIALS = [100000, 1000000]
+ENCOUNTER_PYTHON_TRIALS = 100000 # trials run without NumPy, for comparison
+# (name, slot or character level, damage, "attack"/"save"/"hit", half damage on a save?)
+ENCOUNTER_ROTATION = [("Fireball", 5, "10d6", "save", True), ("Fire Bolt", 5, "2d10", "attack", False), ("Magic Missile", 3, "5d4+5", "hit", False), ("Sacred Flame", 5, "2d8", "save", False)]
+FILTER_QUERIES = ["level=3 class=wizard concentration=no", "school=evocation damage=fire components=!m", "level=1,2 ritual=yes"]
+# limits for the end-to-end workloads: p99 latency in milliseconds and resident memory growth in MB;
+# a run that goes over any of them fails ("{size}" stands for each of SPELLBOOK_SIZES)
+REGRESSION_THRESHOLDS = {
+    "lookup (cold)": {"p99": 100, "memory": 20},
+    "lookup (cached)": {"p99": 5, "memory": 20},
+    "search (api)": {"p99": 100, "memory": 20},
+    "search (catalog)": {"p99": 5, "memory": 20},
+    "custom spell": {"p99": 20, "memory": 20},
+    "dice (service)": {"p99": 20, "memory": 20},
+    "churn {size}": {"p99": 50, "memory": 50},
+    "edit {size}": {"p99": 50, "memory": 50},
+    "sort {size}": {"p99": 50, "memory": 50}
+}
+# limits for the workloads that grow with the spellbook, per 1000 bookmarks
+SPELLBOOK_THRESHOLDS = {
+    "load {size}": {"p99": 80, "memory": 2},
+    "resync {size}": {"p99": 300, "memory": 20}
+}
+
+# Build a spell shaped like a dnd5eapi response
+def makeSpell(i):
+    index = "spell-" + str(i)
+    return {
+        "index": index,
+        "name": "Spell " + str(i),
+        "url": "/api/spells/" + index,
+        "desc": ["A bright streak flashes from your pointing finger to a point you choose within range and then blossoms with a low roar into an explosion of flame. Each creature in a 20-foot-radius sphere centered on that point must make a Dexterity saving throw."],
+        "higher_level": ["When you cast this spell using a spell slot of 4th level or higher, the damage increases by 1d6 for each slot level above 3rd."],
+        "range": "150 feet",
+        "components": ["V", "S", "M"],
+        "material": "A tiny ball of bat guano and sulfur.",
+        "ritual": False,
+        "duration": "Instantaneous",
+        "concentration": False,
+        "casting_time": "1 action",
+        "level": i % 10,
+        "damage": {
+            "damage_type": {"index": "fire", "name": "Fire", "url": "/api/damage-types/fire"},
+            "damage_at_slot_level": {str(slot): str(slot + 5) + "d6" for slot in range(3, 10)}
+        },
+        "school": {"index": "evocation", "name": "Evocation", "url": "/api/magic-schools/evocation"},
+        "classes": [
+            {"index": "sorcerer", "name": "Sorcerer", "url": "/api/classes/sorcerer"},
+            {"index": "wizard", "name": "Wizard", "url": "/api/classes/wizard"}
+        ],
+        "subclasses": [{"index": "lore", "name": "Lore", "url": "/api/subclasses/lore"}]
+    }
+
+# Stand-in for the dnd5eapi spell endpoints, serving made-up spells "spell-0", "spell-1", ...
+# with an ETag on every answer, replying "304 Not Modified" when the client already has that version
+class FakeSpellApiHandler(BaseHTTPRequestHandler):
+    requestCount = 0
+
+    def do_GET(self):
+        FakeSpellApiHandler.requestCount += 1
+        time.sleep(API_LATENCY)
+        index = self.path.split("/api/spells/", 1)[-1]
+        if (index.startswith("spell-") and index[6:].isdigit()):
+            self.reply(200, makeSpell(int(index[6:])))
+        elif (index.startswith("?name=")):
+            matches = [{"index": "spell-" + str(i), "name": "Spell " + str(i)} for i in range(API_SPELLS) if index[6:] in str(i)]
+            self.reply(200, {"count": len(matches), "results": matches})
+        elif (index == ""):
+            spells = [{"index": "spell-" + str(i), "name": "Spell " + str(i), "url": "/api/spells/spell-" + str(i)} for i in range(API_SPELLS)]
+            self.reply(200, {"count": len(spells), "results": spells})
+        else:
+            self.reply(404, {"error": "Not found"})
+
+    def reply(self, status, body):
+        payload = json.dumps(body).encode('utf-8')
+        etag = '"' + hashlib.sha1(payload).hexdigest() + '"'
+        if (status == 200 and self.headers.get("If-None-Match") == etag):
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        if (status == 200):
+            self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+# Start the stand-in API in a background thread and point the client at it
+def startFakeSpellApi():
+    server = ThreadingHTTPServer(("127.0.0.1", API_PORT), FakeSpellApiHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    main.SPELL_API_URL = "http://127.0.0.1:" + str(API_PORT) + "/api/spells/"
+    return server
+
+# Give the client empty caches in a scratch directory, so every run starts cold
+def useColdCaches(directory):
+    main.spellCache = main.SpellCache(os.path.join(directory, "cache.db"), main.CACHE_MEMORY_SIZE, main.CACHE_DISK_BYTES, main.CACHE_TTL, main.CACHE_MISS_TTL)
+    main.spellCatalog = main.SpellCatalog(os.path.join(directory, "catalog.db"))
+    main.renderedSpells.clear()
+
+# Count the file descriptors held by this process (Linux only)
+def countOpenFds():
+    try:
+        return len(os.listdir("/proc/self/fd"))
+    except OSError:
+        return -1
+
+# Stand-in REP service that echoes every request back until it receives "end_program"
+def runEchoService(context, port, ready):
+    socket = context.socket(zmq.REP)
+    socket.bind("tcp://127.0.0.1:" + str(port))
+    ready.set()
+    while True:
+        message = socket.recv()
+        socket.send(message)
+        if (b"end_program" in message):
+            break
+    socket.close()
+
+# Send one request the way the client did before pooling: a new context and socket per call
+def unpooledCall(payload, port):
+    context = zmq.Context()
+    socket = context.socket(zmq.REQ)
+    socket.connect("tcp://localhost:" + str(port))
+    socket.send_string(payload)
+    return socket.recv()
+
+# Send one request over the shared, long-lived service socket
+def pooledCall(payload):
+    return main.runOnTransport(main.exchange("dice", payload.encode('utf-8'), main.SERVICE_TIMEOUT, 0))
+
+# Time numCalls requests made with callFunction and report latency and fd growth
+def timeCalls(label, numCalls, callFunction):
+    payload = json.dumps({"option": 1, "n": 20, "operation": None, "m": None})
+    fdsBefore = countOpenFds()
+    start = time.perf_counter()
+    for i in range(numCalls):
+        callFunction(payload)
+    elapsed = time.perf_counter() - start
+    fdsAfter = countOpenFds()
+    print(f"{label:<10} {numCalls} calls  {elapsed / numCalls * 1e6:9.1f} us/call  fds {fdsBefore} -> {fdsAfter}")
+
+# Compare per-call latency and fd usage of unpooled and pooled microservice sockets
+def benchServiceSockets(numCalls):
+    print("\nMICROSERVICE SOCKETS")
+    serverContext = zmq.Context()
+    ready = threading.Event()
+    server = threading.Thread(target=runEchoService, args=(serverContext, BENCH_PORT, ready), daemon=True)
+    server.start()
+    ready.wait()
+
+    # each unpooled call's context and socket are freed when it returns, so its fd count stays flat; the pooled
+    # run's fds grow once, for the shared context, transport loop and socket its first call opens
+    timeCalls("unpooled", numCalls, lambda payload: unpooledCall(payload, BENCH_PORT))
+
+    main.SERVICE_PORTS['dice'] = BENCH_PORT
+    timeCalls("pooled", numCalls, pooledCall)
+
+    pooledCall(json.dumps({"end_program": True}))
+    main.closeServiceSockets()
+    server.join()
+    serverContext.term()
+
+# Measure how long shutdown and the startup health check take when no microservice is running,
+# which used to hang forever
+def benchUnavailableServices():
+    print("\nUNAVAILABLE MICROSERVICES")
+    defaultPorts = dict(main.SERVICE_PORTS)
+    for offset, service in enumerate(main.SERVICE_PORTS):
+        main.SERVICE_PORTS[service] = BENCH_PORT + 10 + offset
+    start = time.perf_counter()
+    reachable = main.checkMicroservices()
+    print(f"health check   {time.perf_counter() - start:6.2f} s  ({sum(reachable.values())} of {len(reachable)} reachable)")
+    start = time.perf_counter()
+    main.exitMicroservices()
+    print(f"exit           {time.perf_counter() - start:6.2f} s  (timeout {main.EXIT_TIMEOUT} s per service)")
+    main.serviceDownUntil.clear() # the exit just found every service down
+    for label in ["first request", "next request"]:
+        start = time.perf_counter()
+        try:
+            main.serviceRequest("dice", {"option": 1, "n": 20, "operation": None, "m": None})
+        except main.ServiceUnavailableError as e:
+            print(f"{label:<14} {time.perf_counter() - start:6.2f} s  ({e})")
+    main.closeServiceSockets()
+    main.SERVICE_PORTS.update(defaultPorts)
+
+# Answer dice requests with the built-in dice handler on a real socket, for the tcp and ipc transports
+def runDiceServer(endpoint, ready):
+    context = zmq.Context()
+    socket = context.socket(zmq.REP)
+    socket.bind(endpoint)
+    services = main.EmbeddedServices()
+    ready.set()
+    stop = False
+    while (not stop):
+        reply, stop = services.handle("dice", socket.recv())
+        socket.send(reply)
+    socket.close()
+    context.term()
+
+# Compare the round-trip latency of a dice roll over each microservice transport
+def benchTransports(numCalls):
+    print("\nMICROSERVICE TRANSPORTS")
+    defaults = (main.SERVICE_TRANSPORT, main.SERVICE_HOST, main.IPC_DIRECTORY, dict(main.SERVICE_PORTS))
+    with tempfile.TemporaryDirectory() as directory:
+        main.SERVICE_HOST = "127.0.0.1"
+        main.SERVICE_PORTS['dice'] = BENCH_PORT
+        main.IPC_DIRECTORY = directory
+        for transport in ["tcp", "ipc", "inproc"]:
+            main.SERVICE_TRANSPORT = transport
+            main.serviceCodecs.clear()
+            server = None
+            if (transport != "inproc"):
+                ready = threading.Event()
+                server = threading.Thread(target=runDiceServer, args=(main.getServiceEndpoint("dice"), ready), daemon=True)
+                server.start()
+                ready.wait()
+            latencies = []
+            for i in range(numCalls):
+                start = time.perf_counter()
+                main.accessDiceRoller(1, 20, None, None)
+                latencies.append((time.perf_counter() - start) * 1e6)
+            main.serviceRequest("dice", main.SERVICE_EXIT_MESSAGES['dice'])
+            main.closeServiceSockets()
+            if (server is not None):
+                server.join()
+            print(f"{transport:<8} {numCalls} calls  p50 {percentile(latencies, 50):8.1f} us  p99 {percentile(latencies, 99):8.1f} us  ({main.getServiceEndpoint('dice')})")
+    main.SERVICE_TRANSPORT, main.SERVICE_HOST, main.IPC_DIRECTORY, ports = defaults
+    main.SERVICE_PORTS.update(ports)
+    main.serviceCodecs.clear()
+
+# Compare encode/decode time and message size of each microservice codec on bookmark lists
+def benchCodecs():
+    print("\nMICROSERVICE CODECS")
+    codecs = [None, 'json']
+    if (main.msgpack is not None):
+        codecs.append('msgpack')
+    for size in CODEC_LIST_SIZES:
+        request = {"json_array": [makeSpell(i) for i in range(size)], "json_object": None, "option": 4}
+        for codec in codecs:
+            start = time.perf_counter()
+            for i in range(CODEC_REPEATS):
+                message = main.encodeMessage(request, codec)
+            encodeTime = (time.perf_counter() - start) / CODEC_REPEATS
+            start = time.perf_counter()
+            for i in range(CODEC_REPEATS):
+                main.decodeMessage(message)
+            decodeTime = (time.perf_counter() - start) / CODEC_REPEATS
+            label = codec or "plain json"
+            print(f"{size:>6} spells  {label:<10} {len(message):>11} bytes  encode {encodeTime * 1e3:9.2f} ms  decode {decodeTime * 1e3:9.2f} ms")
+
+# Measure rolls per second of the local dice engine, with and without NumPy
+def benchDice():
+    print("\nDICE ENGINE")
+    installedNumpy = main.numpy
+    engines = [("pure python", None)]
+    if (installedNumpy is not None):
+        engines.append(("numpy", installedNumpy))
+    for label, engine in engines:
+        main.numpy = engine
+        for expression in DICE_EXPRESSIONS:
+            start = time.perf_counter()
+            main.rollDice(expression, DICE_BATCH)
+            elapsed = time.perf_counter() - start
+            print(f"{label:<12} {expression:<12} {DICE_BATCH / elapsed:14,.0f} rolls/s")
+    main.numpy = installedNumpy
+    for expression in DICE_EXPRESSIONS:
+        start = time.perf_counter()
+        main.diceStatistics(expression)
+        print(f"exact odds   {expression:<12} {(time.perf_counter() - start) * 1e3:10.2f} ms")
+
+# Measure batch mode throughput in commands per second against the stand-in API,
+# running commands one at a time and with lookups pipelined across a window
+def benchBatch():
+    print("\nBATCH MODE")
+    server = startFakeSpellApi()
+    commands = []
+    for i in range(BATCH_COMMANDS):
+        commands.append("lookup spell " + str(i))
+        if (i % 20 == 0):
+            commands.append("search " + str(i))
+            commands.append("roll 8d6+3 10")
+    defaultWindow = main.BATCH_WINDOW
+    for label, window in [("one at a time", 1), ("pipelined", defaultWindow)]:
+        with tempfile.TemporaryDirectory() as directory:
+            useColdCaches(directory)
+            main.BATCH_WINDOW = window
+            out = io.StringIO()
+            start = time.perf_counter()
+            main.runBatch(commands, out, main.Spellbook(os.path.join(directory, "spellbook.db")))
+            elapsed = time.perf_counter() - start
+            failures = out.getvalue().count('"ok": false')
+            print(f"{label:<14} {len(commands)} commands  {len(commands) / elapsed:9.1f} commands/s  ({failures} failed)")
+    main.BATCH_WINDOW = defaultWindow
+    main.stopPrefetch()
+    server.shutdown()
+
+# Measure "did you mean" suggestion time over a name index as large as the API's spell list
+def benchSuggestions():
+    print("\nNAME SUGGESTIONS")
+    start = time.perf_counter()
+    nameIndex = main.SpellNameIndex({"spell-" + str(i): "Spell " + str(i) for i in range(API_SPELLS)})
+    print(f"build          {API_SPELLS} names  {(time.perf_counter() - start) * 1e3:8.2f} ms")
+    for query in SUGGEST_QUERIES:
+        start = time.perf_counter()
+        for i in range(SUGGEST_REPEATS):
+            suggestions = nameIndex.suggest(query)
+        elapsed = (time.perf_counter() - start) / SUGGEST_REPEATS
+        print(f"{query:<14} {elapsed * 1e6:8.1f} us  -> {', '.join(name for index, name in suggestions[:3]) or 'no suggestions'}")
+
+# Compare filter queries answered by the bitset index with a scan over every spell
+def benchFilter(count):
+    print("\nSPELL FILTER")
+    spells = {}
+    for i in range(count):
+        spell = makeSpell(i)
+        spell['concentration'] = (i % 3 == 0)
+        spell['ritual'] = (i % 7 == 0)
+        spells[spell['index']] = spell
+    start = time.perf_counter()
+    spellFilter = main.SpellFilter()
+    spellFilter.addAll(spells.items())
+    print(f"build          {count} spells  {(time.perf_counter() - start) * 1e3:9.1f} ms")
+    for query in FILTER_QUERIES:
+        criteria = main.parseFilterQuery(query)
+        start = time.perf_counter()
+        matches = spellFilter.query(criteria)
+        indexed = time.perf_counter() - start
+        start = time.perf_counter()
+        scanned = [index for index, spell in spells.items() if matchesCriteria(main.getFilterValues(spell), criteria)]
+        scan = time.perf_counter() - start
+        agree = "same" if sorted(scanned) == sorted(index for index, name in matches) else "DIFFERENT"
+        print(f"{query:<44} {len(matches):>6} matches  index {indexed * 1e3:8.2f} ms  scan {scan * 1e3:8.2f} ms  ({agree} results)")
+
+# Check a spell's filter values against criteria the slow way, for comparison with SpellFilter.query
+def matchesCriteria(values, criteria):
+    for attribute, wanted in criteria.items():
+        if (any(value[1:] in values[attribute] for value in wanted if value.startswith("!"))):
+            return False
+        options = [value for value in wanted if not value.startswith("!")]
+        if (options and not any(value in values[attribute] for value in options)):
+            return False
+    return True
+
+# Rank spells by expected damage with DamageTable, against parsing and working out each spell's damage one at a time
+def benchDamage(count):
+    print("\nDAMAGE ANALYTICS")
+    spells = {}
+    for i in range(count):
+        spell = makeSpell(i)
+        sides = [4, 6, 8, 10, 12][i % 5]
+        if (spell['level'] == 0):
+            spell['damage'] = {"damage_type": spell['damage']['damage_type'], "damage_at_character_level": {str(level): str(level // 5 + 1) + "d" + str(sides) for level in [1, 5, 11, 17]}}
+        else:
+            spell['damage']['damage_at_slot_level'] = {str(slot): str(slot + i % 7) + "d" + str(sides) + "+" + str(i % 4) for slot in range(spell['level'], 10)}
+        spells[spell['index']] = spell
+    start = time.perf_counter()
+    table = main.DamageTable(spells.items())
+    print(f"build          {count} spells  {(time.perf_counter() - start) * 1e3:9.1f} ms  ({len(table.expressions)} different damage expressions)")
+    spellFilter = main.SpellFilter()
+    spellFilter.addAll(spells.items())
+    for scaling, level, query in DAMAGE_QUERIES:
+        keys = [key for key, name in spellFilter.query(main.parseFilterQuery(query))] if query else None
+        start = time.perf_counter()
+        ranked = table.rank(scaling, level, keys)
+        indexed = time.perf_counter() - start
+        start = time.perf_counter()
+        scanned = []
+        for key in (keys if keys is not None else spells):
+            listed = {int(listedLevel): expression for listedLevel, expression in spells[key]['damage'].get("damage_at_" + scaling + "_level", {}).items() if int(listedLevel) <= level}
+            if (listed):
+                scanned.append((-main.getDamageStatistics(main.parseDamageExpression(listed[max(listed)]))[0], key))
+        scanned.sort()
+        scan = time.perf_counter() - start
+        agree = "same" if [round(-mean, 6) for mean, key in scanned[:len(ranked)]] == [round(result['mean'], 6) for result in ranked] else "DIFFERENT"
+        label = scaling + " " + str(level) + (" " + query if query else "")
+        print(f"{label:<44} table {indexed * 1e3:8.2f} ms  one by one {scan * 1e3:9.1f} ms  ({agree} results)")
+
+# Time encounter simulations of a four-spell rotation with NumPy, without it, and split across processes
+def benchEncounter():
+    print("\nENCOUNTER SIMULATOR")
+    casts = [(name, level, expression, main.parseDiceExpression(expression), resolution, halfOnSave) for name, level, expression, resolution, halfOnSave in ENCOUNTER_ROTATION]
+    encounter = dict(main.ENCOUNTER_DEFAULTS)
+    main.simulateEncounter(casts, encounter, 1) # imports NumPy before anything is timed
+    runs = [("numpy", trials) for trials in ENCOUNTER_TRIALS] + [("python", ENCOUNTER_PYTHON_TRIALS)]
+    for label, trials in runs:
+        numpy = main.numpy
+        if (label == "python"):
+            main.numpy = None
+        start = time.perf_counter()
+        summary = main.simulateEncounter(casts, encounter, trials)
+        elapsed = time.perf_counter() - start
+        main.numpy = numpy
+        print(f"{label:<10} {trials:>9} trials  {elapsed * 1e3:9.1f} ms  average {summary['mean']:6.2f}  5th-95th percentile {summary['percentiles'][5]}-{summary['percentiles'][95]}")
+    workers = os.cpu_count() or 1
+    if (workers == 1):
+        print("processes  skipped: only one CPU")
+        return
+    trials = main.ENCOUNTER_PARALLEL_TRIALS * 2
+    start = time.perf_counter()
+    main.simulateTrials(casts, encounter, trials)
+    single = time.perf_counter() - start
+    start = time.perf_counter()
+    main.simulateEncounter(casts, encounter, trials)
+    split = time.perf_counter() - start
+    print(f"processes  {trials:>9} trials  {split * 1e3:9.1f} ms on {workers} processes  ({single * 1e3:.1f} ms in one)")
+
+# Memory held by the spells callFunction() returns, in bytes, measured with tracemalloc
+def measureMemory(callFunction):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = callFunction()
+    held = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return kept, held
+
+# Compare memory per spell and serialized size of raw API dictionaries and the compact Spell model
+def benchSpellModel(count):
+    print("\nSPELL MODEL")
+    payloads = [json.dumps(makeSpell(i)) for i in range(count)]
+    dicts, dictBytes = measureMemory(lambda: [json.loads(payload) for payload in payloads])
+    spells, spellBytes = measureMemory(lambda: [main.Spell.fromApi(json.loads(payload)) for payload in payloads])
+    print(f"{'api dict':<14} {dictBytes / count:9.0f} bytes/spell in memory")
+    print(f"{'Spell':<14} {spellBytes / count:9.0f} bytes/spell in memory  ({dictBytes / spellBytes:.1f}x smaller)")
+    # one bookmark change sends one spell, so compare single-spell messages (large lists get compressed)
+    sizes = [
+        ("api dict", sum(len(payload) for payload in payloads)),
+        ("saved row", sum(len(json.dumps(spell.toRow(), separators=(',', ':'))) for spell in spells)),
+        ("message (old)", sum(len(main.encodeMessage(spell, 'json')) for spell in dicts)),
+        ("message", sum(len(main.encodeMessage(spell, 'json')) for spell in spells))
+    ]
+    if (main.msgpack is not None):
+        sizes.append(("msgpack (old)", sum(len(main.encodeMessage(spell, 'msgpack')) for spell in dicts)))
+        sizes.append(("msgpack", sum(len(main.encodeMessage(spell, 'msgpack')) for spell in spells)))
+    for label, size in sizes:
+        print(f"{label:<14} {size / count:9.0f} bytes/spell serialized")
+
+# Stand-ins for the four microservices, speaking the same protocols as the real ones:
+# A only answers the exit message (bookmarks are sorted locally), B keeps a versioned copy of
+# the bookmarks, C builds custom spells from their fields and D rolls a dice with a modifier
+class FakeMicroservices:
+    def __init__(self, ports):
+        self.ports = ports
+        self.codecs = {} # service -> body format it answers in, as negotiated by the client
+        self.bookmarks = {}
+        self.version = 0
+        self.context = zmq.Context()
+        self.thread = None
+
+    # Bind every service and answer requests in a background thread until each has been told to exit
+    def start(self):
+        sockets = {}
+        for service, port in self.ports.items():
+            socket = self.context.socket(zmq.REP)
+            socket.bind("tcp://127.0.0.1:" + str(port))
+            sockets[socket] = service
+        self.thread = threading.Thread(target=self.run, args=(sockets,), daemon=True)
+        self.thread.start()
+
+    def run(self, sockets):
+        poller = zmq.Poller()
+        for socket in sockets:
+            poller.register(socket, zmq.POLLIN)
+        running = set(sockets.values())
+        while (running):
+            for socket, event in poller.poll():
+                service = sockets[socket]
+                request = main.decodeMessage(socket.recv())
+                if (request.get('accept_codecs')):
+                    self.codecs[service] = request['accept_codecs'][0]
+                reply = self.handle(service, request)
+                if (reply is None):
+                    running.discard(service)
+                    socket.send(b"")
+                elif (isinstance(reply, bytes)):
+                    socket.send(reply)
+                else:
+                    socket.send(main.encodeMessage(reply, self.codecs.get(service)))
+        for socket in sockets:
+            socket.close()
+        self.context.term()
+
+    # Return the reply body for one request, or None for an exit message
+    def handle(self, service, request):
+        if (service == "sort"):
+            return None
+        if (service == "dice"):
+            if (request['option'] == 0):
+                return None
+            roll = random.randint(1, request['n'])
+            if (request['option'] == 2):
+                roll = roll + request['m'] if request['operation'] == "+" else roll - request['m']
+            if (self.codecs.get(service) is None):
+                return roll.to_bytes(4, byteorder='big', signed=True)
+            return roll
+        if (service == "spells"):
+            if (request['option'] == 0):
+                return None
+            record = dict(request['json_object'] or {})
+            record.update(request['spell_fields'] or {})
+            return {"record": record}
+        return self.handleBookmarks(request)
+
+    def handleBookmarks(self, request):
+        option = request['option']
+        if (option == 0):
+            return None
+        if (option == 4):
+            if (not request.get('append')):
+                self.bookmarks = {}
+            self.bookmarks.update((main.getSpellId(spell), spell) for spell in request['json_array'])
+        elif (request.get('version') != self.version):
+            return {"version": self.version, "resync": True}
+        elif (option == 2):
+            self.bookmarks.pop(request['spell_id'], None)
+        else:
+            self.bookmarks.pop(request['spell_id'], None)
+            self.bookmarks[main.getSpellId(request['json_object'])] = request['json_object']
+        self.version += 1
+        return {"version": self.version}
+
+# Save size spells straight into a new bookmarks store, far faster than adding them one by one
+def fillSpellbook(path, size):
+    book = main.Spellbook(path)
+    book.load()
+    rows = []
+    for i in range(size):
+        spell = makeSpell(i)
+        rows.append((spell['index'], i, spell['name'], json.dumps(spell), main.getSpellLevel(spell), json.dumps(main.getSpellClasses(spell))))
+    book.db.executemany("INSERT INTO bookmarks (spell_id, seq, name, body, level, classes) VALUES (?, ?, ?, ?, ?, ?)", rows)
+    book.db.commit()
+    book.db.close()
+
+# Resident memory of this process in MB (Linux only)
+def residentMemory():
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except OSError:
+        return 0.0
+
+# Nearest-rank percentile of a list of numbers
+def percentile(values, percent):
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, int(len(ordered) * percent / 100 + 0.5) - 1))]
+
+# Run callFunction(i) for i in range(calls), returning the latency p50/p99 in ms and memory growth in MB
+def runWorkload(name, calls, callFunction):
+    memoryBefore = residentMemory()
+    latencies = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for i in range(calls):
+            start = time.perf_counter()
+            callFunction(i)
+            latencies.append((time.perf_counter() - start) * 1e3)
+    result = {"name": name, "calls": calls, "p50": percentile(latencies, 50), "p99": percentile(latencies, 99), "memory": residentMemory() - memoryBefore}
+    print(f"{name:<18} {calls:>6} calls  p50 {result['p50']:9.3f} ms  p99 {result['p99']:9.3f} ms  memory {result['memory']:+8.1f} MB")
+    return result
+
+# Look up the regression limits for a workload
+def getThresholds(name):
+    if (name in REGRESSION_THRESHOLDS):
+        return REGRESSION_THRESHOLDS[name]
+    for size in SPELLBOOK_SIZES:
+        for pattern, limits in REGRESSION_THRESHOLDS.items():
+            if (pattern.format(size=size) == name):
+                return limits
+        for pattern, limits in SPELLBOOK_THRESHOLDS.items():
+            if (pattern.format(size=size) == name):
+                return {measure: limit * size / 1000 for measure, limit in limits.items()}
+    return {}
+
+# Drive scripted workloads through the client against the stand-in API and microservices,
+# then compare the results with REGRESSION_THRESHOLDS; returns False if any limit was exceeded
+def benchEndToEnd(sizes):
+    print("\nEND TO END")
+    server = startFakeSpellApi()
+    defaultPorts = dict(main.SERVICE_PORTS)
+    main.SERVICE_PORTS.update(FAKE_SERVICE_PORTS)
+    services = FakeMicroservices(FAKE_SERVICE_PORTS)
+    services.start()
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        useColdCaches(directory)
+        indices = ["spell-" + str(i % API_SPELLS) for i in range(WORKLOAD_CALLS)]
+        results.append(runWorkload("lookup (cold)", API_SPELLS, lambda i: main.printSpell(main.fetchSpell("spell-" + str(i))[1])))
+        results.append(runWorkload("lookup (cached)", WORKLOAD_CALLS, lambda i: main.printSpell(main.fetchSpell(indices[i])[1])))
+        results.append(runWorkload("search (api)", WORKLOAD_CALLS, lambda i: main.findKeywordMatches(str(i % 40))))
+        with contextlib.redirect_stdout(io.StringIO()):
+            main.spellCatalog.sync()
+        results.append(runWorkload("search (catalog)", WORKLOAD_CALLS, lambda i: main.findKeywordMatches("spell " + str(i % 40))))
+        fields = {"name": "Custom", "level": "3", "desc": "A custom spell."}
+        results.append(runWorkload("custom spell", WORKLOAD_CALLS, lambda i: main.generateSpell(fields, 1, None)))
+        defaultBackend = main.DICE_BACKEND
+        main.DICE_BACKEND = "service"
+        results.append(runWorkload("dice (service)", WORKLOAD_CALLS, lambda i: main.rollDice("1d20+5")))
+        main.DICE_BACKEND = defaultBackend
+
+        for size in sizes:
+            path = os.path.join(directory, "spellbook-" + str(size) + ".db")
+            fillSpellbook(path, size)
+            book = main.Spellbook(path)
+            results.append(runWorkload("load " + str(size), 1, lambda i: len(book)))
+            main.bookmarkVersion = -1
+            results.append(runWorkload("resync " + str(size), 1, lambda i: main.resyncBookmarks(book)))
+            # add a new spell, edit it, then remove it again
+            def churn(i):
+                spell = makeSpell(size + i // 3)
+                if (i % 3 == 0):
+                    main.accessBookmarkMods(spell, book, 1)
+                elif (i % 3 == 1):
+                    main.accessBookmarkMods(dict(spell, level=(spell['level'] + 1) % 10), book, 3, spell)
+                else:
+                    main.accessBookmarkMods(spell, book, 2)
+            results.append(runWorkload("churn " + str(size), CHURN_OPERATIONS, churn))
+            # change one field of spells spread across the spellbook, checked against each spell's version
+            def edit(i):
+                spellId = "spell-" + str(i * size // WORKLOAD_CALLS)
+                spellToEdit = book.getSpell(spellId)
+                version = book.getVersion(spellId)
+                editedSpell = main.generateSpell({"range": str(i) + " feet"}, 2, spellToEdit, version)
+                main.accessBookmarkMods(editedSpell, book, 3, spellToEdit, version)
+            results.append(runWorkload("edit " + str(size), WORKLOAD_CALLS, edit))
+            orders = [("level", False, None), ("level", True, None), ("name", False, None), ("class", False, "wizard")]
+            def sortPage(i):
+                sortBy, descending, className = orders[i % len(orders)]
+                for spellId in book.getSortedIds(sortBy, descending, className)[:main.PAGE_SIZE]:
+                    main.renderSpell(book.getSpell(spellId))
+            results.append(runWorkload("sort " + str(size), WORKLOAD_CALLS, sortPage))
+            book.db.close()
+
+    main.exitMicroservices()
+    services.thread.join()
+    main.SERVICE_PORTS.update(defaultPorts)
+    main.stopPrefetch()
+    server.shutdown()
+    print(f"peak resident memory {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MB")
+
+    passed = True
+    for result in results:
+        for measure, limit in getThresholds(result["name"]).items():
+            if (result[measure] > limit):
+                print(f"REGRESSION: {result['name']} {measure} {result[measure]:.1f} is over the limit of {limit}")
+                passed = False
+    return passed
+
+# Median seconds for a fresh interpreter to run the given code (started in a scratch directory next to main.py)
+def timeInterpreter(code, directory):
+    times = []
+    for i in range(STARTUP_RUNS):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", code], cwd=directory, env=dict(os.environ, PYTHONPATH=MAIN_DIRECTORY), check=True, stdout=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+# Median seconds from launching the program until its main menu asks for an option
+def timeToMenu(preamble, directory):
+    code = preamble + "import sys, runpy\nsys.argv = ['main.py', '--transport', 'inproc']\nrunpy.run_path(" + repr(os.path.join(MAIN_DIRECTORY, "main.py")) + ", run_name='__main__')\n"
+    times = []
+    for i in range(STARTUP_RUNS):
+        start = time.perf_counter()
+        process = subprocess.Popen([sys.executable, "-u", "-c", code], cwd=directory, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        output = b""
+        while (b"Choose an option" not in output):
+            chunk = process.stdout.read1(4096)
+            if (not chunk):
+                break
+            output += chunk
+        times.append(time.perf_counter() - start)
+        process.kill()
+        process.communicate()
+    return statistics.median(times)
+
+# A name search's first steps: the name list for suggestions, then the spell itself
+def firstSearch():
+    main.getSpellNameIndex()
+    main.fetchSpell("spell-1")
+
+# Compare start-up with every heavy module imported up front against deferred imports,
+# and the first name search with and without the background warm-up having run
+def benchStartup():
+    print("\nSTART-UP")
+    with tempfile.TemporaryDirectory() as directory:
+        eager = timeInterpreter(EAGER_IMPORTS + "import main", directory)
+        deferred = timeInterpreter("import main", directory)
+        print(f"import         eager {eager * 1e3:8.1f} ms  deferred {deferred * 1e3:8.1f} ms")
+        eager = timeToMenu(EAGER_IMPORTS, directory)
+        deferred = timeToMenu("", directory)
+        print(f"time to menu   eager {eager * 1e3:8.1f} ms  deferred {deferred * 1e3:8.1f} ms")
+
+    server = startFakeSpellApi()
+    searchTimes = {}
+    for label, warm in [("cold", False), ("warmed up", True)]:
+        with tempfile.TemporaryDirectory() as directory:
+            useColdCaches(directory)
+            main.httpSession = None
+            main.spellNameIndex = None
+            if (warm):
+                main.warmUp()
+            start = time.perf_counter()
+            firstSearch()
+            searchTimes[label] = time.perf_counter() - start
+    print(f"first search   cold  {searchTimes['cold'] * 1e3:8.1f} ms  warmed up {searchTimes['warmed up'] * 1e3:8.1f} ms")
+    main.closeServiceSockets()
+    main.stopPrefetch()
+    server.shutdown()
+
+# One client of the spellbook server: looks up random spells and bookmarks a few, timing each reply
+def runServerClient(client, latencies, failures):
+    context = zmq.Context.instance()
+    socket = context.socket(zmq.REQ)
+    socket.connect(SERVER_ENDPOINT)
+    picker = random.Random(client)
+    user = "player-" + str(client)
+    for i in range(SERVER_REQUESTS):
+        command = ("bookmark add " if i % 10 == 0 else "lookup ") + "spell " + str(picker.randrange(SERVER_SPELLS))
+        start = time.perf_counter()
+        socket.send_string(json.dumps({"user": user, "command": command}))
+        reply = json.loads(socket.recv())
+        latencies.append((time.perf_counter() - start) * 1e3)
+        if (not reply["ok"] and "already in your bookmarks" not in reply["error"]):
+            failures.append(reply["error"])
+    socket.close()
+
+# Serve many clients at once from one process and count the API calls the shared cache saves,
+# compared with every client running its own program with its own cold cache
+def benchServer():
+    print("\nSPELLBOOK SERVER")
+    api = startFakeSpellApi()
+    with tempfile.TemporaryDirectory() as directory:
+        useColdCaches(directory)
+        main.mirrorBookmarks = False
+        server = main.SpellbookServer(SERVER_ENDPOINT, directory, main.SERVER_WORKERS)
+        server.start()
+        proxyThread = threading.Thread(target=server.serve)
+        proxyThread.start()
+        FakeSpellApiHandler.requestCount = 0
+        latencies = []
+        failures = []
+        clients = [threading.Thread(target=runServerClient, args=(client, latencies, failures)) for client in range(SERVER_CLIENTS)]
+        start = time.perf_counter()
+        for thread in clients:
+            thread.start()
+        for thread in clients:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        server.stop()
+        proxyThread.join()
+        main.mirrorBookmarks = True
+    separateCalls = 0
+    for client in range(SERVER_CLIENTS):
+        picker = random.Random(client)
+        separateCalls += len({picker.randrange(SERVER_SPELLS) for i in range(SERVER_REQUESTS)})
+    requestCount = SERVER_CLIENTS * SERVER_REQUESTS
+    print(f"{SERVER_CLIENTS} clients      {requestCount} requests  {requestCount / elapsed:9.1f} requests/s  p50 {percentile(latencies, 50):8.2f} ms  p99 {percentile(latencies, 99):8.2f} ms  ({len(failures)} failed)")
+    print(f"API calls      shared cache {FakeSpellApiHandler.requestCount}  one program per client about {separateCalls}")
+    main.stopPrefetch()
+    api.shutdown()
+    return not failures
+
+# Export a large spellbook to JSON Lines and CSV and import it into an empty one, reporting
+# throughput and memory growth, against bookmarking the same spells one at a time
+def benchBulk(count):
+    print("\nBULK IMPORT & EXPORT")
+    with tempfile.TemporaryDirectory() as directory:
+        source = os.path.join(directory, "source.db")
+        fillSpellbook(source, count)
+        book = main.Spellbook(source)
+        len(book)
+        for fileFormat in ["jsonl", "csv"]:
+            path = os.path.join(directory, "spells." + fileFormat)
+            memoryBefore = residentMemory()
+            start = time.perf_counter()
+            with open(path, "w", newline="", encoding="utf-8") as out:
+                exported = book.exportSpells(out, fileFormat)
+            elapsed = time.perf_counter() - start
+            print(f"export {fileFormat:<7} {exported} spells  {exported / elapsed:9.0f} spells/s  memory {residentMemory() - memoryBefore:+7.1f} MB  file {os.path.getsize(path) / 1e6:6.1f} MB")
+        for fileFormat in ["jsonl", "csv"]:
+            target = main.Spellbook(os.path.join(directory, "import-" + fileFormat + ".db"))
+            memoryBefore = residentMemory()
+            start = time.perf_counter()
+            with open(os.path.join(directory, "spells." + fileFormat), newline="", encoding="utf-8") as lines:
+                summary = target.importSpells(lines, fileFormat)
+            elapsed = time.perf_counter() - start
+            print(f"import {fileFormat:<7} {summary['added']} spells  {summary['added'] / elapsed:9.0f} spells/s  memory {residentMemory() - memoryBefore:+7.1f} MB  ({summary['duplicates']} duplicates, {summary['invalid']} invalid)")
+            target.db.close()
+        target = main.Spellbook(os.path.join(directory, "one-at-a-time.db"))
+        start = time.perf_counter()
+        for i in range(BULK_ONE_AT_A_TIME):
+            target.append(book.getSpell("spell-" + str(i)))
+        elapsed = time.perf_counter() - start
+        print(f"one at a time  {BULK_ONE_AT_A_TIME} spells  {BULK_ONE_AT_A_TIME / elapsed:9.0f} spells/s")
+        target.db.close()
+        book.db.close()
+
+# Count the API requests made when many threads look up the same spells at once, then compare
+# refreshing stale cached spells by downloading them again with revalidating them by ETag
+def benchCoalescing():
+    print("\nREQUEST COALESCING & REVALIDATION")
+    api = startFakeSpellApi()
+    defaultTtl = main.spellCache.ttl
+    with tempfile.TemporaryDirectory() as directory:
+        useColdCaches(directory)
+        main.metrics = main.Metrics(main.METRICS_BUCKETS)
+        FakeSpellApiHandler.requestCount = 0
+        barrier = threading.Barrier(COALESCE_CLIENTS)
+        def lookUpAll():
+            barrier.wait()
+            for i in range(COALESCE_SPELLS):
+                main.fetchSpell("spell-" + str(i))
+        threads = [threading.Thread(target=lookUpAll) for i in range(COALESCE_CLIENTS)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        counters = main.metrics.snapshot()["counters"]
+        print(f"concurrent     {COALESCE_CLIENTS * COALESCE_SPELLS} lookups of {COALESCE_SPELLS} spells  {FakeSpellApiHandler.requestCount} API requests  ({counters.get('api.coalesced', 0)} shared)  {elapsed * 1e3:8.1f} ms")
+
+        for label in ["download", "revalidate"]:
+            if (label == "download"):
+                os.makedirs(os.path.join(directory, "refresh"))
+                useColdCaches(os.path.join(directory, "refresh"))
+            main.spellCache.ttl = defaultTtl if label == "download" else 0 # every cached spell is stale
+            main.metrics = main.Metrics(main.METRICS_BUCKETS)
+            start = time.perf_counter()
+            for i in range(API_SPELLS):
+                main.fetchSpell("spell-" + str(i))
+            elapsed = time.perf_counter() - start
+            snapshot = main.metrics.snapshot()
+            print(f"{label:<14} {API_SPELLS} spells  {elapsed * 1e3:8.1f} ms  {snapshot['operations']['http.spell']['bytes_in'] / 1024:8.1f} KB received  ({snapshot['counters'].get('api.revalidated', 0)} not modified)")
+    main.spellCache.ttl = defaultTtl
+    main.metrics = main.Metrics(main.METRICS_BUCKETS)
+    main.stopPrefetch()
+    api.shutdown()
+
+BENCHMARKS = {
+    "sockets": lambda: benchServiceSockets(SOCKET_CALLS),
+    "unavailable": benchUnavailableServices,
+    "transports": lambda: benchTransports(SOCKET_CALLS),
+    "codecs": benchCodecs,
+    "dice": benchDice,
+    "batch": benchBatch,
+    "suggest": benchSuggestions,
+    "filter": lambda: benchFilter(FILTER_SPELLS),
+    "damage": lambda: benchDamage(DAMAGE_SPELLS),
+    "encounter": benchEncounter,
+    "model": lambda: benchSpellModel(MODEL_SPELLS),
+    "e2e": lambda: benchEndToEnd(SPELLBOOK_SIZES),
+    "startup": benchStartup,
+    "server": benchServer,
+    "bulk": lambda: benchBulk(BULK_SPELLS),
+    "coalesce": benchCoalescing
+}
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHMARKS)
+    passed = True
+    for name in names:
+        if (BENCHMARKS[name]() is False):
+            passed = False
+    sys.exit(0 if passed else 1)
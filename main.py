@@ -1,13 +1,187 @@
 # import necessary packages
-import requests
 import textwrap
 import json
-import zmq
+import sys
+import hashlib
+import random
+import math
+import argparse
+import asyncio
+import sqlite3
+import time
+import os
+import csv
+import re
+import bisect
+import threading
+import zlib
+import importlib
+import importlib.util
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future
+from collections import OrderedDict
+
+# Stand-in for a module that is only imported the first time one of its attributes is used,
+# so heavy packages don't slow down reaching the menu (submodules listed are imported along with it)
+class LazyModule:
+    def __init__(self, name, submodules=()):
+        self.name = name
+        self.submodules = submodules
+        self.module = None
+
+    def load(self):
+        if (self.module is None):
+            module = importlib.import_module(self.name)
+            for submodule in self.submodules:
+                importlib.import_module(submodule)
+            self.module = module
+        return self.module
+
+    def __getattr__(self, attribute):
+        return getattr(self.load(), attribute)
+
+# Lazily imported optional module, or None if it isn't installed (checked without importing it)
+def optionalModule(name):
+    if (importlib.util.find_spec(name) is None):
+        return None
+    return LazyModule(name)
+
+requests = LazyModule("requests")
+zmq = LazyModule("zmq", ["zmq.asyncio"])
+
+# optional: NumPy rolls large batches of dice much faster
+numpy = optionalModule("numpy")
+
+# optional: MessagePack makes microservice messages smaller and faster to encode
+msgpack = optionalModule("msgpack")
 
 #CONSTANTS
 FIRST_LEVEL_PARAMS = ['index', 'name', 'level', 'url']
-SECOND_LEVEL_PARAMS = ['index', 'name', 'url', 'desc', 'higher_level', 'range', 'components', 'material', 'area_of_effect', 'ritual', 'duration', 'concentration', 'casting_time', 'level', 'attack_type', 'damage', 'school', 'classes', 'subclasses', 'url']
+SECOND_LEVEL_PARAMS = ['index', 'name', 'url', 'desc', 'higher_level', 'range', 'components', 'material', 'area_of_effect', 'ritual', 'duration', 'concentration', 'casting_time', 'level', 'attack_type', 'damage', 'school', 'classes', 'subclasses', 'url', 'dc']
+SPELL_FIELDS = list(dict.fromkeys(FIRST_LEVEL_PARAMS + SECOND_LEVEL_PARAMS)) # fields a Spell keeps, each once
 DESC_LENGTH = 70
+LINE = "-----------------------------------------------------------------------------"
+PAGE_SIZE = 5 # spell cards printed before asking to continue
+RENDER_CACHE_SIZE = 512 # rendered spell cards kept for reuse
+SERVICE_PORTS = {'dice': 5552, 'bookmarks': 5553, 'spells': 5554, 'sort': 5555}
+SERVICE_HOST = "localhost"
+# how the microservices are reached: "tcp" (SERVICE_HOST and SERVICE_PORTS), "ipc" (Unix domain sockets
+# in IPC_DIRECTORY, for services on this computer) or "inproc" (built-in versions running inside this program)
+SERVICE_TRANSPORT = "tcp"
+IPC_DIRECTORY = "/tmp"
+SERVICE_ENDPOINTS = {} # service -> full ZMQ endpoint, overriding SERVICE_TRANSPORT for that service
+SERVICE_TIMEOUT = 2.5 # seconds to wait for a microservice reply before giving up on that attempt
+SERVICE_TIMEOUT_PER_MB = 1.0 # extra seconds allowed per MB of request, so a large bookmark resync isn't cut off
+SERVICE_RETRIES = 2 # extra attempts after a timeout, each on a fresh socket
+SERVICE_DOWN_COOLDOWN = 10.0 # seconds requests to a microservice that just timed out fail at once instead of waiting again
+EXIT_TIMEOUT = 1.0 # seconds to wait for each microservice to acknowledge the exit message
+HEALTH_CHECK_TIMEOUT = 1.0 # seconds to wait for a microservice to accept a connection at startup
+# message that tells each microservice to shut down
+SERVICE_EXIT_MESSAGES = {
+    'sort': {"end_program": True},
+    'bookmarks': {"json_array": "", "json_object": "", "option": 0},
+    'spells': {"option": 0, "json_array": None, "json_object": None, "spell_fields": None},
+    'dice': {"option": 0, "n": None, "operation": None, "m": None}
+}
+BOOKMARKS_PATH = "spellbook.db"
+# fields asked for when creating a custom spell, in order; editing asks only for the ones picked
+# ('damage' covers the damage type and its scaling)
+CUSTOM_SPELL_FIELDS = ['name', 'level', 'range', 'casting_time', 'duration', 'attack_type', 'desc', 'higher_level', 'concentration', 'ritual', 'components', 'damage', 'school', 'classes']
+# answers getSpellFields collects for those fields (the damage question is split into several)
+SPELL_FIELD_ANSWERS = [field for field in CUSTOM_SPELL_FIELDS if field != 'damage'] + ['has_damage', 'damage_type', 'scaling_type', 'scaling_levels', 'damage_values']
+IMPORT_BATCH_SIZE = 1000 # imported spells written to the bookmarks store per transaction
+RESYNC_BATCH_SIZE = 1000 # bookmarks sent to microservice B per resync request
+IMPORT_ERROR_LIMIT = 20 # invalid import records described in the summary (the rest are only counted)
+# spell fields written to CSV cells as JSON, since they hold lists or nested objects
+CSV_JSON_FIELDS = ['desc', 'higher_level', 'components', 'area_of_effect', 'damage', 'school', 'classes', 'subclasses', 'dc']
+SERVER_ENDPOINT = "tcp://*:5560" # where --serve listens for clients by default
+SERVER_WORKERS = 8 # client requests handled at the same time in server mode
+SERVER_SPELLBOOK_DIRECTORY = "spellbooks" # each user's bookmarks are saved here as <user>.db in server mode
+SERVER_WORKER_ENDPOINT = "inproc://spellbook-server-workers"
+SERVER_CONTROL_ENDPOINT = "inproc://spellbook-server-control"
+DICE_BACKEND = "local" # "local" rolls with the built-in dice engine, "service" asks microservice D
+MAX_DICE = 1000 # most dice in one term of a dice expression
+MAX_FACES = 10000 # most faces on one die
+MAX_BATCH_ROLLS = 100000 # most rolls of one expression at a time from the menu or a batch command
+ROLL_CHUNK_DICE = 1000000 # most dice NumPy rolls into one array; more are rolled a chunk of trials at a time
+DICE_STATES_LIMIT = 5000000 # most work allowed when computing exact dice odds
+DICE_PERCENTILES = [5, 25, 50, 75, 95]
+DAMAGE_MODIFIER = 3 # spellcasting ability modifier assumed where a spell's damage adds "MOD"
+DAMAGE_LEVELS = {"slot": 9, "character": 20} # highest spell slot and character level damage is worked out for
+DAMAGE_RESULTS = 10 # spells listed by a damage comparison
+# encounter simulation settings: target's armor class and saving throw bonus, caster's spell attack bonus,
+# spell save DC and character level (for cantrips), and the number of trials
+ENCOUNTER_DEFAULTS = {"ac": 15, "save": 2, "attack": 7, "dc": 15, "level": 5, "trials": 100000}
+ENCOUNTER_MAX_TRIALS = 10000000
+ENCOUNTER_PARALLEL_TRIALS = 2000000 # simulations of at least this many trials are split across processes
+ENCOUNTER_CHUNK_TRIALS = 100000 # trials a process rolls at once
+ENCOUNTER_CHART_ROWS = 20 # most bars in a simulated damage chart; wider spreads are grouped into ranges
+CODEC_MAGIC = b"\x00S" # binary microservice messages start with these bytes; JSON text never does
+CODEC_MSGPACK = 1 # frame flag: body is MessagePack (otherwise JSON)
+CODEC_ZLIB = 2 # frame flag: body is zlib-compressed
+COMPRESS_THRESHOLD = 4096 # bodies larger than this many bytes are compressed
+BOOKMARK_PROTOCOL = 3 # version of the delta-based bookmark protocol spoken to microservice B (3: resyncs sent in parts)
+SPELL_API_URL = "https://www.dnd5eapi.co/api/spells/"
+CACHE_PATH = "spell_cache.db"
+CACHE_MEMORY_SIZE = 256 # spells kept in memory
+CACHE_DISK_BYTES = 32 * 1024 * 1024 # on-disk store is trimmed back under this size
+CACHE_TTL = 7 * 24 * 60 * 60 # seconds before a cached spell is fetched again
+CACHE_MISS_TTL = 60 * 60 # seconds before a "spell not found" is asked again
+BATCH_WINDOW = 64 # batch mode commands read ahead, so their spell lookups run concurrently
+PREFETCH_WORKERS = 8 # spell details fetched at the same time
+CATALOG_PATH = "spell_catalog.db"
+SPELL_LIST_INDEX = "" # the API's list of all spells is cached like a spell, under its URL's empty index
+SUGGESTION_LIMIT = 5 # most "did you mean" suggestions shown for a spell name that isn't found
+SUGGESTION_MIN_SCORE = 0.3 # least trigram similarity (0 to 1) for a name to be suggested
+FILTER_ATTRIBUTES = ['level', 'school', 'class', 'concentration', 'ritual', 'damage', 'components']
+FILTER_ALIASES = {'classes': 'class', 'damage_type': 'damage', 'component': 'components'} # other names accepted in filter queries
+# weight of a keyword hit in each spell field when ranking keyword search results
+CATALOG_FIELD_WEIGHTS = {'name': 8, 'school': 3, 'classes': 3, 'damage_type': 3, 'higher_level': 1, 'desc': 1}
+# upper bounds (in seconds) of the latency histogram buckets kept for each measured operation
+METRICS_BUCKETS = [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+METRICS_MENU_OPTION = 99 # unlisted main menu option that shows the metrics report
+
+# NumPy random generator, created on first use
+randomGenerator = None
+
+# Spell names for "did you mean" suggestions, built on first use
+spellNameIndex = None
+
+# Rendered spell cards, keyed by (spell index, content hash, DESC_LENGTH)
+renderedSpells = OrderedDict()
+
+# Shared HTTP state: one keep-alive session and a bounded pool of prefetch threads
+httpSession = None
+prefetchExecutor = None
+
+# Shared ZMQ state: one asyncio context per session, run on a background event loop,
+# with one long-lived REQ socket (and a lock to take turns on it) per microservice
+zmqContext = None
+transportLoop = None
+transportLock = threading.Lock() # the warm-up thread and the main thread may both start the loop
+serviceSockets = {}
+serviceLocks = {}
+serviceDownUntil = {} # service -> time.monotonic() until which it is taken to be down
+
+# Built-in microservices for the "inproc" transport, and the thread answering each one's requests
+embeddedServices = None
+embeddedThreads = {}
+
+# Message encoding negotiated with each microservice: None until the service answers in the
+# binary format, then 'msgpack' or 'json' for the body format it used
+serviceCodecs = {}
+
+# Bookmark list version last acknowledged by microservice B
+# -1 means the service hasn't seen this session's saved bookmarks yet, so the first change resyncs it
+bookmarkVersion = -1
+
+# Whether bookmark changes are mirrored to microservice B; off in server mode, where every user has their own
+# spellbook but the service only keeps a single list
+mirrorBookmarks = True
+
+# What to do with the metrics when the program closes (set from the command line)
+profileOnExit = False
+metricsExportPath = None
 
 # MAIN Program & Helpers Functions ----------------------------------------------------------------------------
 # Prints out the title of the program with a short sentence describing the application
@@ -26,22 +200,27 @@ def printTitle():
 # Print out main menu options
 def printMenuOptions():
     print("\nAPPLICATION FUNCTIONS")
-    print("6: Roll a dice (with or without modifiers)")
+    print("10: Simulate an encounter with a rotation of bookmarked spells")
+    print("9: Compare spell damage at a spell slot or character level")
+    print("8: Filter spells by level, school, class, concentration, ritual, damage type or components")
+    print("7: Download the full spell catalog for offline keyword search")
+    print("6: Roll dice (a single dice, a dice expression, or dice odds)")
     print("5: Add a custom spell to Bookmarks/Edit a bookmarked spell")
     print("4: View Bookmarks")
     print("3: Search for a spell with exact spell name.") # (ex. Search for 'shocking grasp', 'fireball', etc.)
-    print("2: Search for a spell by a keyword within the spell's name.") # (ex. Searching 'acid' returns all entries with 'acid' associated in the name.)
+    print("2: Search for a spell by a keyword.") # (ex. Searching 'acid' returns all entries with 'acid' in the name, or in any field once the catalog is downloaded.)
     print("1: Help Manual.")
     print("0: Quit.\n")
 
 # Get user input for any integer input
-def getIntegerInput(prompt, minVal, maxVal):
+# hidden values are accepted too, without being part of the advertised range
+def getIntegerInput(prompt, minVal, maxVal, hidden=()):
     userInput = -1
     invalidInput = True
     while (invalidInput):
         try:
             userInput = int(input(prompt))
-            if (userInput < minVal or userInput > maxVal):
+            if ((userInput < minVal or userInput > maxVal) and userInput not in hidden):
                 print("Invalid Input. Please enter a valid option!")
             else:
                 invalidInput = False
@@ -53,28 +232,26 @@ def getIntegerInput(prompt, minVal, maxVal):
 # (print 1 spell)
 # Code citation: Referenced "GeeksForGeeks"
 def searchSpellName():
-    # API endpoint URL
-    url = "https://www.dnd5eapi.co/api/spells/"
-
     # get user input
     userSpell = input("Enter a spell name: ")
 
-    # format user input into lowercase, dashed form
-    userSpell = userSpell.lower()
-    userSpell = userSpell.replace(" ", "-")
-
-    # update URL for API call
-    url = url + userSpell
+    # check the name against the local name index first, so typos never cost a request
+    with metrics.measure("search.suggest"):
+        nameIndex = getSpellNameIndex()
+        spellIndex = resolveSpellName(userSpell, nameIndex)
+    if (spellIndex is None):
+        return None
 
-    # do an API call to dnd5eapi, given a spell name
+    # look up the spell in the cache, falling back to an API call to dnd5eapi
     try:
-        response = requests.get(url)
+        with metrics.measure("search.name") as measurement:
+            status, spell = fetchSpell(spellIndex)
+            measurement.error = (status != 200)
 
-        if (response.status_code) == 200:
-            spell = response.json()
+        if (status == 200):
             return spell
         else:
-            print("\nError: Spell not found with response code", response.status_code)
+            print("\nError: Spell not found with response code", status)
             return None
 
     except requests.exceptions.RequestException as e:
@@ -82,43 +259,51 @@ def searchSpellName():
         print("Error: ", e)
         return None
 
+# Turn a typed spell name into a known spell index, asking the user to pick from the closest names
+# if it doesn't match one exactly
+# Returns None if the user picks none of them; without a name index the typed name is used as it is
+def resolveSpellName(userSpell, nameIndex):
+    # format user input into lowercase, dashed form
+    spellIndex = toSpellIndex(userSpell)
+    if (nameIndex is None or spellIndex in nameIndex):
+        return spellIndex
+    suggestions = nameIndex.suggest(userSpell)
+    if (not suggestions):
+        print("\nError: No spell found with a name like '" + userSpell.strip() + "'.")
+        return None
+    if (normalizeSpellName(suggestions[0][1]) == normalizeSpellName(userSpell)):
+        # same name with different punctuation, e.g. "tashas hideous laughter"
+        return suggestions[0][0]
+    print("\nSpell not found. Did you mean:")
+    printNumberedMatches([name for index, name in suggestions])
+    print(0, ": ", "None of these")
+    choice = getIntegerInput("\nSpell selection [0 to " + str(len(suggestions)) + "]: ", 0, len(suggestions))
+    if (choice == 0):
+        return None
+    return suggestions[choice - 1][0]
+
+# Format a spell name into the lowercase, dashed index the API uses
+def toSpellIndex(spellName):
+    return spellName.strip().lower().replace(" ", "-")
+
 # Option 2 implementation: search for spells in the API by keyword in spell name 
 # (possibly print many spells)
 def searchKeyWord(bookmarks):
-    matchedIndices = [] # initialize empty array of matched indices
-    matchedNames = [] # initialize empty array of matched names
-    numMatches = 0
-
-    # API endpoint URL
-    url = "https://www.dnd5eapi.co/api/spells/"
-
     # get user input for key word
     keyWord = input("Enter a key word to search for: ")
 
-    # find all matching keywords
-    # format user input into lowercase form
-    keyWord = keyWord.lower()
-    keyWord = keyWord.replace(" ", "+")
-
-    # Find spells that match the key word in name field
     try:
-        allSpellsURL = url + "?"
-        currURL = allSpellsURL + "name=" + keyWord
-        currResponse = requests.get(currURL)
-        if currResponse.status_code == 200:
-            matchingSpells = currResponse.json()
-            for spell in matchingSpells['results']:
-                if spell['index'] not in matchedIndices:
-                    # only match spells that have not already been matched
-                    matchedIndices.append(spell['index'])
-                    matchedNames.append(spell['name'])
-                    numMatches += 1
-        else:
-            print("Error: No response with response code", currResponse.status_code)
+        matchedIndices, matchedNames, status = findKeywordMatches(keyWord)
+        if (status != 200):
+            print("Error: No response with response code", status)
     except requests.exceptions.RequestException as e:
         # handle network-related errors/exceptions
         print("Error: ", e)
         return None
+    numMatches = len(matchedIndices)
+
+    # start fetching the details of matches that aren't in the catalog while the user picks one
+    prefetched = prefetchSpells([index for index in matchedIndices if spellCatalog.get(index) is None])
 
     # display the name of every matching spell found
     if numMatches == 0:
@@ -134,11 +319,12 @@ def searchKeyWord(bookmarks):
                 # Choose a spell to examine further
                 spellChoice = getSpellChoice(numMatches, matchedNames)
                 try: 
-                    # get spell by index
-                    spellToPrintURL = url + matchedIndices[spellChoice - 1]
-                    spellToPrintResp = requests.get(spellToPrintURL)
-                    if spellToPrintResp.status_code == 200:
-                        spellToPrint = spellToPrintResp.json()
+                    # get spell by index, from the catalog if it has been downloaded
+                    spellToPrint = spellCatalog.get(matchedIndices[spellChoice - 1])
+                    status = 200
+                    if (spellToPrint is None):
+                        status, spellToPrint = prefetched[matchedIndices[spellChoice - 1]].result()
+                    if status == 200:
                         printSpell(spellToPrint)
                         # ask user if they want to add this spell to a bookmarks list
                         addSpell(spellToPrint, bookmarks)
@@ -147,11 +333,57 @@ def searchKeyWord(bookmarks):
                 except requests.exceptions.RequestException as e:
                     # handle network-related errors/exceptions
                     print("Error: ", e)
+                    cancelPrefetch(prefetched)
                     return None
                 userChoice = subSpellMenu()
             except ValueError:
                 print("\nInvalid Input. Please enter an integer!")    
 
+    # returning to the main menu, so drop any detail fetches still waiting to run
+    cancelPrefetch(prefetched)
+
+# Find the spells matching a key word: ranked from the downloaded catalog if there is one,
+# otherwise by name through the API
+# Returns (matched indices, matched names, response code); raises RequestException on network errors
+def findKeywordMatches(keyWord):
+    with metrics.measure("search.keyword") as measurement:
+        matchedIndices, matchedNames, status = lookupKeywordMatches(keyWord)
+        measurement.error = (status != 200)
+    return matchedIndices, matchedNames, status
+
+def lookupKeywordMatches(keyWord):
+    matchedIndices = [] # initialize empty array of matched indices
+    matchedNames = [] # initialize empty array of matched names
+
+    if (not spellCatalog.isEmpty()):
+        # answer the search from the downloaded catalog, ranked by relevance
+        for index in spellCatalog.search(keyWord):
+            matchedIndices.append(index)
+            matchedNames.append(spellCatalog.get(index)['name'])
+        return matchedIndices, matchedNames, 200
+
+    # find all matching keywords
+    # format user input into lowercase form
+    keyWord = keyWord.lower()
+    keyWord = keyWord.replace(" ", "+")
+
+    # Find spells that match the key word in name field
+    allSpellsURL = SPELL_API_URL + "?"
+    currURL = allSpellsURL + "name=" + keyWord
+    with metrics.measure("http.search") as request:
+        # the same search made at the same moment (e.g. by two server clients) is only sent once
+        currResponse = spellApi.singleFlight(currURL, lambda: spellApi.get(currURL))
+        request.bytesIn = len(currResponse.content)
+        request.error = (currResponse.status_code != 200)
+    if currResponse.status_code == 200:
+        matchingSpells = currResponse.json()
+        for spell in matchingSpells['results']:
+            if spell['index'] not in matchedIndices:
+                # only match spells that have not already been matched
+                matchedIndices.append(spell['index'])
+                matchedNames.append(spell['name'])
+    return matchedIndices, matchedNames, currResponse.status_code
+
 # Get user's spell choice from sub-menu in Option 2
 def getSpellChoice(numMatches, matchedNames):
     print("\nSelect a spell from the given indices.")
@@ -182,7 +414,7 @@ def subSpellMenu():
 
 # Print a line for ease of reading
 def printLine():
-    print("-----------------------------------------------------------------------------")
+    print(LINE)
 
 # Option 1: Display help menu
 def showHelpMenu():
@@ -191,34 +423,89 @@ def showHelpMenu():
 This program supports searching the DND5e API for particular spells
 based on spell name or a particular keyword. In depth descriptions follow.
 
-Option 6: Roll a dice (with or without modifiers)
+Option 10: Simulate an encounter
+Enter a target's armor class and saving throw bonus, your spell attack
+bonus, spell save DC and character level, then a rotation of your
+bookmarked spells in the order you cast them, with the spell slot for
+each after @, for example 'fireball@5, fire bolt, magic missile@3'.
+The rotation is played out many times (100000 is a good number): attack
+spells must hit the target's armor class, and the target gets a saving
+throw against the others that allow one. You see each spell's average
+damage and hit rate, and the average, percentiles and chart of the total
+damage. Enter more rotations to compare them against the same target.
+
+Option 9: Compare spell damage
+Rank spells in the full spell catalog (download it with option 7
+first) or in your bookmarks by their average damage when cast with a
+given spell slot, or at a given character level for cantrips. Each
+spell is listed with its damage dice, average, standard deviation and
+lowest to highest damage. Narrow the comparison down with the same
+filters as option 8, for example 'damage=fire class=sorcerer' for the
+best fire spells a Sorcerer can cast. Damage that adds your spellcasting
+modifier (MOD) is worked out with a modifier of +3.
+
+Option 8: Filter spells
+Find every spell that matches several criteria at once, in the full
+spell catalog (download it with option 7 first) or in your bookmarks.
+Type filters as attribute=value, for example
+'level=3 school=evocation class=wizard concentration=no damage=fire'.
+The attributes are level, school, class, concentration, ritual,
+damage and components. Separate alternatives with commas ('level=1,2')
+and put '!' before a value to leave it out ('components=!m' finds
+spells without material components).
+
+Option 7: Download the full spell catalog for offline keyword search
+This downloads every spell from the API once and saves it on your
+computer. After that, keyword searches (option 2) look through every
+field of every spell (name, description, higher level effects, school,
+classes and damage type), rank the best matches first, and keep
+working without an internet connection. Run it again at any time to
+refresh the catalog.
+
+Option 6: Roll dice (a single dice, a dice expression, or dice odds)
 You can roll a dice with any number of faces between 1 and 10000.
 You can also add and subtract modifiers, where the modifier can
 take any value between 1 and 10000.
+You can also roll full dice expressions, like '8d6+3' (eight six-sided
+dice plus 3), '2d20kh1' (roll two d20s and keep the highest) or
+'4d6dl1' (roll four d6s and drop the lowest), as many times as you
+like at once. 'kl' keeps the lowest dice and 'dh' drops the highest.
+The odds option shows the average result, the spread of results and
+the chance of rolling each total for an expression.
 
 Option 5: Add a custom spell to Bookmarks/Edit a bookmarked spell
 This is where you can create a custom spell or edit a spell in your
-bookmarks. You have full control over the given fields.
+bookmarks. You have full control over the given fields. When editing,
+pick just the fields you want to change. If the spell was changed
+somewhere else while you were editing it (for example by another copy
+of the program), your edit is not saved, so nothing is overwritten.
           
 Option 4: View Bookmarks
 This is where you can quickly access and view your saved spells, 
 including spells you've edited/spells that you've custom-made.
+Bookmarks are saved on your computer, so they will still be here
+the next time you open the application.
           
 Option 3: Search for a spell with exact spell name
 If the user already knows the name of a particular spell they want
 to view the details of, input '3' from the main menu and type in
 the name of a spell, like 'Shocking Grasp'. Information about the
 spell will appear in the console. 
+If the name is misspelled, the closest spell names are listed so you
+can pick the one you meant.
 The console will also prompt you to add the spell to your bookmarks,
 where you can refer to them later.
           
-Option 2: Search for a spell by a keyword within the spell's name
+Option 2: Search for a spell by a keyword
 If you cannot recall the name of a spell, no worries! This option
 allows you to find a spell based on a 'key word' that may appear
 in the spell's name. Input '2' from the main menu and type in your 
 desired key word. The application will search and display any spell 
 that has a match to the keyword in the name. For example, searching
 'acid' should display any spell whose name has 'acid' in it.
+If you have downloaded the spell catalog (option 7), the keyword is
+matched against every field of the spell instead, and the results
+are ranked with the closest matches first.
 The console will also prompt you to add the spell to your bookmarks,
 where you can refer to them later.
 NOTE: This search option will take slightly longer than the first,
@@ -232,128 +519,2414 @@ more about the commands this application allows.""")
 
 # Print select (programmer-specified) data from a single spell
 def printSpell(spell):
-    printLine()
+    with metrics.measure("render.print") as measurement:
+        card = renderSpell(spell)
+        sys.stdout.write(card)
+        sys.stdout.flush()
+        measurement.bytesOut = len(card)
+
+# Print a list of spells a page at a time, only rendering (and loading) the spells actually shown
+def printSpells(spells):
+    pending = iter(spells)
+    nextSpell = next(pending, None)
+    while (nextSpell is not None):
+        page = []
+        while (nextSpell is not None and len(page) < PAGE_SIZE):
+            page.append(renderSpell(nextSpell))
+            nextSpell = next(pending, None)
+        sys.stdout.write("".join(page))
+        sys.stdout.flush()
+        if (nextSpell is not None):
+            keepGoing = input("Press Enter to see more spells, or enter 0 to stop: ")
+            if (keepGoing.strip() == "0"):
+                return
+
+# Return the printed card for a spell, reusing the last rendering if the spell hasn't changed
+def renderSpell(spell):
+    with metrics.measure("render.card"):
+        return renderCard(spell)
+
+def renderCard(spell):
+    contentHash = hashlib.blake2b(json.dumps(spell, sort_keys=True, default=encodeValue).encode('utf-8'), digest_size=16).digest()
+    key = (spell.get('index'), contentHash, DESC_LENGTH)
+    card = renderedSpells.get(key)
+    if (card is None):
+        card = formatSpell(spell)
+        renderedSpells[key] = card
+        while (len(renderedSpells) > RENDER_CACHE_SIZE):
+            renderedSpells.popitem(last=False)
+    else:
+        renderedSpells.move_to_end(key)
+    return card
 
-    print("Name: ", spell['name'])
-    spellDesc = textwrap.wrap(spell['desc'][0], width=DESC_LENGTH)
+# Format select (programmer-specified) data from a single spell as printable text
+# (custom spells may leave any field but the name empty; those are shown as unknown)
+def formatSpell(spell):
+    lines = [LINE]
 
-    print("\nDescription: ")
-    for line in spellDesc:
-        print(line)
+    lines.append(f"Name:  {spell['name']}")
+    spellDesc = spell.get('desc')
+    spellDesc = textwrap.wrap(spellDesc[0], width=DESC_LENGTH) if spellDesc else ["No description."]
 
-    if (spell['higher_level']):
-        print("\nHigher level: ")
-        levelDesc = textwrap.wrap(spell['higher_level'][0], width=DESC_LENGTH)
-        for line in levelDesc:
-            print(line)
+    lines.append("\nDescription: ")
+    lines.extend(spellDesc)
 
-    print("\nRange: ", spell['range'])
-    print("Casting time: ", spell['casting_time'])
-    print("Duration: ", spell['duration'])
-    print("Level: ", spell['level'])
+    if (spell.get('higher_level')):
+        lines.append("\nHigher level: ")
+        lines.extend(textwrap.wrap(spell['higher_level'][0], width=DESC_LENGTH))
 
-    if (spell['concentration']):
-        print("\nConcentration: Necessary")
+    lines.append(f"\nRange:  {spell.get('range', 'Unknown')}")
+    lines.append(f"Casting time:  {spell.get('casting_time', 'Unknown')}")
+    lines.append(f"Duration:  {spell.get('duration', 'Unknown')}")
+    lines.append(f"Level:  {spell.get('level', 'Unknown')}")
+
+    if (spell.get('concentration')):
+        lines.append("\nConcentration: Necessary")
     else:
-        print("\nConcentration: Not necessary")
+        lines.append("\nConcentration: Not necessary")
     if 'attack_type' in spell:
-        print("Attack type: ", spell['attack_type'])
+        lines.append(f"Attack type:  {spell['attack_type']}")
+    if 'dc' in spell:
+        lines.append(f"Saving throw:  {spell['dc']['dc_type']['name']}" + (" (half damage on a success)" if spell['dc'].get('dc_success') == "half" else ""))
     if ("damage" in spell):
-        print("Damage type: ", spell['damage']['damage_type']['name'])
+        lines.append(f"Damage type:  {spell['damage'].get('damage_type', {}).get('name', 'Unknown')}")
         if 'damage_at_slot_level' in spell['damage']:
-            print("\nDamage at slot level:")
+            lines.append("\nDamage at slot level:")
             numSlots = 0
             for slot in (spell['damage']['damage_at_slot_level']):
-                print("Slot level", 
-                        slot, 
-                        ":", 
-                        spell['damage']['damage_at_slot_level'][slot])
+                lines.append(f"Slot level {slot} : {spell['damage']['damage_at_slot_level'][slot]}{describeAverage(spell['damage']['damage_at_slot_level'][slot])}")
                 numSlots += 1
             if numSlots == 0:
-                print("No information for damage at slot levels.")
+                lines.append("No information for damage at slot levels.")
         if 'damage_at_character_level' in spell['damage']:
-            print("\nDamage at character level:")
+            lines.append("\nDamage at character level:")
             numLevels = 0
             for level in (spell['damage']['damage_at_character_level']):
-                print("Character level ", 
-                        level, 
-                        ":",
-                        spell['damage']['damage_at_character_level'][level])
+                lines.append(f"Character level  {level} : {spell['damage']['damage_at_character_level'][level]}{describeAverage(spell['damage']['damage_at_character_level'][level])}")
                 numLevels += 1
             if numLevels == 0:
-                print("No information for damage at character levels")
+                lines.append("No information for damage at character levels")
 
-    print("\nSchool of Magic: ", spell['school']['name'])
-    for spell_class in spell['classes']:
-        print("Class(es): ", spell_class['name'])
-    printLine()
+    lines.append(f"\nSchool of Magic:  {spell.get('school', {}).get('name', 'Unknown')}")
+    for spell_class in spell.get('classes', []):
+        lines.append(f"Class(es):  {spell_class['name']}")
+    lines.append(LINE)
+    return "\n".join(lines) + "\n"
 
 # Signal all microservices to quit
 # Can force terminate in powershell with taskkill /F /IM python.exe
 def exitMicroservices():
-    # send the exit input to all the microservices
-    generateSpell(None, 0, None, None)
-    accessBookmarkMods("", "", 0)
-    getSortOption(None, 0)
-    accessDiceRoller(0, None, None, None)
+    # send the exit input to all the microservices at once, waiting at most EXIT_TIMEOUT for each
+    runOnTransport(exitAllServices())
+    closeServiceSockets()
+
+# -------------------------------------------------------------------------------------------------------------
+
+# METRICS -----------------------------------------------------------------------------------------------------
+# Latency histograms, payload sizes and error counts for each kind of external call,
+# e.g. "http.spell", "service.bookmarks", "codec.encode" or "render.card"
+class Metrics:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.operations = {}
+        self.counters = {} # event -> times it happened, e.g. "api.coalesced"
+        self.lock = threading.Lock() # operations are recorded from prefetch threads and the transport loop too
+
+    # Time a block of code: with metrics.measure("operation") as measurement: ...
+    # An exception leaving the block counts as an error, as does setting measurement.error
+    def measure(self, operation):
+        return Measurement(self, operation)
+
+    def record(self, operation, seconds, error=False, bytesOut=0, bytesIn=0):
+        with self.lock:
+            stats = self.operations.get(operation)
+            if (stats is None):
+                stats = {"count": 0, "errors": 0, "seconds": 0.0, "max": 0.0, "bytes_out": 0, "bytes_in": 0, "buckets": [0] * (len(self.buckets) + 1)}
+                self.operations[operation] = stats
+            stats["count"] += 1
+            stats["seconds"] += seconds
+            stats["max"] = max(stats["max"], seconds)
+            stats["bytes_out"] += bytesOut
+            stats["bytes_in"] += bytesIn
+            if (error):
+                stats["errors"] += 1
+            # the last bucket holds everything slower than the largest bound
+            stats["buckets"][bisect.bisect_left(self.buckets, seconds)] += 1
+
+    # Count an event that has no duration of its own, e.g. a lookup answered by another lookup's request
+    def count(self, event, amount=1):
+        with self.lock:
+            self.counters[event] = self.counters.get(event, 0) + amount
+
+    # Estimate a latency percentile from the histogram (the upper bound of the bucket it falls in)
+    def percentile(self, stats, percent):
+        target = stats["count"] * percent / 100
+        seen = 0
+        for i, count in enumerate(stats["buckets"]):
+            seen += count
+            if (seen >= target and count > 0):
+                if (i < len(self.buckets)):
+                    return min(self.buckets[i], stats["max"])
+                break
+        return stats["max"]
+
+    # Return a copy of every operation's statistics, with summary figures added
+    def snapshot(self):
+        with self.lock:
+            operations = {operation: dict(stats, buckets=list(stats["buckets"])) for operation, stats in self.operations.items()}
+            counters = dict(self.counters)
+        for stats in operations.values():
+            stats["mean"] = stats["seconds"] / stats["count"]
+            stats["p50"] = self.percentile(stats, 50)
+            stats["p99"] = self.percentile(stats, 99)
+        return {"buckets": self.buckets, "operations": operations, "counters": counters}
+
+    # Format the statistics as a table, one operation per row (times in milliseconds), then the counted events
+    def report(self):
+        snapshot = self.snapshot()
+        operations = snapshot["operations"]
+        counters = snapshot["counters"]
+        if (not operations and not counters):
+            return "No operations recorded yet.\n"
+        lines = [f"{'Operation':<20}{'Calls':>7}{'Errors':>7}{'Mean':>10}{'p50':>10}{'p99':>10}{'Max':>10}{'Bytes out':>11}{'Bytes in':>11}"]
+        for operation in sorted(operations):
+            stats = operations[operation]
+            times = "".join(f"{stats[key] * 1e3:>10.2f}" for key in ("mean", "p50", "p99", "max"))
+            lines.append(f"{operation:<20}{stats['count']:>7}{stats['errors']:>7}{times}{stats['bytes_out']:>11}{stats['bytes_in']:>11}")
+        if (counters):
+            lines.append("")
+            lines.append(f"{'Event':<20}{'Count':>7}")
+            for event in sorted(counters):
+                lines.append(f"{event:<20}{counters[event]:>7}")
+        return "\n".join(lines) + "\n"
+
+    # Format the statistics in the Prometheus text exposition format
+    def toPrometheus(self):
+        snapshot = self.snapshot()
+        operations = snapshot["operations"]
+        lines = ["# HELP spellbook_operation_seconds Time taken by each kind of external call.",
+                 "# TYPE spellbook_operation_seconds histogram"]
+        for operation in sorted(operations):
+            stats = operations[operation]
+            label = 'operation="' + operation + '"'
+            cumulative = 0
+            for bound, count in zip(self.buckets + ["+Inf"], stats["buckets"]):
+                cumulative += count
+                lines.append(f'spellbook_operation_seconds_bucket{{{label},le="{bound}"}} {cumulative}')
+            lines.append(f"spellbook_operation_seconds_sum{{{label}}} {stats['seconds']}")
+            lines.append(f"spellbook_operation_seconds_count{{{label}}} {stats['count']}")
+        lines += ["# HELP spellbook_operation_errors_total Calls that failed or returned an error.",
+                  "# TYPE spellbook_operation_errors_total counter"]
+        for operation in sorted(operations):
+            lines.append(f'spellbook_operation_errors_total{{operation="{operation}"}} {operations[operation]["errors"]}')
+        lines += ["# HELP spellbook_operation_bytes_total Payload bytes sent and received.",
+                  "# TYPE spellbook_operation_bytes_total counter"]
+        for operation in sorted(operations):
+            for direction in ("out", "in"):
+                lines.append(f'spellbook_operation_bytes_total{{operation="{operation}",direction="{direction}"}} {operations[operation]["bytes_" + direction]}')
+        lines += ["# HELP spellbook_events_total Events without a duration, e.g. API requests shared by concurrent lookups.",
+                  "# TYPE spellbook_events_total counter"]
+        for event in sorted(snapshot["counters"]):
+            lines.append(f'spellbook_events_total{{event="{event}"}} {snapshot["counters"][event]}')
+        return "\n".join(lines) + "\n"
+
+    # Write a snapshot to a file: JSON if the name ends in .json, Prometheus text otherwise
+    def export(self, path):
+        with open(path, "w") as out:
+            if (path.endswith(".json")):
+                json.dump(self.snapshot(), out, indent=2)
+            else:
+                out.write(self.toPrometheus())
+
+# One timed run of an operation
+class Measurement:
+    def __init__(self, metrics, operation):
+        self.metrics = metrics
+        self.operation = operation
+        self.error = False
+        self.bytesOut = 0
+        self.bytesIn = 0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.metrics.record(self.operation, time.perf_counter() - self.start, self.error or excType is not None, self.bytesOut, self.bytesIn)
+        return False
+
+metrics = Metrics(METRICS_BUCKETS)
+
+# Show the metrics report (unlisted main menu option METRICS_MENU_OPTION)
+def showMetrics():
+    printLine()
+    print("TIMINGS (ms)")
+    sys.stdout.write(metrics.report())
+    printLine()
+
+# Report and export the metrics as requested on the command line, when the program closes
+def finishMetrics(out):
+    if (profileOnExit):
+        out.write("\nTIMINGS (ms)\n" + metrics.report())
+    if (metricsExportPath):
+        metrics.export(metricsExportPath)
+
+# -------------------------------------------------------------------------------------------------------------
+
+# SPELL MODEL -------------------------------------------------------------------------------------------------
+# A spell kept to just the fields in SPELL_FIELDS, with the API's nested objects (school, classes, damage type...)
+# flattened to their names. Names shared by many spells are interned, so every spell points at one copy.
+# Spells read like the API's dictionaries (spell['name'], spell.get('damage'), 'attack_type' in spell),
+# so code written for either works with both.
+class Spell:
+    __slots__ = tuple(SPELL_FIELDS)
+
+    def __init__(self, **fields):
+        for field in SPELL_FIELDS:
+            setattr(self, field, fields.get(field))
+
+    # Build a spell from an API (or microservice) dictionary; a Spell is returned as it is
+    @staticmethod
+    def fromApi(spell):
+        if (isinstance(spell, Spell)):
+            return spell
+        damage = spell.get('damage')
+        if (damage is not None):
+            damage = (internName(damage.get('damage_type')), toPairs(damage.get('damage_at_slot_level')), toPairs(damage.get('damage_at_character_level')))
+        area = spell.get('area_of_effect')
+        if (isinstance(area, dict)):
+            area = (internName(area.get('type')), area.get('size'))
+        savingThrow = spell.get('dc')
+        if (isinstance(savingThrow, dict)):
+            savingThrow = (internName(savingThrow.get('dc_type')), savingThrow.get('dc_success'))
+        return Spell(
+            index=spell.get('index'), name=spell.get('name'), level=spell.get('level'), url=spell.get('url'),
+            desc=toParagraphs(spell.get('desc')), higher_level=toParagraphs(spell.get('higher_level')),
+            range=spell.get('range'), components=tuple(internName(component) for component in spell.get('components') or []),
+            material=spell.get('material'), area_of_effect=area, ritual=spell.get('ritual'), duration=spell.get('duration'),
+            concentration=spell.get('concentration'), casting_time=spell.get('casting_time'), attack_type=spell.get('attack_type'),
+            damage=damage, school=internName(spell.get('school')), classes=tuple(sys.intern(name) for name in getSpellClasses(spell)),
+            subclasses=tuple(internName(subclass) for subclass in spell.get('subclasses') or []), dc=savingThrow
+        )
+
+    # Build a spell from the answers collected by getSpellFields, on top of base (a spell being edited) if given;
+    # fields left empty keep the base spell's value
+    # Raises ValueError for answers it can't use, or if the spell would have no name
+    @staticmethod
+    def fromFields(spellFields, base=None):
+        fields = {field: getattr(base, field) for field in SPELL_FIELDS} if base is not None else {}
+        answers = toFieldAnswers(spellFields)
+        if ('name' in answers):
+            fields['name'] = answers['name']
+            fields['index'] = toSpellIndex(answers['name'])
+        if ('level' in answers):
+            fields['level'] = int(answers['level']) if answers['level'].isdigit() else answers['level']
+        for key in ['range', 'casting_time', 'duration', 'attack_type']:
+            if (key in answers):
+                fields[key] = answers[key]
+        for key in ['desc', 'higher_level']:
+            if (key in answers):
+                fields[key] = tuple(paragraph.strip() for paragraph in answers[key].split("\n") if paragraph.strip())
+        for key in ['concentration', 'ritual']:
+            if (key in answers):
+                fields[key] = (answers[key].lower() == "yes")
+        if ('components' in answers):
+            fields['components'] = tuple(sys.intern(component.strip().upper()) for component in answers['components'].split(',') if component.strip())
+        if (answers.get('has_damage', "").lower() == "yes"):
+            damageValues = toPairs(json.loads(answers.get('damage_values', "{}")))
+            scaling = answers.get('scaling_type')
+            fields['damage'] = (internName(answers.get('damage_type')), damageValues if scaling == "slot" else None, damageValues if scaling == "character" else None)
+        elif (answers.get('has_damage', "").lower() == "no"):
+            fields['damage'] = None
+        if ('school' in answers):
+            fields['school'] = sys.intern(answers['school'])
+        if ('classes' in answers):
+            fields['classes'] = tuple(sys.intern(name.strip()) for name in answers['classes'].split(',') if name.strip())
+        for key in ['desc', 'higher_level', 'components', 'classes', 'subclasses']:
+            fields.setdefault(key, ())
+        fields.setdefault('concentration', False)
+        fields.setdefault('ritual', False)
+        if (not fields.get('name')):
+            raise ValueError("spell field 'name' is required; a spell is bookmarked and found by its name")
+        return Spell(**fields)
+
+    # Rebuild a spell saved with toRow
+    @staticmethod
+    def fromRow(row):
+        fields = dict(zip(SPELL_FIELDS, row))
+        for key in ['desc', 'higher_level', 'components', 'classes', 'subclasses']:
+            fields[key] = tuple(sys.intern(value) if key in ['components', 'classes', 'subclasses'] else value for value in fields[key] or [])
+        if (fields['damage'] is not None):
+            damageType, slotLevels, characterLevels = fields['damage']
+            fields['damage'] = (internName(damageType), toPairs(slotLevels), toPairs(characterLevels))
+        if (fields['area_of_effect'] is not None):
+            fields['area_of_effect'] = tuple(fields['area_of_effect'])
+        # rows saved before a field was added are shorter; the missing fields stay None
+        if (fields.get('dc') is not None):
+            fields['dc'] = (internName(fields['dc'][0]), fields['dc'][1])
+        if (fields['school'] is not None):
+            fields['school'] = sys.intern(fields['school'])
+        return Spell(**fields)
+
+    # Rebuild a spell from a saved bookmark body: a toRow list, or a whole API dictionary saved by older versions
+    @staticmethod
+    def fromStored(body):
+        if (isinstance(body, list)):
+            return Spell.fromRow(body)
+        return Spell.fromApi(body)
+
+    # The spell as a plain list of its SPELL_FIELDS values, for compact storage
+    def toRow(self):
+        return [getattr(self, field) for field in SPELL_FIELDS]
+
+    # The spell as an API-shaped dictionary (nested objects carry their index and name, but no urls)
+    def toDict(self):
+        spell = {}
+        for field in SPELL_FIELDS:
+            value = self.exportField(field)
+            if (value is not None):
+                spell[field] = value
+        return spell
+
+    # One field in the API's shape, or None if the spell doesn't have it
+    def exportField(self, field):
+        value = getattr(self, field)
+        if (value is None):
+            return None
+        if (field == 'school'):
+            return {"index": toSpellIndex(value), "name": value}
+        if (field in ['classes', 'subclasses']):
+            return [{"index": toSpellIndex(name), "name": name} for name in value]
+        if (field == 'damage'):
+            damageType, slotLevels, characterLevels = value
+            damage = {}
+            if (damageType is not None):
+                damage['damage_type'] = {"index": toSpellIndex(damageType), "name": damageType}
+            if (slotLevels is not None):
+                damage['damage_at_slot_level'] = dict(slotLevels)
+            if (characterLevels is not None):
+                damage['damage_at_character_level'] = dict(characterLevels)
+            return damage
+        if (field == 'area_of_effect'):
+            return {"type": value[0], "size": value[1]}
+        if (field == 'dc'):
+            return {"dc_type": {"index": toSpellIndex(value[0] or ""), "name": value[0]}, "dc_success": value[1]}
+        if (isinstance(value, tuple)):
+            return list(value)
+        return value
+
+    def __getitem__(self, field):
+        value = self.exportField(field) if field in SPELL_FIELDS else None
+        if (value is None):
+            raise KeyError(field)
+        return value
+
+    def get(self, field, default=None):
+        value = self.exportField(field) if field in SPELL_FIELDS else None
+        return default if value is None else value
+
+    def __contains__(self, field):
+        return field in SPELL_FIELDS and getattr(self, field) is not None
+
+# Check the fields of a custom spell or spell edit and turn them into the text answers getSpellFields collects:
+# whole numbers become text, true/false become yes/no, lists of text become one paragraph per line (descriptions)
+# or a comma separated list (components, classes), and damage values may be a JSON object. Empty values are left out.
+# Raises ValueError naming the first unknown field, or field whose value can't be used
+def toFieldAnswers(spellFields):
+    answers = {}
+    for key, value in spellFields.items():
+        if (key not in SPELL_FIELD_ANSWERS):
+            raise ValueError("'" + str(key) + "' is not a spell field; use one of: " + ", ".join(SPELL_FIELD_ANSWERS))
+        if (value is None):
+            continue
+        if (isinstance(value, bool)):
+            value = "yes" if value else "no"
+        elif (isinstance(value, int)):
+            value = str(value)
+        elif (key == 'damage_values' and isinstance(value, dict)):
+            value = json.dumps(value)
+        elif (key in ['desc', 'higher_level', 'components', 'classes'] and isinstance(value, list) and all(isinstance(item, str) for item in value)):
+            value = ("\n" if key in ['desc', 'higher_level'] else ", ").join(value)
+        elif (not isinstance(value, str)):
+            raise ValueError("spell field '" + key + "' can't be " + json.dumps(value) + "; give text" + (" or a list of text" if key in ['desc', 'higher_level', 'components', 'classes'] else ""))
+        if (key == 'damage_values' and value.strip() and not isDamageTable(value)):
+            raise ValueError("spell field 'damage_values' must be a JSON object of level -> damage, e.g. {\"3\": \"8d6\"}")
+        if (value.strip()):
+            answers[key] = value.strip()
+    return answers
+
+# Whether text is a JSON object of level -> damage expression, as damage_values must be
+def isDamageTable(text):
+    try:
+        table = json.loads(text)
+    except ValueError:
+        return False
+    return isinstance(table, dict) and all(isinstance(damage, str) for damage in table.values())
+
+# Interned name of an API object ({"index": ..., "name": ...}) or of a plain name
+def internName(value):
+    if (isinstance(value, dict)):
+        value = value.get('name')
+    if (isinstance(value, str)):
+        return sys.intern(value)
+    return value
+
+# Paragraphs of text as a tuple (custom spells may give a single string)
+def toParagraphs(value):
+    if (value is None):
+        return ()
+    if (isinstance(value, str)):
+        return (value,) if value else ()
+    return tuple(value)
+
+# A dictionary (or saved list of pairs) of level -> damage as a tuple of pairs, keeping its order
+def toPairs(value):
+    if (value is None):
+        return None
+    if (isinstance(value, dict)):
+        value = value.items()
+    return tuple((sys.intern(str(level)), damage) for level, damage in value)
+
+# Turn values JSON and MessagePack can't store directly into ones they can
+def encodeValue(value):
+    if (isinstance(value, Spell)):
+        return value.toDict()
+    return str(value)
+
+# -------------------------------------------------------------------------------------------------------------
+
+# SPELL CACHE -------------------------------------------------------------------------------------------------
+# Two-tier cache of spell lookups: a bounded in-memory LRU in front of an on-disk SQLite store.
+# Entries are (status code, spell) pairs so a 404 is remembered as well as a found spell.
+# Events: cache.hit and cache.miss (fresh entries found or not), cache.disk_hit (entries read back from disk),
+# cache.eviction (entries dropped from either tier to stay within its size)
+class SpellCache:
+    def __init__(self, path, memorySize, diskBytes, ttl, missTtl):
+        self.memory = OrderedDict() # index -> (fetched time, status, spell, ETag or None)
+        self.memorySize = memorySize
+        self.diskBytes = diskBytes
+        self.ttl = ttl
+        self.missTtl = missTtl
+        self.diskSize = 0
+        self.path = path
+        self.db = None
+        self.opened = False
+        self.lock = threading.Lock() # lookups may come from prefetch threads
+
+    # Open the on-disk store on first use
+    def openStore(self):
+        self.opened = True
+        try:
+            self.db = sqlite3.connect(self.path, check_same_thread=False)
+            self.db.execute("CREATE TABLE IF NOT EXISTS spells (spell_index TEXT PRIMARY KEY, fetched REAL, status INTEGER, body TEXT, size INTEGER, etag TEXT)")
+            if ('etag' not in [row[1] for row in self.db.execute("PRAGMA table_info(spells)")]):
+                # stores from before revalidation; their entries are simply downloaded again once stale
+                self.db.execute("ALTER TABLE spells ADD COLUMN etag TEXT")
+            self.diskSize = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM spells").fetchone()[0]
+        except sqlite3.Error:
+            # keep working as a memory-only cache if the store can't be opened
+            self.db = None
+
+    # Check whether an entry fetched at the given time is still fresh
+    def isFresh(self, fetched, status):
+        if (status == 200):
+            return time.time() - fetched < self.ttl
+        return time.time() - fetched < self.missTtl
+
+    # Return a cached (status, spell) pair for a spell index, or None on a miss
+    def get(self, index):
+        with self.lock:
+            entry = self.readEntry(index)
+            if (entry is None or not self.isFresh(entry[0], entry[1])):
+                metrics.count("cache.miss")
+                return None
+            self.remember(index, entry)
+            metrics.count("cache.hit")
+            return (entry[1], entry[2])
+
+    # Return the whole (fetched time, status, spell, ETag) entry for a spell index, fresh or stale,
+    # or None if there isn't one (without counting a hit or miss)
+    def getEntry(self, index):
+        with self.lock:
+            return self.readEntry(index)
+
+    def readEntry(self, index):
+        if (not self.opened):
+            self.openStore()
+        entry = self.memory.get(index)
+        if (entry is None and self.db is not None):
+            row = self.db.execute("SELECT fetched, status, body, etag FROM spells WHERE spell_index = ?", (index,)).fetchone()
+            if (row):
+                entry = (row[0], row[1], json.loads(row[2]) if row[2] else None, row[3])
+                metrics.count("cache.disk_hit")
+        return entry
+
+    # Mark a stale entry fresh again, after the API confirmed it hasn't changed
+    def refresh(self, index):
+        with self.lock:
+            entry = self.readEntry(index)
+            if (entry is None):
+                return
+            fetched = time.time()
+            self.remember(index, (fetched,) + entry[1:])
+            if (self.db is not None):
+                self.db.execute("UPDATE spells SET fetched = ? WHERE spell_index = ?", (fetched, index))
+                self.db.commit()
+
+    # Store a lookup result in both tiers, with the ETag the API sent for it (if any)
+    def put(self, index, status, spell, etag=None):
+        with self.lock:
+            if (not self.opened):
+                self.openStore()
+            entry = (time.time(), status, spell, etag)
+            self.remember(index, entry)
+            if (self.db is not None):
+                body = json.dumps(spell) if spell is not None else ""
+                oldSize = self.db.execute("SELECT size FROM spells WHERE spell_index = ?", (index,)).fetchone()
+                if (oldSize):
+                    self.diskSize -= oldSize[0]
+                self.db.execute("INSERT OR REPLACE INTO spells VALUES (?, ?, ?, ?, ?, ?)", (index, entry[0], status, body, len(body), etag))
+                self.diskSize += len(body)
+                if (self.diskSize > self.diskBytes):
+                    self.trimDisk()
+                self.db.commit()
+
+    # Move an entry to the front of the in-memory LRU, evicting the least recently used one if full
+    def remember(self, index, entry):
+        self.memory[index] = entry
+        self.memory.move_to_end(index)
+        while (len(self.memory) > self.memorySize):
+            self.memory.popitem(last=False)
+            metrics.count("cache.eviction")
+
+    # Delete the oldest on-disk entries until the store is back under three quarters of its size limit
+    def trimDisk(self):
+        target = self.diskBytes * 3 // 4
+        for index, size in self.db.execute("SELECT spell_index, size FROM spells ORDER BY fetched").fetchall():
+            if (self.diskSize <= target):
+                break
+            self.db.execute("DELETE FROM spells WHERE spell_index = ?", (index,))
+            self.diskSize -= size
+            metrics.count("cache.eviction")
+
+spellCache = SpellCache(CACHE_PATH, CACHE_MEMORY_SIZE, CACHE_DISK_BYTES, CACHE_TTL, CACHE_MISS_TTL)
+
+# Every request to the spell API goes through here. Requests for the same URL made at the same time
+# (by prefetch threads, a user's selection, or server clients) share one upstream call: the first caller
+# makes it and the others wait for its result ("single flight").
+# Events: api.upstream (requests sent), api.coalesced (callers that shared another's request),
+# api.revalidated (stale cached spells the API confirmed unchanged with a 304)
+class SpellApiClient:
+    def __init__(self):
+        self.inFlight = {} # key -> Future of the call being made for it
+        self.lock = threading.Lock()
+
+    # Run call() for a key, unless a call for the same key is already running, in which case
+    # wait for that one and return its result (or raise its exception)
+    def singleFlight(self, key, call):
+        with self.lock:
+            future = self.inFlight.get(key)
+            leader = future is None
+            if (leader):
+                future = Future()
+                self.inFlight[key] = future
+        if (not leader):
+            metrics.count("api.coalesced")
+            return future.result()
+        try:
+            result = call()
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.inFlight[key]
+
+    # Send one GET request upstream
+    def get(self, url, headers=None):
+        metrics.count("api.upstream")
+        return getHttpSession().get(url, headers=headers)
+
+spellApi = SpellApiClient()
+
+# Look up a spell by index, going to the API only on a cache miss
+# Returns a (status code, spell) pair; spell is None unless the status is 200
+def fetchSpell(index):
+    cached = spellCache.get(index)
+    if (cached is not None):
+        return cached
+    return spellApi.singleFlight(SPELL_API_URL + index, lambda: fetchSpellFromApi(index))
+
+# Fetch one spell into the cache; a stale cached copy is revalidated with its ETag (If-None-Match),
+# so if the spell hasn't changed the API answers "304 Not Modified" without sending it again
+def fetchSpellFromApi(index):
+    entry = spellCache.getEntry(index)
+    if (entry is not None and spellCache.isFresh(entry[0], entry[1])):
+        # a request that finished just before this one was started already fetched it
+        metrics.count("api.coalesced")
+        return (entry[1], entry[2])
+    headers = {}
+    if (entry is not None and entry[1] == 200 and entry[3]):
+        headers['If-None-Match'] = entry[3]
+    with metrics.measure("http.spell") as request:
+        response = spellApi.get(SPELL_API_URL + index, headers)
+        request.bytesIn = len(response.content)
+        request.error = (response.status_code not in (200, 304, 404))
+    if (response.status_code == 304 and headers):
+        metrics.count("api.revalidated")
+        spellCache.refresh(index)
+        return (200, entry[2])
+    if (response.status_code == 200):
+        spell = response.json()
+        spellCache.put(index, 200, spell, response.headers.get("ETag"))
+        return (200, spell)
+    if (response.status_code == 404):
+        # remember missing spells too, so typos don't cost a round trip twice
+        spellCache.put(index, 404, None)
+    return (response.status_code, None)
+
+# Return the shared HTTP session, whose connection pool is sized for the prefetch threads
+def getHttpSession():
+    global httpSession
+    if (httpSession is None):
+        httpSession = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=PREFETCH_WORKERS)
+        httpSession.mount("https://", adapter)
+        httpSession.mount("http://", adapter)
+    return httpSession
+
+# Start fetching spell details in the background
+# Returns a dictionary of spell index -> future resolving to fetchSpell's (status, spell) pair
+def prefetchSpells(indices):
+    global prefetchExecutor
+    if (prefetchExecutor is None):
+        prefetchExecutor = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS)
+    futures = {}
+    for index in indices:
+        if (index not in futures):
+            futures[index] = prefetchExecutor.submit(fetchSpell, index)
+    return futures
+
+# Cancel prefetches that haven't started yet (fetches already running finish into the cache)
+def cancelPrefetch(futures):
+    for future in futures.values():
+        future.cancel()
+
+# Stop the prefetch threads when the program closes
+def stopPrefetch():
+    global prefetchExecutor
+    if (prefetchExecutor is not None):
+        prefetchExecutor.shutdown(wait=False, cancel_futures=True)
+        prefetchExecutor = None
+
+# -------------------------------------------------------------------------------------------------------------
+
+# SPELL CATALOG -----------------------------------------------------------------------------------------------
+# Split text into lowercase word tokens for the keyword index
+def tokenize(text):
+    return re.findall(r"[a-z0-9]+", str(text).lower())
+
+# Gather the searchable text of a spell, field by field
+def getSearchableFields(spell):
+    fields = {
+        'name': [spell.get('name', "")],
+        'desc': spell.get('desc') or [],
+        'higher_level': spell.get('higher_level') or [],
+        'school': [spell['school']['name']] if spell.get('school') else [],
+        'classes': [spellClass['name'] for spellClass in spell.get('classes') or []],
+        'damage_type': []
+    }
+    damage = spell.get('damage') or {}
+    if (damage.get('damage_type')):
+        fields['damage_type'] = [damage['damage_type']['name']]
+    return fields
+
+# Local mirror of every spell in the API, with an inverted keyword index over it
+class SpellCatalog:
+    def __init__(self, path):
+        self.path = path
+        self.spells = {} # spell index -> spell
+        self.index = {} # token -> {spell index: weighted count}
+        self.vocabulary = [] # sorted tokens, for prefix matching
+        self.filterIndex = None # SpellFilter over the catalog, built on the first filter query
+        self.damageTable = None # DamageTable over the catalog, built on the first damage comparison
+        self.loaded = False
+        self.lock = threading.Lock() # the catalog may be loaded by the start-up warm-up
+
+    # Load the downloaded catalog from disk and build the keyword index
+    # (only marked loaded once complete, so other threads never see a half-built index)
+    def load(self):
+        with self.lock:
+            try:
+                db = sqlite3.connect(self.path)
+                db.execute("CREATE TABLE IF NOT EXISTS catalog (spell_index TEXT PRIMARY KEY, body TEXT)")
+                rows = db.execute("SELECT spell_index, body FROM catalog").fetchall()
+                db.close()
+            except sqlite3.Error:
+                rows = []
+            self.spells = {}
+            for index, body in rows:
+                self.spells[index] = json.loads(body)
+            self.buildIndex()
+            self.filterIndex = None
+            self.damageTable = None
+            self.loaded = True
+
+    # Build the token -> spells index, weighting each hit by the field it appears in
+    def buildIndex(self):
+        self.index = {}
+        for spellIndex, spell in self.spells.items():
+            for field, texts in getSearchableFields(spell).items():
+                weight = CATALOG_FIELD_WEIGHTS[field]
+                for text in texts:
+                    for token in tokenize(text):
+                        postings = self.index.setdefault(token, {})
+                        postings[spellIndex] = postings.get(spellIndex, 0) + weight
+        self.vocabulary = sorted(self.index)
+
+    # Check whether any spells have been downloaded
+    def isEmpty(self):
+        if (not self.loaded):
+            self.load()
+        return len(self.spells) == 0
+
+    # Return a downloaded spell by index, or None if it isn't in the catalog
+    def get(self, index):
+        if (not self.loaded):
+            self.load()
+        return self.spells.get(index)
+
+    # Return the indices of spells matching every word of the query, best matches first
+    # A query word also matches longer words that start with it ('fire' matches 'fireball')
+    def search(self, query):
+        if (not self.loaded):
+            self.load()
+        scores = None
+        for token in tokenize(query):
+            tokenScores = {}
+            position = bisect.bisect_left(self.vocabulary, token)
+            while (position < len(self.vocabulary) and self.vocabulary[position].startswith(token)):
+                term = self.vocabulary[position]
+                # exact word matches count double compared to prefix matches
+                boost = 2 if term == token else 1
+                for spellIndex, weight in self.index[term].items():
+                    tokenScores[spellIndex] = tokenScores.get(spellIndex, 0) + weight * boost
+                position += 1
+            if (scores is None):
+                scores = tokenScores
+            else:
+                scores = {spellIndex: scores[spellIndex] + tokenScores[spellIndex] for spellIndex in scores if spellIndex in tokenScores}
+        if (not scores):
+            return []
+        return sorted(scores, key=lambda spellIndex: (-scores[spellIndex], self.spells[spellIndex]['name']))
+
+    # Return (spell index, name) pairs of the downloaded spells matching filter criteria, sorted by name
+    def filter(self, criteria):
+        if (not self.loaded):
+            self.load()
+        if (self.filterIndex is None):
+            self.filterIndex = SpellFilter()
+            self.filterIndex.addAll(self.spells.items())
+        return self.filterIndex.query(criteria)
+
+    # Return the DamageTable over the catalog, building it on first use
+    def getDamageTable(self):
+        if (not self.loaded):
+            self.load()
+        if (self.damageTable is None):
+            self.damageTable = DamageTable(self.spells.items())
+        return self.damageTable
+
+    # Download every spell in the API into the local catalog and rebuild the index
+    def sync(self):
+        response = spellApi.get(SPELL_API_URL)
+        if (response.status_code != 200):
+            print("Error: Could not fetch the spell list with response code", response.status_code)
+            return False
+        results = response.json()['results']
+        db = sqlite3.connect(self.path)
+        db.execute("CREATE TABLE IF NOT EXISTS catalog (spell_index TEXT PRIMARY KEY, body TEXT)")
+        fetches = prefetchSpells([result['index'] for result in results])
+        try:
+            for i, result in enumerate(results, start=1):
+                status, spell = fetches[result['index']].result()
+                if (status == 200):
+                    db.execute("INSERT OR REPLACE INTO catalog VALUES (?, ?)", (result['index'], json.dumps(spell)))
+                if (i % 50 == 0 or i == len(results)):
+                    db.commit()
+                    print(f"Downloaded {i} of {len(results)} spells")
+        finally:
+            # keep whatever was downloaded, even if the connection dropped part way through
+            cancelPrefetch(fetches)
+            db.commit()
+            db.close()
+            self.load()
+        return True
+
+spellCatalog = SpellCatalog(CATALOG_PATH)
+
+# Option 7 implementation: download the full catalog for offline keyword search
+def downloadCatalog():
+    global spellNameIndex
+    print("\nDownloading the spell catalog. This only needs to be done once.")
+    try:
+        spellNameIndex = None # rebuild suggestions from the catalog next time
+        if (spellCatalog.sync()):
+            print(f"\nCatalog ready: {len(spellCatalog.spells)} spells available offline.")
+    except requests.exceptions.RequestException as e:
+        # handle network-related errors/exceptions
+        print("Error: ", e)
+        print("Spells downloaded so far were kept. Run this option again to finish the download.")
+
+# -------------------------------------------------------------------------------------------------------------
+
+# SPELL NAME INDEX --------------------------------------------------------------------------------------------
+# Trigram index over every spell's name and index, for "did you mean" suggestions on exact-name search.
+# A name is split into overlapping three-letter pieces ("  f", " fi", "fir", "ire", ...); a typo only
+# breaks the few pieces around it, so the names sharing the most pieces with the query are the closest.
+class SpellNameIndex:
+    def __init__(self, names):
+        self.indices = list(names) # spell index of each entry
+        self.names = [names[index] for index in self.indices] # display name of each entry
+        self.keys = [normalizeSpellName(name) for name in self.names]
+        self.grams = [getTrigrams(key) for key in self.keys]
+        self.postings = {} # trigram -> entries that contain it
+        for entry, grams in enumerate(self.grams):
+            for gram in grams:
+                self.postings.setdefault(gram, []).append(entry)
+        self.sortedKeys = sorted((key, entry) for entry, key in enumerate(self.keys)) # for prefix matching
+        self.known = set(self.indices)
+
+    def __contains__(self, index):
+        return index in self.known
+
+    def __len__(self):
+        return len(self.indices)
+
+    # Return up to limit (spell index, name) pairs that best match a mistyped or partial name:
+    # names starting with the query first, then by share of trigrams in common
+    def suggest(self, query, limit=SUGGESTION_LIMIT):
+        key = normalizeSpellName(query)
+        if (not key):
+            return []
+        queryGrams = getTrigrams(key)
+        shared = {}
+        for gram in queryGrams:
+            for entry in self.postings.get(gram, []):
+                shared[entry] = shared.get(entry, 0) + 1
+        scores = {}
+        for entry, count in shared.items():
+            # Dice coefficient: 1 for identical names, 0 for names with nothing in common
+            similarity = 2 * count / (len(queryGrams) + len(self.grams[entry]))
+            if (similarity >= SUGGESTION_MIN_SCORE):
+                scores[entry] = similarity
+        position = bisect.bisect_left(self.sortedKeys, (key,))
+        while (position < len(self.sortedKeys) and self.sortedKeys[position][0].startswith(key)):
+            entry = self.sortedKeys[position][1]
+            scores[entry] = scores.get(entry, 0) + 1
+            position += 1
+        best = sorted(scores, key=lambda entry: (-scores[entry], self.names[entry]))[:limit]
+        return [(self.indices[entry], self.names[entry]) for entry in best]
+
+# Lowercase a spell name, drop apostrophes and reduce other punctuation and dashes to single spaces
+# ("Tasha's Hideous-Laughter" -> "tashas hideous laughter")
+def normalizeSpellName(name):
+    return " ".join(re.findall(r"[a-z0-9]+", name.lower().replace("'", "")))
+
+# Set of the overlapping three-letter pieces of a normalized name, padded so the start of each word counts more
+def getTrigrams(key):
+    padded = "  " + key + " "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+# Return the name index, building it on first use from the downloaded catalog, or else from the
+# API's list of spells (fetched once and kept in the spell cache)
+# Returns None if neither is available, e.g. when offline without a catalog
+def getSpellNameIndex():
+    global spellNameIndex
+    if (spellNameIndex is None):
+        if (not spellCatalog.isEmpty()):
+            names = {index: spell['name'] for index, spell in spellCatalog.spells.items()}
+        else:
+            try:
+                status, spellList = fetchSpell(SPELL_LIST_INDEX)
+            except requests.exceptions.RequestException:
+                return None
+            if (status != 200):
+                return None
+            names = {result['index']: result['name'] for result in spellList['results']}
+        spellNameIndex = SpellNameIndex(names)
+    return spellNameIndex
+
+# -------------------------------------------------------------------------------------------------------------
+
+# SPELL FILTER ------------------------------------------------------------------------------------------------
+# Spells matching several criteria at once ("level 3, evocation, Wizard, no concentration, fire damage").
+# Every spell gets a bit position; every value of every attribute keeps a bitset (a Python int) with the
+# bits of the spells that have it. A query ORs the bitsets of the values asked for within an attribute and
+# ANDs the attributes together, so it costs a few big-integer operations rather than a scan of the spells.
+class SpellFilter:
+    def __init__(self):
+        self.keys = [] # bit position -> spell key, None for a free position
+        self.positions = {} # spell key -> bit position
+        self.values = {} # spell key -> its filter values, to clear its bits on removal
+        self.names = {} # spell key -> name, for ordering results
+        self.freePositions = []
+        self.bitsets = {attribute: {} for attribute in FILTER_ATTRIBUTES} # attribute -> value -> bitset
+        self.allSpells = 0 # bitset of every spell in the filter
+
+    def __len__(self):
+        return len(self.positions)
+
+    # Add a spell (or replace the one with the same key)
+    def add(self, key, spell):
+        if (key in self.positions):
+            self.remove(key)
+        position = self.freePositions.pop() if self.freePositions else len(self.keys)
+        if (position == len(self.keys)):
+            self.keys.append(key)
+        else:
+            self.keys[position] = key
+        bit = 1 << position
+        values = getFilterValues(spell)
+        for attribute, attributeValues in values.items():
+            bitsets = self.bitsets[attribute]
+            for value in attributeValues:
+                bitsets[value] = bitsets.get(value, 0) | bit
+        self.positions[key] = position
+        self.values[key] = values
+        self.names[key] = spell['name']
+        self.allSpells |= bit
+
+    # Add many (key, spell) pairs to an empty filter at once, setting each bitset in one go
+    # rather than growing it spell by spell
+    def addAll(self, spells):
+        positions = {attribute: {} for attribute in FILTER_ATTRIBUTES} # attribute -> value -> bit positions
+        for key, spell in spells:
+            position = len(self.keys)
+            self.keys.append(key)
+            values = getFilterValues(spell)
+            for attribute, attributeValues in values.items():
+                for value in attributeValues:
+                    positions[attribute].setdefault(value, []).append(position)
+            self.positions[key] = position
+            self.values[key] = values
+            self.names[key] = spell['name']
+        for attribute, valuePositions in positions.items():
+            for value, valueBits in valuePositions.items():
+                self.bitsets[attribute][value] = toBitset(valueBits, len(self.keys))
+        self.allSpells = (1 << len(self.keys)) - 1
+
+    # Remove a spell; its bit position is reused by the next spell added
+    def remove(self, key):
+        position = self.positions.pop(key, None)
+        if (position is None):
+            return
+        bit = 1 << position
+        for attribute, attributeValues in self.values.pop(key).items():
+            bitsets = self.bitsets[attribute]
+            for value in attributeValues:
+                bitsets[value] &= ~bit
+                if (not bitsets[value]):
+                    del bitsets[value]
+        del self.names[key]
+        self.keys[position] = None
+        self.freePositions.append(position)
+        self.allSpells &= ~bit
+
+    # Return (key, name) pairs of the spells matching criteria, sorted by name
+    # criteria maps an attribute to a list of values: the spell must have one of them, or for values
+    # starting with "!", none of them
+    def query(self, criteria):
+        matches = self.allSpells
+        for attribute, values in criteria.items():
+            bitsets = self.bitsets[attribute]
+            wanted = [value for value in values if not value.startswith("!")]
+            unwanted = [value[1:] for value in values if value.startswith("!")]
+            if (wanted):
+                anyWanted = 0
+                for value in wanted:
+                    anyWanted |= bitsets.get(value, 0)
+                matches &= anyWanted
+            for value in unwanted:
+                matches &= ~bitsets.get(value, 0)
+        # read the set bits from the binary digits, lowest first, in one pass over the bitset
+        bits = bin(matches)[:1:-1]
+        keys = []
+        position = bits.find("1")
+        while (position != -1):
+            keys.append(self.keys[position])
+            position = bits.find("1", position + 1)
+        return sorted(((key, self.names[key]) for key in keys), key=lambda match: (match[1].lower(), match[0]))
+
+# Bitset with the given bit positions set, built as bytes and converted once
+def toBitset(positions, size):
+    bits = bytearray((size + 7) // 8)
+    for position in positions:
+        bits[position >> 3] |= 1 << (position & 7)
+    return int.from_bytes(bits, "little")
+
+# Values a spell has for each FILTER_ATTRIBUTES attribute, lowercased
+def getFilterValues(spell):
+    damage = spell.get('damage') or {}
+    school = spell.get('school') or {}
+    damageType = damage.get('damage_type') or {}
+    return {
+        'level': [str(getSpellLevel(spell))],
+        'school': [str(school.get('name', "")).lower()] if isinstance(school, dict) else [str(school).lower()],
+        'class': [className.lower() for className in getSpellClasses(spell)],
+        'concentration': ["yes" if spell.get('concentration') else "no"],
+        'ritual': ["yes" if spell.get('ritual') else "no"],
+        'damage': [str(damageType.get('name', "")).lower()] if damageType else ["none"],
+        'components': [str(component).lower() for component in spell.get('components') or []]
+    }
+
+# Parse a filter query like "level=3 school=evocation class=wizard concentration=no damage=fire,cold"
+# into criteria for SpellFilter.query; "_" stands for a space inside a value ("class=blood_hunter")
+# Raises ValueError for anything that isn't attribute=value[,value...] with a known attribute
+def parseFilterQuery(text):
+    criteria = {}
+    for term in text.split():
+        attribute, separator, values = term.partition("=")
+        attribute = attribute.lower()
+        if (attribute in FILTER_ALIASES):
+            attribute = FILTER_ALIASES[attribute]
+        if (not separator or not values or attribute not in FILTER_ATTRIBUTES):
+            raise ValueError("'" + term + "' is not a filter; use attribute=value with one of: " + ", ".join(FILTER_ATTRIBUTES))
+        criteria.setdefault(attribute, []).extend(value.lower().replace("_", " ") for value in values.split(",") if value)
+    if (not criteria):
+        raise ValueError("enter at least one filter, e.g. level=3 class=wizard")
+    return criteria
+
+# Option 8 implementation: filter the catalog or the bookmarks by several criteria at once
+def filterSpellsMenu(bookmarks):
+    print("\nFILTER SPELLS")
+    print("2: Filter your bookmarks")
+    print("1: Filter the full spell catalog")
+    print("0: Return to main menu\n")
+    source = getIntegerInput("Select an option [0, 1, or 2]: ", 0, 2)
+    if (source == 0):
+        return
+    if (source == 1 and spellCatalog.isEmpty()):
+        print("The spell catalog hasn't been downloaded yet. Download it with option 7 first.")
+        return
+    print("\nEnter filters as attribute=value, separated by spaces, e.g.")
+    print("  level=3 school=evocation class=wizard concentration=no damage=fire")
+    print("Attributes: " + ", ".join(FILTER_ATTRIBUTES) + ". Separate alternatives with commas (level=1,2)")
+    print("and put ! before a value to exclude it (components=!m).")
+    try:
+        criteria = parseFilterQuery(input("Filters: "))
+    except ValueError as e:
+        print("Error:", e)
+        return
+    with metrics.measure("filter." + ("catalog" if source == 1 else "bookmarks")):
+        if (source == 1):
+            matches = spellCatalog.filter(criteria)
+            getSpell = spellCatalog.get
+        else:
+            matches = bookmarks.filter(criteria)
+            getSpell = bookmarks.getSpell
+    if (not matches):
+        print("\nNo spells match those filters.")
+        return
+    print(f"\n{len(matches)} matching spells:")
+    printNumberedMatches([name for key, name in matches])
+    showDetails = getIntegerInput("\nShow the matching spells' details [1 = yes, 0 = no]?: ", 0, 1)
+    if (showDetails == 1):
+        printSpells(getSpell(key) for key, name in matches)
+
+# -------------------------------------------------------------------------------------------------------------
+
+# DAMAGE ANALYTICS --------------------------------------------------------------------------------------------
+# Expected damage, spread and range of every damage-dealing spell at every spell slot (1-9) and character
+# level (1-20), kept as whole tables so a comparison ranks hundreds of spells in one go. Each different damage
+# expression ("8d6", "1d4 + MOD") is parsed once with the dice engine. At a level a spell doesn't list, its
+# damage is the one at the nearest listed level below (cantrips only list character levels 1, 5, 11 and 17).
+class DamageTable:
+    def __init__(self, spells):
+        self.keys = [] # row -> spell key
+        self.names = [] # row -> spell name
+        self.rows = {} # spell key -> row
+        self.expressions = [] # expression number -> damage expression as the spell gives it
+        self.statistics = [] # expression number -> (mean, variance, min, max)
+        self.invalid = 0 # different damage expressions the dice engine can't read, left out
+        self.levels = {} # "slot" or "character" -> spell rows x levels of expression numbers, -1 for no damage
+        numbers = {} # damage expression -> expression number, None if it can't be read
+        cells = {scaling: [] for scaling in DAMAGE_LEVELS} # scaling -> [(row, level, expression number)]
+        for key, spell in spells:
+            damage = spell.get('damage') or {}
+            spellCells = []
+            for scaling in DAMAGE_LEVELS:
+                for level, expression in (damage.get('damage_at_' + scaling + '_level') or {}).items():
+                    level = int(level) if str(level).isdigit() else 0
+                    if (not 1 <= level <= DAMAGE_LEVELS[scaling]):
+                        continue
+                    if (expression not in numbers):
+                        numbers[expression] = self.addExpression(expression)
+                    if (numbers[expression] is not None):
+                        spellCells.append((scaling, level, numbers[expression]))
+            if (spellCells):
+                row = len(self.keys)
+                self.rows[key] = row
+                self.keys.append(key)
+                self.names.append(spell['name'])
+                for scaling, level, number in spellCells:
+                    cells[scaling].append((row, level, number))
+        self.buildLevels(cells)
+
+    def __len__(self):
+        return len(self.keys)
+
+    # Parse a damage expression and work out its statistics, returning its number (None if it can't be read)
+    def addExpression(self, expression):
+        try:
+            statistics = getDamageStatistics(parseDamageExpression(expression))
+        except (ValueError, AttributeError):
+            self.invalid += 1
+            return None
+        self.expressions.append(str(expression))
+        self.statistics.append(statistics)
+        return len(self.statistics) - 1
+
+    # Fill the level tables from the listed (row, level, expression number) cells and carry each spell's
+    # damage up through the levels it doesn't list
+    def buildLevels(self, cells):
+        if (numpy is not None):
+            self.statistics = numpy.array(self.statistics, dtype=numpy.float64).reshape(-1, 4)
+            for scaling, highest in DAMAGE_LEVELS.items():
+                table = numpy.full((len(self.keys), highest + 1), -1, dtype=numpy.int64)
+                if (cells[scaling]):
+                    rows, levels, numbers = numpy.array(cells[scaling], dtype=numpy.int64).T
+                    table[rows, levels] = numbers
+                # column of the nearest listed level at or below each level (column 0 never lists damage)
+                listed = numpy.where(table >= 0, numpy.arange(highest + 1), 0)
+                numpy.maximum.accumulate(listed, axis=1, out=listed)
+                self.levels[scaling] = numpy.take_along_axis(table, listed, axis=1)
+            return
+        for scaling, highest in DAMAGE_LEVELS.items():
+            table = [[-1] * (highest + 1) for key in self.keys]
+            for row, level, number in cells[scaling]:
+                table[row][level] = number
+            for levels in table:
+                for level in range(2, highest + 1):
+                    if (levels[level] < 0):
+                        levels[level] = levels[level - 1]
+            self.levels[scaling] = table
+
+    # The spells with the highest expected damage at a spell slot ("slot") or character ("character") level,
+    # best first. keys limits the ranking to those spells (e.g. a filter query's matches); None ranks them all.
+    # Returns up to limit records of the spell's key, name, damage expression, mean, standard deviation, min and max
+    def rank(self, scaling, level, keys=None, limit=DAMAGE_RESULTS):
+        if (scaling not in DAMAGE_LEVELS or not 1 <= level <= DAMAGE_LEVELS[scaling]):
+            raise ValueError("damage is compared at spell slot levels 1 to " + str(DAMAGE_LEVELS['slot']) + " or character levels 1 to " + str(DAMAGE_LEVELS['character']))
+        if (numpy is not None):
+            numbers = self.levels[scaling][:, level]
+            included = numbers >= 0
+            if (keys is not None):
+                chosen = numpy.zeros(len(self.keys), dtype=bool)
+                chosen[numpy.fromiter((self.rows[key] for key in keys if key in self.rows), dtype=numpy.int64)] = True
+                included &= chosen
+            rows = numpy.flatnonzero(included)
+            order = numpy.argsort(-self.statistics[numbers[rows], 0], kind="stable")
+            ranked = [(row, numbers[row]) for row in rows[order[:limit]].tolist()]
+        else:
+            keys = None if keys is None else set(keys)
+            ranked = [(row, levels[level]) for row, levels in enumerate(self.levels[scaling]) if levels[level] >= 0 and (keys is None or self.keys[row] in keys)]
+            ranked.sort(key=lambda entry: -self.statistics[entry[1]][0])
+            ranked = ranked[:limit]
+        results = []
+        for row, number in ranked:
+            mean, variance, lowest, highest = (float(value) for value in self.statistics[number])
+            results.append({"index": self.keys[row], "name": self.names[row], "damage": self.expressions[number],
+                            "mean": mean, "stddev": math.sqrt(variance), "min": int(lowest), "max": int(highest)})
+        return results
+
+# Parse a spell's damage expression, putting DAMAGE_MODIFIER in place of "MOD"
+# Raises ValueError if it isn't a dice expression
+def parseDamageExpression(expression):
+    return parseDiceExpression(expression.upper().replace("MOD", str(DAMAGE_MODIFIER)))
+
+# Mean, variance, lowest and highest total of a parsed dice expression. The terms are independent, so each
+# adds its own; plain NdM dice have closed forms and only kept or dropped dice need their full odds
+def getDamageStatistics(terms):
+    mean = variance = lowest = highest = 0
+    for term in terms:
+        sign, count, sides, keep, keepHighest, constant = term
+        if (count == 0):
+            termMean, termVariance, termLowest, termHighest = sign * constant, 0, sign * constant, sign * constant
+        elif (keep == count):
+            termMean = sign * count * (sides + 1) / 2
+            termVariance = count * (sides * sides - 1) / 12
+            termLowest, termHighest = sorted([sign * count, sign * count * sides])
+        else:
+            distribution = getTermDistribution(term)
+            termMean = sum(total * chance for total, chance in distribution.items())
+            termVariance = sum(chance * (total - termMean) ** 2 for total, chance in distribution.items())
+            termLowest, termHighest = min(distribution), max(distribution)
+        mean += termMean
+        variance += termVariance
+        lowest += termLowest
+        highest += termHighest
+    return (mean, variance, lowest, highest)
+
+# " (average N)" for a damage expression shown with a spell, or "" if it can't be read
+def describeAverage(expression):
+    try:
+        mean = getDamageStatistics(parseDamageExpression(expression))[0]
+    except (ValueError, AttributeError):
+        return ""
+    return f" (average {mean:g})"
+
+# Rank the catalog's or the bookmarks' spells by expected damage at a level, optionally only those
+# matching filter criteria (see parseFilterQuery)
+def rankSpellDamage(spells, scaling, level, criteria=None, limit=DAMAGE_RESULTS):
+    keys = None if criteria is None else [key for key, name in spells.filter(criteria)]
+    return spells.getDamageTable().rank(scaling, level, keys, limit)
+
+# Option 9 implementation: compare the damage of catalog or bookmarked spells at a spell slot or character level
+def compareDamageMenu(bookmarks):
+    print("\nCOMPARE SPELL DAMAGE")
+    print("2: Compare your bookmarks")
+    print("1: Compare the full spell catalog")
+    print("0: Return to main menu\n")
+    source = getIntegerInput("Select an option [0, 1, or 2]: ", 0, 2)
+    if (source == 0):
+        return
+    if (source == 1 and spellCatalog.isEmpty()):
+        print("The spell catalog hasn't been downloaded yet. Download it with option 7 first.")
+        return
+    print("\n2: At a character level (cantrips)")
+    print("1: At a spell slot level\n")
+    scaling = "slot" if getIntegerInput("Select an option [1 or 2]: ", 1, 2) == 1 else "character"
+    label = "spell slot level" if scaling == "slot" else "character level"
+    level = getIntegerInput(f"Enter the {label} [1, ..., {DAMAGE_LEVELS[scaling]}]: ", 1, DAMAGE_LEVELS[scaling])
+    print("\nOptionally narrow the spells down with filters (see option 8), e.g. damage=fire class=sorcerer")
+    text = input("Filters (press enter to compare every spell): ").strip()
+    criteria = None
+    if (text):
+        try:
+            criteria = parseFilterQuery(text)
+        except ValueError as e:
+            print("Error:", e)
+            return
+    with metrics.measure("damage." + ("catalog" if source == 1 else "bookmarks")):
+        results = rankSpellDamage(spellCatalog if source == 1 else bookmarks, scaling, level, criteria)
+    if (not results):
+        print("\nNo matching spells deal damage at " + label + " " + str(level) + ".")
+        return
+    print(f"\nHighest expected damage at {label} {level}" + (f" ({DAMAGE_MODIFIER} for MOD)" if any("MOD" in result['damage'].upper() for result in results) else "") + ":")
+    print(f"{'':>4}{'Spell':<30}{'Damage':<14}{'Average':>9}{'Std dev':>9}   Range")
+    for number, result in enumerate(results, start=1):
+        print(f"{number:>2}. {result['name']:<30}{result['damage']:<14}{result['mean']:>9.1f}{result['stddev']:>9.1f}   {result['min']}-{result['max']}")
+
+# -------------------------------------------------------------------------------------------------------------
+
+# ENCOUNTER SIMULATOR -----------------------------------------------------------------------------------------
+# Casts a rotation of bookmarked spells at one target, over and over, and reports how the total damage is spread.
+# Attack spells roll d20 + the caster's attack bonus against the target's armor class (a 20 always hits and rolls
+# the damage dice twice, a 1 always misses); saving throw spells have the target roll d20 + its save bonus
+# against the caster's spell save DC, taking half or no damage on a success; other damage spells always hit.
+# Trials are rolled as arrays, a chunk at a time, and very long simulations are split across processes.
+
+# Turn a rotation like "fireball@5, fire bolt, magic missile@3" into casts for simulateTrials: each entry is a
+# bookmarked spell and the spell slot to cast it with (its own level if left out); cantrips use the character level.
+# Casts are (name, level, damage expression, dice terms, "attack", "save" or "hit", half damage on a save?)
+# Raises ValueError for spells that aren't bookmarked, deal no damage or can't be cast with that slot
+def planRotation(text, bookmarks, encounter):
+    casts = []
+    for entry in text.split(","):
+        name, separator, slot = entry.partition("@")
+        name = name.strip()
+        slot = slot.strip()
+        if (not name):
+            continue
+        if (separator and not slot.isdigit()):
+            raise ValueError("'" + entry.strip() + "' needs a spell slot level after @, e.g. fireball@5")
+        spellId = toSpellIndex(name)
+        if (bookmarks.find(spellId) is None):
+            raise ValueError("'" + name + "' is not in your bookmarks")
+        if (not bookmarks.isSaveKnown(spellId)):
+            bookmarks.recordSavingThrow(spellId, lookUpSavingThrow(bookmarks.getSpell(spellId)))
+        spell = bookmarks.getSpell(spellId)
+        spellLevel = getSpellLevel(spell)
+        damage = spell.get('damage') or {}
+        if (spellLevel > 0 and damage.get('damage_at_slot_level')):
+            level = int(slot) if slot else spellLevel
+            if (not spellLevel <= level <= DAMAGE_LEVELS['slot']):
+                raise ValueError(f"{spell['name']} is cast with a spell slot of level {spellLevel} to {DAMAGE_LEVELS['slot']}")
+            expression = getListedDamage(damage['damage_at_slot_level'], level)
+        else:
+            level = encounter['level']
+            expression = getListedDamage(damage.get('damage_at_character_level') or {}, level)
+        if (expression is None):
+            raise ValueError(spell['name'] + " doesn't deal damage at that level")
+        savingThrow = spell.get('dc')
+        resolution = "attack" if spell.get('attack_type') else "save" if savingThrow else "hit"
+        halfOnSave = savingThrow is not None and savingThrow.get('dc_success') == "half"
+        casts.append((spell['name'], level, expression, parseDamageExpression(expression), resolution, halfOnSave))
+    if (not casts):
+        raise ValueError("enter at least one bookmarked spell, e.g. fireball@5, fire bolt")
+    return casts
+
+# Saving throw of an API spell bookmarked before spells kept their save DC, from the API's copy of it; such
+# spells would otherwise be simulated as always hitting
+# Returns None if the spell has no saving throw; raises ValueError if the API can't be asked
+def lookUpSavingThrow(spell):
+    missing = spell['name'] + "'s saving throw isn't in your bookmarks"
+    try:
+        status, apiSpell = fetchSpell(spell['index'])
+    except requests.exceptions.RequestException:
+        raise ValueError(missing + " and the spell API can't be reached to look it up")
+    if (status != 200):
+        raise ValueError(missing + " and the spell API doesn't have it (status " + str(status) + ")")
+    return apiSpell.get('dc')
+
+# Damage a spell lists for a level, or for the nearest listed level below it; None if it lists none that low
+def getListedDamage(levels, level):
+    listed = {int(key): expression for key, expression in levels.items() if str(key).isdigit() and int(key) <= level}
+    return listed[max(listed)] if listed else None
+
+# Run trials of a rotation with NumPy, rolling every trial of a cast at once (with a generator from seed, so
+# each process of a split simulation rolls different dice); the trials are rolled ENCOUNTER_CHUNK_TRIALS at a
+# time, so long simulations don't hold every trial's dice in memory
+# Returns the number of trials ending on each total damage, and each cast's summed damage and hits (failed saves)
+def simulateTrials(casts, encounter, trials, seed=None):
+    generator = numpy.random.default_rng(seed)
+    counts = {}
+    castDamage = [0] * len(casts)
+    castHits = [0] * len(casts)
+    for start in range(0, trials, ENCOUNTER_CHUNK_TRIALS):
+        chunk = min(ENCOUNTER_CHUNK_TRIALS, trials - start)
+        totals = numpy.zeros(chunk, dtype=numpy.int64)
+        for number, (name, level, expression, terms, resolution, halfOnSave) in enumerate(casts):
+            damage = numpy.zeros(chunk, dtype=numpy.int64)
+            for term in terms:
+                damage += rollTermNumpy(term, chunk, generator)
+            if (resolution == "attack"):
+                attack = generator.integers(1, 21, size=chunk)
+                critical = attack == 20
+                hit = critical | ((attack > 1) & (attack + encounter['attack'] >= encounter['ac']))
+                for term in terms:
+                    if (term[1] > 0):
+                        damage[critical] += rollTermNumpy(term, int(critical.sum()), generator)
+                damage[~hit] = 0
+            elif (resolution == "save"):
+                hit = generator.integers(1, 21, size=chunk) + encounter['save'] < encounter['dc']
+                damage = numpy.where(hit, damage, damage // 2 if halfOnSave else 0)
+            else:
+                hit = numpy.ones(chunk, dtype=bool)
+            numpy.maximum(damage, 0, out=damage)
+            totals += damage
+            castDamage[number] += int(damage.sum())
+            castHits[number] += int(hit.sum())
+        values, chunkCounts = numpy.unique(totals, return_counts=True)
+        for total, count in zip(values.tolist(), chunkCounts.tolist()):
+            counts[total] = counts.get(total, 0) + count
+    return counts, castDamage, castHits
+
+# Run trials of a rotation without NumPy, one trial at a time and ENCOUNTER_CHUNK_TRIALS trials' rolls at a time;
+# returns the same as simulateTrials
+def simulateTrialsPython(casts, encounter, trials):
+    counts = {}
+    castDamage = [0] * len(casts)
+    castHits = [0] * len(casts)
+    for start in range(0, trials, ENCOUNTER_CHUNK_TRIALS):
+        chunk = min(ENCOUNTER_CHUNK_TRIALS, trials - start)
+        totals = [0] * chunk
+        for number, (name, level, expression, terms, resolution, halfOnSave) in enumerate(casts):
+            rolls = [sum(termRolls) for termRolls in zip(*(rollTerm(term, chunk) for term in terms))]
+            for trial in range(chunk):
+                damage = rolls[trial]
+                if (resolution == "attack"):
+                    attack = random.randint(1, 20)
+                    hit = attack == 20 or (attack > 1 and attack + encounter['attack'] >= encounter['ac'])
+                    if (attack == 20):
+                        damage += sum(rollTerm(term, 1)[0] for term in terms if term[1] > 0)
+                elif (resolution == "save"):
+                    hit = random.randint(1, 20) + encounter['save'] < encounter['dc']
+                else:
+                    hit = True
+                if (not hit):
+                    damage = damage // 2 if halfOnSave and resolution == "save" else 0
+                damage = max(damage, 0)
+                totals[trial] += damage
+                castDamage[number] += damage
+                castHits[number] += hit
+        for total in totals:
+            counts[total] = counts.get(total, 0) + 1
+    return counts, castDamage, castHits
+
+# Simulate a rotation trials times, splitting simulations of ENCOUNTER_PARALLEL_TRIALS or more across processes
+# Returns the summary of the total damage (see summarizeDistribution) with the trial count and each cast's
+# average damage and hit rate
+def simulateEncounter(casts, encounter, trials):
+    workers = os.cpu_count() or 1
+    simulate = simulateTrials if numpy is not None else simulateTrialsPython
+    if (trials >= ENCOUNTER_PARALLEL_TRIALS and workers > 1):
+        chunks = [trials // workers + (1 if i < trials % workers else 0) for i in range(workers)]
+        # NumPy workers get a seed each; the random module already seeds itself afresh in each spawned process
+        seeds = [numpy.random.SeedSequence().spawn(workers)] if numpy is not None else []
+        # spawned rather than forked, so the workers don't inherit the transport and warm-up threads' state
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+            parts = list(pool.map(simulate, [casts] * workers, [encounter] * workers, chunks, *seeds))
+    else:
+        parts = [simulate(casts, encounter, trials)]
+    counts = {}
+    castDamage = [0] * len(casts)
+    castHits = [0] * len(casts)
+    for partCounts, partDamage, partHits in parts:
+        for total, count in partCounts.items():
+            counts[total] = counts.get(total, 0) + count
+        castDamage = [damage + more for damage, more in zip(castDamage, partDamage)]
+        castHits = [hits + more for hits, more in zip(castHits, partHits)]
+    summary = summarizeDistribution({total: count / trials for total, count in counts.items()})
+    summary['trials'] = trials
+    summary['casts'] = [{"name": cast[0], "level": cast[1], "damage": cast[2], "resolution": cast[4], "mean": damage / trials, "hit_rate": hits / trials}
+                        for cast, damage, hits in zip(casts, castDamage, castHits)]
+    return summary
+
+# Option 10 implementation: simulate rotations of bookmarked spells against one target and compare them
+def encounterMenu(bookmarks):
+    print("\nENCOUNTER SIMULATOR")
+    print("Cast a rotation of your bookmarked spells at one target many times over, and see how much damage it deals.\n")
+    encounter = {}
+    encounter['ac'] = getIntegerInput("Target's armor class [1, ..., 30]: ", 1, 30)
+    encounter['save'] = getIntegerInput("Target's saving throw bonus [-5, ..., 20]: ", -5, 20)
+    encounter['attack'] = getIntegerInput("Your spell attack bonus [-5, ..., 20]: ", -5, 20)
+    encounter['dc'] = getIntegerInput("Your spell save DC [1, ..., 30]: ", 1, 30)
+    encounter['level'] = getIntegerInput("Your character level, for cantrip damage [1, ..., 20]: ", 1, 20)
+    trials = getIntegerInput(f"Number of trials [1, ..., {ENCOUNTER_MAX_TRIALS}] (e.g. {ENCOUNTER_DEFAULTS['trials']}): ", 1, ENCOUNTER_MAX_TRIALS)
+    loadouts = []
+    while True:
+        print("\nEnter spells to cast in order, with the spell slot after @, e.g. fireball@5, fire bolt, magic missile@3")
+        text = input("Rotation (press enter to return to main menu): ").strip()
+        if (not text):
+            return
+        try:
+            casts = planRotation(text, bookmarks, encounter)
+        except ValueError as e:
+            print("Error:", e)
+            continue
+        with metrics.measure("encounter.simulate"):
+            summary = simulateEncounter(casts, encounter, trials)
+        printEncounter(summary)
+        loadouts.append((text, summary))
+        if (len(loadouts) > 1):
+            print("\nLoadouts simulated so far:")
+            print(f"{'':>4}{'Rotation':<44}{'Average':>9}" + "".join(f"{str(percentile) + 'th':>7}" for percentile in DICE_PERCENTILES))
+            for number, (rotation, result) in enumerate(loadouts, start=1):
+                print(f"{number:>2}. {rotation[:43]:<44}{result['mean']:>9.1f}" + "".join(f"{total:>7}" for total in result['percentiles'].values()))
+
+# Print the result of an encounter simulation
+def printEncounter(summary):
+    printLine()
+    print(f"Simulated {summary['trials']} times\n")
+    outcomes = {"attack": "hits", "save": "fails its save"}
+    for cast in summary['casts']:
+        outcome = f"{outcomes[cast['resolution']]} {cast['hit_rate'] * 100:.1f}% of the time" if cast['resolution'] in outcomes else "always hits"
+        print(f"{cast['name']} at level {cast['level']} ({cast['damage']}): average {cast['mean']:.1f}, {outcome}")
+    print(f"\nTotal damage  Average: {summary['mean']:.2f}  Standard deviation: {summary['stddev']:.2f}")
+    print(f"Lowest: {summary['min']}  Highest: {summary['max']}")
+    print("\nPercentiles:")
+    for percentile, total in summary['percentiles'].items():
+        print(f"{percentile}th percentile: {total}")
+    print("\nChance of each total:")
+    printDistributionChart(summary['distribution'])
+    printLine()
+
+# Print a bar for the chance of each total, grouping totals into ranges when there are more than ENCOUNTER_CHART_ROWS
+def printDistributionChart(distribution):
+    lowest = min(distribution)
+    highest = max(distribution)
+    width = math.ceil((highest - lowest + 1) / ENCOUNTER_CHART_ROWS)
+    rows = {start: 0.0 for start in range(lowest, highest + 1, width)}
+    for total, chance in distribution.items():
+        rows[lowest + (total - lowest) // width * width] += chance
+    mostLikely = max(rows.values())
+    for start, chance in rows.items():
+        end = min(start + width - 1, highest)
+        label = str(start) if end == start else str(start) + "-" + str(end)
+        print(f"{label:>9}  {chance * 100:6.2f}%  " + "#" * round(chance / mostLikely * 40))
+
+# -------------------------------------------------------------------------------------------------------------
+
+# MICROSERVICE CLIENT -----------------------------------------------------------------------------------------
+# Raised when a microservice doesn't reply within SERVICE_TIMEOUT on any attempt, or did not within the last
+# SERVICE_DOWN_COOLDOWN seconds
+class ServiceUnavailableError(Exception):
+    def __init__(self, service):
+        super().__init__("the " + service + " microservice (" + getServiceEndpoint(service) + ") did not respond")
+        self.service = service
+
+# Return the event loop that runs all microservice traffic, starting it in a background thread on first use
+def getTransportLoop():
+    global transportLoop
+    if (transportLoop is None):
+        with transportLock:
+            if (transportLoop is None):
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, daemon=True).start()
+                transportLoop = loop
+    return transportLoop
+
+# Run a coroutine on the transport loop and wait for its result
+def runOnTransport(coroutine):
+    return asyncio.run_coroutine_threadsafe(coroutine, getTransportLoop()).result()
+
+# ZMQ endpoint a microservice is reached at
+def getServiceEndpoint(service):
+    if (service in SERVICE_ENDPOINTS):
+        return SERVICE_ENDPOINTS[service]
+    if (SERVICE_TRANSPORT == "inproc"):
+        return "inproc://spellbook-" + service
+    if (SERVICE_TRANSPORT == "ipc"):
+        return "ipc://" + IPC_DIRECTORY + "/spellbook-" + service + ".ipc"
+    return "tcp://" + SERVICE_HOST + ":" + str(SERVICE_PORTS[service])
+
+# Return the long-lived socket for a microservice, connecting it on first use
+# (only called from the transport loop)
+def getServiceSocket(service):
+    global zmqContext
+    if (zmqContext is None):
+        zmqContext = zmq.asyncio.Context()
+    if (service not in serviceSockets):
+        endpoint = getServiceEndpoint(service)
+        if (endpoint.startswith("inproc://") and service not in embeddedThreads):
+            startEmbeddedService(service, endpoint)
+        socket = zmqContext.socket(zmq.REQ)
+        socket.setsockopt(zmq.LINGER, 0) # don't block shutdown on unsent messages
+        socket.connect(endpoint)
+        serviceSockets[service] = socket
+    return serviceSockets[service]
+
+# Throw away a microservice's socket; a REQ socket still waiting on a reply can't send again
+def resetServiceSocket(service):
+    socket = serviceSockets.pop(service, None)
+    if (socket is not None):
+        socket.close()
+
+# Close every microservice socket, the shared context and the transport loop
+def closeServiceSockets():
+    global zmqContext, transportLoop
+    if (transportLoop is None):
+        return
+    runOnTransport(closeSocketsOnLoop())
+    with transportLock:
+        transportLoop.call_soon_threadsafe(transportLoop.stop)
+        transportLoop = None
+    if (zmqContext is not None):
+        zmqContext.term()
+        zmqContext = None
+
+# Close the sockets from the loop that uses them
+async def closeSocketsOnLoop():
+    for service in list(serviceSockets):
+        resetServiceSocket(service)
+    serviceLocks.clear()
+    serviceDownUntil.clear()
+
+# Send raw bytes to a microservice and wait for the reply, "Lazy Pirate" style: if no reply comes
+# within the timeout, the socket is replaced and the request sent again, up to retries more times.
+# A service that gave no reply to any attempt is skipped for SERVICE_DOWN_COOLDOWN seconds, so every
+# request in the meantime fails at once instead of waiting out the same timeouts again
+async def exchange(service, message, timeout, retries):
+    if (service not in serviceLocks):
+        serviceLocks[service] = asyncio.Lock()
+    async with serviceLocks[service]:
+        if (time.monotonic() < serviceDownUntil.get(service, 0)):
+            metrics.count("service.skipped")
+            raise ServiceUnavailableError(service)
+        for attempt in range(retries + 1):
+            socket = getServiceSocket(service)
+            await socket.send(message)
+            try:
+                if (hasattr(asyncio, "timeout")):
+                    # Python 3.11+: a deadline on the current task, cheaper than wait_for's extra task
+                    async with asyncio.timeout(timeout):
+                        return await socket.recv()
+                return await asyncio.wait_for(socket.recv(), timeout)
+            except asyncio.TimeoutError:
+                resetServiceSocket(service)
+        serviceDownUntil[service] = time.monotonic() + SERVICE_DOWN_COOLDOWN
+        raise ServiceUnavailableError(service)
+
+# Tell every microservice to exit at the same time; services that are down are skipped after EXIT_TIMEOUT
+async def exitAllServices():
+    exits = [exchange(service, encodeMessage(message, serviceCodecs.get(service)), EXIT_TIMEOUT, 0) for service, message in SERVICE_EXIT_MESSAGES.items()]
+    await asyncio.gather(*exits, return_exceptions=True)
+
+# Check which microservices are accepting connections, all at once
+# Returns a dictionary of service -> True if it is reachable
+def checkMicroservices():
+    return runOnTransport(checkAllServices())
+
+async def checkAllServices():
+    services = list(SERVICE_PORTS)
+    results = await asyncio.gather(*[isServiceReachable(service) for service in services])
+    return dict(zip(services, results))
+
+# Open (and immediately close) a plain TCP connection to a microservice's port; this sends the
+# service no request, so it can't trigger any of its actions
+async def isServiceReachable(service):
+    scheme, address = getServiceEndpoint(service).split("://", 1)
+    try:
+        if (scheme == "tcp"):
+            host, port = address.rsplit(":", 1)
+            connection = asyncio.open_connection(host, int(port))
+        elif (scheme == "ipc"):
+            connection = asyncio.open_unix_connection(address)
+        else:
+            return True # built-in services start on first use
+        reader, writer = await asyncio.wait_for(connection, HEALTH_CHECK_TIMEOUT)
+        writer.close()
+        return True
+    except (OSError, ValueError, asyncio.TimeoutError):
+        return False
+
+# Warn about microservices that aren't running when the program starts
+def warnUnavailableServices():
+    down = [service + " (" + getServiceEndpoint(service) + ")" for service, up in checkMicroservices().items() if not up]
+    if (down):
+        print("\nNote: these microservices are not running:", ", ".join(down))
+        print("Features that need them will report an error instead of waiting.")
+
+# Body formats this client can read and write in binary frames, best first
+def getSupportedCodecs():
+    if (msgpack is not None):
+        return ['msgpack', 'json']
+    return ['json']
+
+# Encode a message for a microservice
+# codec None is the original plain UTF-8 JSON; 'msgpack' or 'json' produce a binary frame:
+# CODEC_MAGIC, one flags byte, then the body (compressed when it is large)
+def encodeMessage(message, codec):
+    with metrics.measure("codec.encode") as measurement:
+        encoded = encodeBody(message, codec)
+        measurement.bytesOut = len(encoded)
+    return encoded
+
+def encodeBody(message, codec):
+    if (codec is None):
+        return json.dumps(message, default=encodeValue).encode('utf-8')
+    if (codec == 'msgpack' and msgpack is not None):
+        flags = CODEC_MSGPACK
+        body = msgpack.packb(message, default=encodeValue)
+    else:
+        flags = 0
+        body = json.dumps(message, default=encodeValue, separators=(',', ':')).encode('utf-8')
+    if (len(body) > COMPRESS_THRESHOLD):
+        flags |= CODEC_ZLIB
+        body = zlib.compress(body, 1)
+    return CODEC_MAGIC + bytes([flags]) + body
+
+# Decode a message from a microservice, in either the binary frame or plain JSON
+# Raises ValueError if the message can't be decoded
+def decodeMessage(message):
+    with metrics.measure("codec.decode") as measurement:
+        measurement.bytesIn = len(message)
+        return decodeBody(message)
+
+def decodeBody(message):
+    if (not message.startswith(CODEC_MAGIC)):
+        return json.loads(message.decode('utf-8'))
+    if (len(message) == len(CODEC_MAGIC)):
+        raise ValueError("binary message has no flags byte")
+    flags = message[len(CODEC_MAGIC)]
+    body = message[len(CODEC_MAGIC) + 1:]
+    try:
+        if (flags & CODEC_ZLIB):
+            body = zlib.decompress(body)
+        if (flags & CODEC_MSGPACK):
+            if (msgpack is None):
+                raise ValueError("MessagePack reply received but msgpack is not installed")
+            return msgpack.unpackb(body)
+        return json.loads(body)
+    except zlib.error as e:
+        raise ValueError(e)
+
+# Send a request to a microservice and return its raw reply
+# Raises ServiceUnavailableError if the service doesn't reply after SERVICE_RETRIES retries
+# Until a service has answered in the binary format, requests go out as plain JSON that lists the
+# binary body formats we accept; once it has, the same body format is used for every later request.
+def serviceRequest(service, request):
+    return runOnTransport(serviceRequestAsync(service, request))
+
+async def serviceRequestAsync(service, request):
+    codec = serviceCodecs.get(service)
+    if (codec is None):
+        request = request.copy()
+        request['accept_codecs'] = getSupportedCodecs()
+    message = encodeMessage(request, codec)
+    timeout = SERVICE_TIMEOUT + len(message) / 2**20 * SERVICE_TIMEOUT_PER_MB
+    with metrics.measure("service." + service) as measurement:
+        measurement.bytesOut = len(message)
+        reply = await exchange(service, message, timeout, SERVICE_RETRIES)
+        measurement.bytesIn = len(reply)
+    if (reply.startswith(CODEC_MAGIC) and len(reply) > len(CODEC_MAGIC)):
+        if (reply[len(CODEC_MAGIC)] & CODEC_MSGPACK):
+            serviceCodecs[service] = 'msgpack'
+        else:
+            serviceCodecs[service] = 'json'
+    return reply
+
+# -------------------------------------------------------------------------------------------------------------
+
+# EMBEDDED MICROSERVICES --------------------------------------------------------------------------------------
+# In-process versions of the four microservices, used when SERVICE_TRANSPORT is "inproc". Each answers
+# on an inproc:// socket from its own thread, speaking the same protocol as the real service.
+class EmbeddedServices:
+    def __init__(self):
+        self.codecs = {} # service -> body format negotiated with the client
+        self.bookmarkIds = set() # microservice B only tracks which spells are bookmarked; the spells are stored locally
+        self.bookmarkVersion = 0
+
+    # Answer one raw request for a service
+    # Returns (raw reply, True if the service was told to exit)
+    def handle(self, service, message):
+        request = decodeMessage(message)
+        if (request.get('accept_codecs')):
+            self.codecs[service] = next((codec for codec in request['accept_codecs'] if codec in getSupportedCodecs()), 'json')
+        if (service == "sort"):
+            reply = self.handleSort(request)
+        elif (service == "bookmarks"):
+            reply = self.handleBookmarks(request)
+        elif (service == "spells"):
+            reply = self.handleSpells(request)
+        else:
+            reply = self.handleDice(request)
+        if (reply is None):
+            return (b"", True)
+        if (isinstance(reply, int) and self.codecs.get(service) is None):
+            # the original dice reply: the result as a big-endian integer
+            return (reply.to_bytes(4, byteorder='big', signed=True), False)
+        return (encodeMessage(reply, self.codecs.get(service)), False)
+
+    # Microservice A: bookmarks are sorted locally now, so it only has to acknowledge the exit message
+    def handleSort(self, request):
+        if (request.get('end_program')):
+            return None
+        return {}
+
+    # Microservice B: keep the bookmark version in step with the client, asking for a resync on a mismatch
+    def handleBookmarks(self, request):
+        option = request.get('option')
+        if (option == 0):
+            return None
+        if (option == 4):
+            if (not request.get('append')):
+                self.bookmarkIds = set()
+            self.bookmarkIds.update(getSpellId(spell) for spell in request['json_array'])
+        elif (request.get('version') != self.bookmarkVersion):
+            return {"version": self.bookmarkVersion, "resync": True}
+        elif (option == 2):
+            self.bookmarkIds.discard(request['spell_id'])
+        else:
+            self.bookmarkIds.discard(request['spell_id'])
+            self.bookmarkIds.add(getSpellId(request['json_object']))
+        self.bookmarkVersion += 1
+        return {"version": self.bookmarkVersion}
+
+    # Microservice C: build a spell (or an edited copy of json_object) from the collected fields
+    def handleSpells(self, request):
+        if (request.get('option') == 0):
+            return None
+        base = Spell.fromApi(request['json_object']) if request.get('json_object') else None
+        try:
+            return {"record": Spell.fromFields(request.get('spell_fields') or {}, base)}
+        except (ValueError, TypeError):
+            return {} # fields it can't build a spell from: no record
+
+    # Microservice D: roll one dice with n faces, adding or subtracting m for option 2
+    def handleDice(self, request):
+        option = request.get('option')
+        if (option == 0):
+            return None
+        roll = random.randint(1, request['n'])
+        if (option == 2):
+            roll = roll + request['m'] if request['operation'] == "+" else roll - request['m']
+        return roll
+
+# Bind an embedded service's socket and answer its requests from a background thread
+# (only called from the transport loop, which owns the shared context inproc:// sockets need)
+def startEmbeddedService(service, endpoint):
+    global embeddedServices
+    if (embeddedServices is None):
+        embeddedServices = EmbeddedServices()
+    socket = zmq.Context.shadow(zmqContext.underlying).socket(zmq.REP)
+    socket.setsockopt(zmq.LINGER, 0)
+    socket.bind(endpoint)
+    embeddedThreads[service] = threading.Thread(target=serveEmbedded, args=(service, socket), daemon=True)
+    embeddedThreads[service].start()
+
+def serveEmbedded(service, socket):
+    try:
+        stop = False
+        while (not stop):
+            reply, stop = embeddedServices.handle(service, socket.recv())
+            socket.send(reply)
+    except zmq.ContextTerminated:
+        pass # the program is closing
+    finally:
+        socket.close()
+        embeddedThreads.pop(service, None)
 
 # -------------------------------------------------------------------------------------------------------------
 
 # MICROSERVICE A ----------------------------------------------------------------------------------------------
 # Sort the bookmarks list
+# Sorting is read straight from the bookmarks' sorted views; microservice A is only told when to exit
 def getSortOption(bookmarks, sortChoice):
-    # interact with microservice A
-    context = zmq.Context()
-
-    # socket to talk to server
-    socket = context.socket(zmq.REQ)
-    socket.connect("tcp://localhost:5555")
     if (sortChoice == 0):
         # exit the microservice
-        exit_message = json.dumps({"end_program": True})
-        socket.send_string(exit_message)
-        dummy_msg = socket.recv() # receive the sent message so the microservice can actually terminate
+        # wait for the reply so the microservice can actually terminate
+        try:
+            dummy_msg = serviceRequest("sort", SERVICE_EXIT_MESSAGES['sort'])
+        except ServiceUnavailableError:
+            pass
     else:
-        # form dictionary request
-        dict = {
-            "sort_by": None,
-            "descending": None,
-            "class_name": None,
-            "bookmarks": True,
-            "spell_list": bookmarks
-        }
+        descending = False
+        className = None
         if (sortChoice == 1):
-            dict['sort_by'] = "level"
+            sortBy = "level"
             print("SORTING TYPE")
             print("2: Sort spells by level descending")
             print("1: Sort spells by level ascending\n")
             sortingType = getIntegerInput("Select an option [1 or 2]: ", 1, 2)
-            if (sortingType == 1):
-                dict['descending'] = False
-            else:
-                dict['descending'] = True
+            if (sortingType == 2):
+                descending = True
         elif (sortChoice == 2):
-            dict['sort_by'] = "name"
+            sortBy = "name"
         elif (sortChoice == 3):
-            dict['sort_by'] = "class"
-            classType = input("Enter the class you want to sort by: ")
-            dict['class_name'] = classType
-
-        # send the request
-        message = json.dumps(dict)
-        socket.send_string(message)
-        result = socket.recv_string()
-        try: 
-            spell_data = json.loads(result)
-            if spell_data == []:
-                # if no spells returned, class name was invalid
-                print("Class not found.")
+            sortBy = "class"
+            className = input("Enter the class you want to sort by: ")
+
+        with metrics.measure("bookmarks.sort"):
+            sortedIds = bookmarks.getSortedIds(sortBy, descending, className)
+        if sortedIds == []:
+            # if no spells returned, class name was invalid
+            print("Class not found.")
+        else:
+            # print the sorted spells a page at a time, reading each one only when its page is shown
+            printSpells(bookmarks.getSpell(spellId) for spellId in sortedIds)
+# -------------------------------------------------------------------------------------------------------------
+
+# BOOKMARK STORE ----------------------------------------------------------------------------------------------
+# Identify a spell by its API index, or by its dashed name for custom spells
+def getSpellId(spell):
+    if (spell.get('index')):
+        return spell['index']
+    return str(spell.get('name', "")).lower().replace(" ", "-")
+
+# Level of a spell as an integer (custom spells may store it as text)
+def getSpellLevel(spell):
+    try:
+        return int(spell.get('level') or 0)
+    except (TypeError, ValueError):
+        return 0
+
+# Names of the classes that can cast a spell (custom spells may store them as comma separated text)
+def getSpellClasses(spell):
+    classes = spell.get('classes') or []
+    if (isinstance(classes, str)):
+        return [name.strip() for name in classes.split(',') if name.strip()]
+    return [spellClass['name'] if isinstance(spellClass, dict) else str(spellClass) for spellClass in classes]
+
+# Raised when an edit was made against an older version of a bookmarked spell than the one saved now
+# (a ValueError, so batch and server mode report it like any other rejected command)
+class StaleEditError(ValueError):
+    def __init__(self, spellId, version, currentVersion):
+        if (currentVersion is None):
+            message = "'" + spellId + "' was removed from the bookmarks while it was being edited"
+        else:
+            message = "'" + spellId + "' was changed while it was being edited (edited version " + str(version) + ", saved version " + str(currentVersion) + ")"
+        super().__init__(message)
+        self.spellId = spellId
+        self.version = version
+        self.currentVersion = currentVersion
+
+# Bookmarks saved on disk in SQLite, one row per spell, so each add, remove or edit writes only that row.
+# Spell ids, names, levels and classes are read the first time the bookmarks are used; full spells are
+# read one at a time as they are needed. To the rest of the program it behaves like a list of spells.
+# Sorted views by level, by name and by class are kept up to date on every change, so sorting the
+# bookmarks is just reading one of them.
+class Spellbook:
+    def __init__(self, path):
+        self.path = path
+        self.db = None
+        self.ids = [] # spell ids, in bookmark order
+        self.spellNames = {} # spell id -> spell name
+        self.sortKeys = {} # spell id -> (level, lowercase name, lowercase class names)
+        self.bodies = {} # spell id -> spell, for spells read so far
+        self.nextSeq = 0 # sort key for the next bookmark added
+        self.levelIndex = [] # (level, name, spell id), sorted
+        self.levelDescIndex = [] # (-level, name, spell id), sorted
+        self.nameIndex = [] # (name, spell id), sorted
+        self.classIndex = {} # class name -> sorted [(name, spell id)]
+        self.filterIndex = None # SpellFilter over the bookmarks, built on the first filter query
+        self.damageTable = None # DamageTable over the bookmarks, built on the first damage comparison after a change
+        self.versions = {} # spell id -> edit version, only used when the bookmarks can't be saved
+        self.unknownSaves = set() # ids of API spells saved before spells kept their saving throw
+        self.loaded = False
+
+    # Read the ids, names, levels and classes of the saved bookmarks (not the spells themselves)
+    def load(self):
+        self.loaded = True
+        try:
+            self.db = sqlite3.connect(self.path, check_same_thread=False)
+            self.db.execute("CREATE TABLE IF NOT EXISTS bookmarks (spell_id TEXT PRIMARY KEY, seq INTEGER, name TEXT, body TEXT, level INTEGER, classes TEXT, version INTEGER NOT NULL DEFAULT 0, save_known INTEGER NOT NULL DEFAULT 1)")
+            self.upgradeStore()
+            self.db.execute("CREATE INDEX IF NOT EXISTS bookmarks_listing ON bookmarks (seq, spell_id, name, level, classes)") # covers the startup read, so spell bodies are never touched
+            rows = self.db.execute("SELECT spell_id, seq, name, level, classes FROM bookmarks ORDER BY seq").fetchall()
+            self.unknownSaves = {spellId for (spellId,) in self.db.execute("SELECT spell_id FROM bookmarks WHERE save_known = 0")}
+        except sqlite3.Error as e:
+            print("Warning: bookmarks can't be saved this session:", e)
+            self.db = None
+            rows = []
+        for spellId, seq, name, level, classes in rows:
+            self.ids.append(spellId)
+            self.addToIndexes(spellId, name, level, json.loads(classes))
+        if (rows):
+            self.nextSeq = rows[-1][1] + 1
+
+    # Add the level and classes columns to a store saved before bookmarks could be sorted locally,
+    # the version column to one saved before edits were checked against versions, and the save_known
+    # column to one saved before spells kept their saving throw (marking the API spells saved without it)
+    def upgradeStore(self):
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(bookmarks)")]
+        if ('save_known' not in columns):
+            self.db.execute("ALTER TABLE bookmarks ADD COLUMN save_known INTEGER NOT NULL DEFAULT 1")
+            for spellId, body in self.db.execute("SELECT spell_id, body FROM bookmarks").fetchall():
+                row = json.loads(body)
+                # whole API dictionaries kept their saving throw; only compact rows from before 'dc' lack it
+                if (isinstance(row, list) and len(row) <= SPELL_FIELDS.index('dc') and row[SPELL_FIELDS.index('url')]):
+                    self.db.execute("UPDATE bookmarks SET save_known = 0 WHERE spell_id = ?", (spellId,))
+            self.db.commit()
+        if ('version' not in columns):
+            self.db.execute("ALTER TABLE bookmarks ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+            self.db.commit()
+        if ('level' not in columns):
+            self.db.execute("ALTER TABLE bookmarks ADD COLUMN level INTEGER")
+            self.db.execute("ALTER TABLE bookmarks ADD COLUMN classes TEXT")
+            self.db.execute("DROP INDEX IF EXISTS bookmarks_order")
+            for spellId, body in self.db.execute("SELECT spell_id, body FROM bookmarks").fetchall():
+                spell = json.loads(body)
+                self.db.execute("UPDATE bookmarks SET level = ?, classes = ? WHERE spell_id = ?", (getSpellLevel(spell), json.dumps(getSpellClasses(spell)), spellId))
+            self.db.commit()
+
+    # Run one write against the store and commit it straight away
+    def write(self, statement, values):
+        if (self.db is not None):
+            self.db.execute(statement, values)
+            self.db.commit()
+
+    # Insert a spell into every sorted view
+    # (keepSorted=False just appends, for bulk loads that call sortIndexes once at the end)
+    def addToIndexes(self, spellId, name, level, classes, keepSorted=True):
+        sortName = name.lower()
+        classNames = [className.lower() for className in classes]
+        self.spellNames[spellId] = name
+        self.sortKeys[spellId] = (level, sortName, classNames)
+        add = bisect.insort if keepSorted else list.append
+        add(self.levelIndex, (level, sortName, spellId))
+        add(self.levelDescIndex, (-level, sortName, spellId))
+        add(self.nameIndex, (sortName, spellId))
+        for className in classNames:
+            add(self.classIndex.setdefault(className, []), (sortName, spellId))
+
+    def sortIndexes(self):
+        for index in [self.levelIndex, self.levelDescIndex, self.nameIndex] + list(self.classIndex.values()):
+            index.sort()
+
+    # Remove a spell from every sorted view
+    def removeFromIndexes(self, spellId):
+        del self.spellNames[spellId]
+        level, sortName, classNames = self.sortKeys.pop(spellId)
+        removeSorted(self.levelIndex, (level, sortName, spellId))
+        removeSorted(self.levelDescIndex, (-level, sortName, spellId))
+        removeSorted(self.nameIndex, (sortName, spellId))
+        for className in classNames:
+            removeSorted(self.classIndex[className], (sortName, spellId))
+            if (not self.classIndex[className]):
+                del self.classIndex[className]
+
+    # Store one spell's row, with the spell itself in its compact list form
+    def saveSpell(self, spellId, seq, spell, version=0):
+        self.unknownSaves.discard(spellId)
+        self.write("INSERT OR REPLACE INTO bookmarks (spell_id, seq, name, body, level, classes, version) VALUES (?, ?, ?, ?, ?, ?, ?)", (spellId, seq, spell['name'], toStoredBody(spell), getSpellLevel(spell), json.dumps(getSpellClasses(spell)), version))
+
+    def __len__(self):
+        if (not self.loaded):
+            self.load()
+        return len(self.ids)
+
+    def __getitem__(self, position):
+        if (not self.loaded):
+            self.load()
+        if (isinstance(position, slice)):
+            return [self[i] for i in range(*position.indices(len(self.ids)))]
+        return self.getSpell(self.ids[position])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    # Return a bookmarked spell by id, reading it from the store the first time
+    def getSpell(self, spellId):
+        if (spellId not in self.bodies):
+            row = self.db.execute("SELECT body FROM bookmarks WHERE spell_id = ?", (spellId,)).fetchone()
+            self.bodies[spellId] = Spell.fromStored(json.loads(row[0]))
+        return self.bodies[spellId]
+
+    # Add a spell to the end of the bookmarks
+    def append(self, spell):
+        if (not self.loaded):
+            self.load()
+        spell = Spell.fromApi(spell)
+        spellId = getSpellId(spell)
+        self.ids.append(spellId)
+        self.addToIndexes(spellId, spell['name'], getSpellLevel(spell), getSpellClasses(spell))
+        self.bodies[spellId] = spell
+        if (self.filterIndex is not None):
+            self.filterIndex.add(spellId, spell)
+        self.damageTable = None
+        self.saveSpell(spellId, self.nextSeq, spell)
+        self.nextSeq += 1
+
+    # Replace the spell at a position, keeping its place in the bookmarks
+    def __setitem__(self, position, spell):
+        if (not self.loaded):
+            self.load()
+        spell = Spell.fromApi(spell)
+        oldId = self.ids[position]
+        spellId = getSpellId(spell)
+        self.removeFromIndexes(oldId)
+        self.bodies.pop(oldId, None)
+        self.ids[position] = spellId
+        self.addToIndexes(spellId, spell['name'], getSpellLevel(spell), getSpellClasses(spell))
+        self.bodies[spellId] = spell
+        if (self.filterIndex is not None):
+            self.filterIndex.remove(oldId)
+            self.filterIndex.add(spellId, spell)
+        self.damageTable = None
+        seq = self.nextSeq
+        version = self.versions.pop(oldId, 0) + 1
+        if (self.db is not None):
+            seq, version = self.db.execute("SELECT seq, version + 1 FROM bookmarks WHERE spell_id = ?", (oldId,)).fetchone()
+            self.db.execute("DELETE FROM bookmarks WHERE spell_id = ?", (oldId,))
+        self.saveSpell(spellId, seq, spell, version)
+        if (self.db is None):
+            self.versions[spellId] = version
+
+    # Edit version of a bookmarked spell (it goes up by one with every change saved to it),
+    # or None if it isn't bookmarked
+    def getVersion(self, spellId):
+        if (not self.loaded):
+            self.load()
+        if (self.db is None):
+            return self.versions.get(spellId, 0) if spellId in self.spellNames else None
+        row = self.db.execute("SELECT version FROM bookmarks WHERE spell_id = ?", (spellId,)).fetchone()
+        return row[0] if row else None
+
+    # Save an edited copy of a bookmarked spell, but only if the spell is still at the version the edit
+    # was made against. The check and the write are a single UPDATE, so edits saved by another program
+    # sharing the store are caught too; only this one row and its index entries are touched.
+    # Returns the spell's new version; raises StaleEditError if it changed or was removed in the meantime
+    def patch(self, spellId, version, spell):
+        if (not self.loaded):
+            self.load()
+        spell = Spell.fromApi(spell)
+        newId = getSpellId(spell)
+        if (newId != spellId and newId in self.spellNames):
+            raise ValueError("another bookmarked spell is already called '" + spell['name'] + "'")
+        if (self.db is not None):
+            if (spellId not in self.spellNames):
+                self.refresh(spellId) # it may have been bookmarked by another program
+            try:
+                cursor = self.db.execute("UPDATE bookmarks SET spell_id = ?, name = ?, body = ?, level = ?, classes = ?, version = version + 1 WHERE spell_id = ? AND version = ?",
+                                         (newId, spell['name'], toStoredBody(spell), getSpellLevel(spell), json.dumps(getSpellClasses(spell)), spellId, version))
+            except sqlite3.IntegrityError:
+                self.db.rollback()
+                raise ValueError("another bookmarked spell is already called '" + spell['name'] + "'")
+            if (cursor.rowcount == 0):
+                self.db.rollback()
+                self.refresh(spellId)
+                raise StaleEditError(spellId, version, self.getVersion(spellId))
+            self.db.commit()
+        elif (spellId not in self.spellNames or self.versions.get(spellId, 0) != version):
+            raise StaleEditError(spellId, version, self.getVersion(spellId))
+        else:
+            self.versions[newId] = self.versions.pop(spellId, 0) + 1
+        self.removeFromIndexes(spellId)
+        self.bodies.pop(spellId, None)
+        if (newId != spellId):
+            self.ids[self.ids.index(spellId)] = newId
+        self.addToIndexes(newId, spell['name'], getSpellLevel(spell), getSpellClasses(spell))
+        self.bodies[newId] = spell
+        if (self.filterIndex is not None):
+            self.filterIndex.remove(spellId)
+            self.filterIndex.add(newId, spell)
+        self.damageTable = None
+        return version + 1
+
+    # Reread one bookmark from the store after another program changed (or removed) it
+    def refresh(self, spellId):
+        row = self.db.execute("SELECT name, level, classes FROM bookmarks WHERE spell_id = ?", (spellId,)).fetchone()
+        self.damageTable = None
+        if (spellId in self.spellNames):
+            self.removeFromIndexes(spellId)
+            if (self.filterIndex is not None):
+                self.filterIndex.remove(spellId)
+        self.bodies.pop(spellId, None)
+        if (row is None):
+            if (spellId in self.ids):
+                self.ids.remove(spellId)
+            return
+        name, level, classes = row
+        if (spellId not in self.ids):
+            self.ids.append(spellId)
+        self.addToIndexes(spellId, name, level, json.loads(classes))
+        if (self.filterIndex is not None):
+            self.filterIndex.add(spellId, self.getSpell(spellId))
+
+    # Remove the spell at a position
+    def __delitem__(self, position):
+        if (not self.loaded):
+            self.load()
+        spellId = self.ids.pop(position)
+        self.removeFromIndexes(spellId)
+        self.bodies.pop(spellId, None)
+        if (self.filterIndex is not None):
+            self.filterIndex.remove(spellId)
+        self.damageTable = None
+        self.versions.pop(spellId, None)
+        self.unknownSaves.discard(spellId)
+        self.write("DELETE FROM bookmarks WHERE spell_id = ?", (spellId,))
+
+    # Whether a bookmarked spell's saving throw is known (False for API spells saved before spells kept it)
+    def isSaveKnown(self, spellId):
+        return spellId not in self.unknownSaves
+
+    # Fill in the saving throw (an API "dc" object, or None for none) of a spell saved without one; a repair
+    # of the saved copy, so the spell's edit version stays the same
+    def recordSavingThrow(self, spellId, savingThrow):
+        fields = {field: getattr(self.getSpell(spellId), field) for field in SPELL_FIELDS}
+        fields['dc'] = (internName(savingThrow.get('dc_type')), savingThrow.get('dc_success')) if savingThrow else None
+        spell = Spell(**fields)
+        self.bodies[spellId] = spell
+        self.unknownSaves.discard(spellId)
+        self.write("UPDATE bookmarks SET body = ?, save_known = 1 WHERE spell_id = ?", (toStoredBody(spell), spellId))
+
+    # Return the position of a bookmarked spell by id, or None if it isn't bookmarked
+    def find(self, spellId):
+        if (not self.loaded):
+            self.load()
+        if (spellId not in self.spellNames):
+            return None
+        return self.ids.index(spellId)
+
+    # Names of the bookmarked spells, in order, without reading the spells themselves
+    def getNames(self):
+        if (not self.loaded):
+            self.load()
+        return [self.spellNames[spellId] for spellId in self.ids]
+
+    # Ids of the bookmarked spells in a sorted order: by "level" (ascending or descending), by "name",
+    # or "class" for just the spells of className, alphabetically
+    def getSortedIds(self, sortBy, descending=False, className=None):
+        if (not self.loaded):
+            self.load()
+        if (sortBy == "level"):
+            return [entry[-1] for entry in (self.levelDescIndex if descending else self.levelIndex)]
+        if (sortBy == "name"):
+            return [entry[-1] for entry in self.nameIndex]
+        return [entry[-1] for entry in self.classIndex.get(className.strip().lower(), [])]
+
+    # Return (spell id, name) pairs of the bookmarks matching filter criteria, sorted by name
+    # The filter is built from every saved spell the first time (without keeping the spells in memory),
+    # then kept up to date on every change
+    def filter(self, criteria):
+        if (not self.loaded):
+            self.load()
+        if (self.filterIndex is None):
+            self.filterIndex = SpellFilter()
+            self.filterIndex.addAll(self.items())
+        return self.filterIndex.query(criteria)
+
+    # Return the DamageTable over the bookmarks, building it on first use after a change
+    def getDamageTable(self):
+        if (not self.loaded):
+            self.load()
+        if (self.damageTable is None):
+            self.damageTable = DamageTable(self.items())
+        return self.damageTable
+
+    # Every bookmark as a (spell id, spell) pair; spells not read yet come from the store one row at a time
+    def items(self):
+        if (self.db is None):
+            return ((spellId, self.bodies[spellId]) for spellId in self.ids)
+        rows = self.db.execute("SELECT spell_id, body FROM bookmarks")
+        return ((spellId, self.bodies.get(spellId) or Spell.fromStored(json.loads(body))) for spellId, body in rows)
+
+    # Every bookmark in bookmark order, read from the store one row at a time (and not kept), so even a
+    # huge spellbook is never all in memory
+    def spells(self):
+        if (not self.loaded):
+            self.load()
+        if (self.db is None):
+            return (self.bodies[spellId] for spellId in self.ids)
+        rows = self.db.execute("SELECT body FROM bookmarks ORDER BY seq")
+        return (Spell.fromStored(json.loads(body)) for (body,) in rows)
+
+    # Write every bookmark to out as JSON Lines ("jsonl") or CSV ("csv"), in bookmark order
+    # Returns the number of spells written
+    def exportSpells(self, out, fileFormat):
+        writer = None
+        if (fileFormat == "csv"):
+            writer = csv.DictWriter(out, fieldnames=SPELL_FIELDS)
+            writer.writeheader()
+        count = 0
+        for spell in self.spells():
+            if (writer is not None):
+                writer.writerow(toCsvRow(spell))
+            else:
+                out.write(json.dumps(spell.toDict(), separators=(',', ':')) + "\n")
+            count += 1
+        return count
+
+    # Bookmark the spells read from a JSON Lines or CSV stream, one record at a time: each is checked,
+    # skipped if its spell index is already bookmarked (or came earlier in the stream), and saved in
+    # transactions of IMPORT_BATCH_SIZE rows. Imported spells aren't kept in memory, only the index entries
+    # of the ones actually saved.
+    # Returns counts of added, duplicate and invalid records, describing the first few invalid ones
+    def importSpells(self, lines, fileFormat):
+        if (not self.loaded):
+            self.load()
+        summary = {"added": 0, "duplicates": 0, "invalid": 0, "errors": []}
+        batch = []
+        batchIds = set()
+        try:
+            for lineNumber, record in readSpellRecords(lines, fileFormat):
+                try:
+                    spell = toImportedSpell(record, fileFormat)
+                except ValueError as e:
+                    summary['invalid'] += 1
+                    if (len(summary['errors']) < IMPORT_ERROR_LIMIT):
+                        summary['errors'].append("line " + str(lineNumber) + ": " + str(e))
+                    continue
+                spellId = getSpellId(spell)
+                if (spellId in self.spellNames or spellId in batchIds):
+                    summary['duplicates'] += 1
+                    continue
+                level = getSpellLevel(spell)
+                classes = getSpellClasses(spell)
+                if (self.db is None):
+                    self.ids.append(spellId)
+                    self.addToIndexes(spellId, spell['name'], level, classes, keepSorted=False)
+                    self.bodies[spellId] = spell
+                    summary['added'] += 1
+                else:
+                    batch.append((spellId, self.nextSeq, spell['name'], toStoredBody(spell), level, classes))
+                    batchIds.add(spellId)
+                    if (len(batch) >= IMPORT_BATCH_SIZE):
+                        self.insertBatch(batch, summary)
+                        batch = []
+                        batchIds.clear()
+                self.nextSeq += 1
+        finally:
+            if (batch):
+                self.insertBatch(batch, summary)
+            self.sortIndexes()
+            if (summary['added'] > 0):
+                self.filterIndex = None
+                self.damageTable = None
+        return summary
+
+    # Save a batch of new bookmark rows in one transaction and index the saved ones; rows whose spell another
+    # program bookmarked in the meantime are left out, and counted in the summary as duplicates
+    def insertBatch(self, rows, summary):
+        # holding the write lock from the start, every row with a rowid past the last one is from this batch
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            lastRowid = self.db.execute("SELECT COALESCE(MAX(rowid), 0) FROM bookmarks").fetchone()[0]
+            self.db.executemany("INSERT OR IGNORE INTO bookmarks (spell_id, seq, name, body, level, classes) VALUES (?, ?, ?, ?, ?, ?)",
+                                ((spellId, seq, name, body, level, json.dumps(classes)) for spellId, seq, name, body, level, classes in rows))
+            saved = {spellId for (spellId,) in self.db.execute("SELECT spell_id FROM bookmarks WHERE rowid > ?", (lastRowid,))}
+            self.db.commit()
+        except sqlite3.Error:
+            self.db.rollback()
+            raise
+        for spellId, seq, name, body, level, classes in rows:
+            if (spellId in saved):
+                self.ids.append(spellId)
+                self.addToIndexes(spellId, name, level, classes, keepSorted=False)
+                summary['added'] += 1
             else:
-                # iterate through the response, printing out each spell
-                for spell in spell_data:
-                    printSpell(spell)
-        except json.JSONDecodeError:
-            print("Error: Could not decode server resonse")
+                summary['duplicates'] += 1
+
+# A spell as saved in the store: its compact list form, as JSON text
+def toStoredBody(spell):
+    return json.dumps(spell.toRow(), default=str, separators=(',', ':'))
+
+# A spell as a row of CSV cells: plain values as they are, lists and nested objects as JSON
+def toCsvRow(spell):
+    row = {}
+    for field in SPELL_FIELDS:
+        value = spell.exportField(field)
+        if (value is not None):
+            row[field] = json.dumps(value) if field in CSV_JSON_FIELDS else value
+    return row
+
+# Read import records one at a time, yielding (line number, record) pairs
+# JSON Lines records are left as text, so a malformed line only invalidates itself
+def readSpellRecords(lines, fileFormat):
+    if (fileFormat == "csv"):
+        reader = csv.DictReader(lines)
+        for row in reader:
+            yield reader.line_num, row
+    else:
+        for lineNumber, line in enumerate(lines, start=1):
+            if (line.strip()):
+                yield lineNumber, line
+
+# Check one import record and build its spell
+# Raises ValueError describing the first problem found
+def toImportedSpell(record, fileFormat):
+    try:
+        if (fileFormat == "csv"):
+            record = {field: json.loads(value) if field in CSV_JSON_FIELDS else value for field, value in record.items() if field in SPELL_FIELDS and value}
+        else:
+            record = json.loads(record)
+    except ValueError as e:
+        raise ValueError("not valid JSON (" + str(e) + ")")
+    if (not isinstance(record, dict)):
+        raise ValueError("a spell must be a JSON object")
+    if (not isinstance(record.get('name'), str) or not record['name'].strip()):
+        raise ValueError("the spell has no name")
+    level = record.get('level', 0)
+    if (isinstance(level, str) and level.strip().isdigit()):
+        level = int(level)
+    if (not isinstance(level, int) or isinstance(level, bool) or not 0 <= level <= 9):
+        raise ValueError("level must be a whole number from 0 to 9")
+    record['level'] = level
+    for field in ['ritual', 'concentration']:
+        if (isinstance(record.get(field), str)):
+            record[field] = record[field].strip().lower() in ["true", "yes"]
+    record.setdefault('index', toSpellIndex(record['name']))
+    try:
+        spell = Spell.fromApi(record)
+    except (TypeError, AttributeError, ValueError):
+        raise ValueError("the spell's fields don't have the expected shape")
+    if (not isinstance(spell.index, str) or not spell.index):
+        raise ValueError("the spell index must be text")
+    return spell
+
+# Remove an entry from a sorted list, finding it by binary search
+def removeSorted(sortedList, entry):
+    position = bisect.bisect_left(sortedList, entry)
+    if (position < len(sortedList) and sortedList[position] == entry):
+        del sortedList[position]
+
 # -------------------------------------------------------------------------------------------------------------
 
 # MICROSERVICE B ----------------------------------------------------------------------------------------------
@@ -361,7 +2934,7 @@ def getSortOption(bookmarks, sortChoice):
 def addSpell(spell, bookmarks):
     addOption = getIntegerInput("Would you like to add this spell to your bookmarks [1 = yes, 0 = no]?: ", 0, 1)
     if (addOption == 1):
-        bookmarks[:] = accessBookmarkMods(spell, bookmarks, 1) # set option to 1 to add the spell
+        accessBookmarkMods(spell, bookmarks, 1) # set option to 1 to add the spell
 
 # Get option + confirmation to remove a spell from bookmarks
 def removeSpell(spell, bookmarks):
@@ -370,44 +2943,133 @@ def removeSpell(spell, bookmarks):
         print("WARNING: Removing the spell will delete it from your bookmarks. Please confirm that you want to delete it.")
         removeOption = getIntegerInput("Would you like to remove this spell from your bookmarks [1 = yes, 0 = no]?: ", 0, 1)
         if (removeOption == 1):
-            bookmarks[:] = accessBookmarkMods(spell, bookmarks, 2) # set option to 2 to remove the spell
+            accessBookmarkMods(spell, bookmarks, 2) # set option to 2 to remove the spell
     
-# Interaction with the bookmark_mods.py microservice: add/remove spells
-def accessBookmarkMods(spell, bookmarks, option):
-    # interact with microservice B
-    context = zmq.Context()
-
-    # socket to talk to server
-    socket = context.socket(zmq.REQ)
-    socket.connect("tcp://localhost:5553")
-
-    # form dictionary request
-    dict = {
-        "json_array": bookmarks,
-        "json_object": spell,
+# Interaction with the bookmark_mods.py microservice: add/remove/edit spells
+# Options: 0 = exit, 1 = add, 2 = remove, 3 = edit (replacing oldSpell), 4 = full resync
+# An edit given the version of oldSpell it was made against is rejected with StaleEditError if the saved
+# spell has changed since; it only touches the spell's own row and index entries, and moves its version up by one
+# Only the change itself is sent to the service, which answers with its new bookmark version (and optionally
+# the stored record, which is what gets saved locally, so each change is written once);
+# the whole list is only sent again if that version shows the service has drifted.
+def accessBookmarkMods(spell, bookmarks, option, oldSpell=None, version=None):
+    global bookmarkVersion
+    if (option == 0):
+        # exit the microservice
+        sendBookmarkRequest({"json_array": "", "json_object": "", "option": 0})
+        return bookmarks
+    spell = Spell.fromApi(spell)
+
+    # check the change against the local list before telling the service about it
+    spellId = getSpellId(oldSpell if option == 3 else spell)
+    versioned = (option == 3 and version is not None)
+    position = None if versioned else bookmarks.find(spellId)
+    if (versioned):
+        currentVersion = bookmarks.getVersion(spellId)
+        if (currentVersion != version):
+            raise StaleEditError(spellId, version, currentVersion)
+    elif (option == 1 and position is not None):
+        print("This spell is already in your bookmarks.")
+        return bookmarks
+    elif (option == 3 and position is not None):
+        if (getSpellId(spell) != spellId and bookmarks.find(getSpellId(spell)) is not None):
+            print("Another bookmarked spell already has that name.")
+            return bookmarks
+
+    reply = sendBookmarkChange(spell, spellId, option) if mirrorBookmarks else None
+    # a reply without a version comes from a service that doesn't track versions
+    mirrored = isinstance(reply, dict) and 'version' in reply
+    inStep = mirrored and not reply.get('resync') and reply['version'] == bookmarkVersion + 1
+    if (inStep and reply.get('record') and option != 2):
+        spell = Spell.fromApi(reply['record'])
+
+    # apply the change locally
+    try:
+        if (versioned):
+            bookmarks.patch(spellId, version, spell)
+        elif (option == 1):
+            bookmarks.append(spell)
+        elif (option == 2 and position is not None):
+            del bookmarks[position]
+        elif (option == 3 and position is not None):
+            bookmarks[position] = spell
+    except ValueError:
+        # the service already took the change we couldn't save; resync it on the next bookmark change
+        bookmarkVersion = -1
+        raise
+    if (inStep):
+        bookmarkVersion = reply['version']
+    elif (mirrored):
+        resyncBookmarks(bookmarks)
+    return bookmarks
+
+# Send one bookmark change (just the affected spell) to microservice B and return its reply
+def sendBookmarkChange(spell, spellId, option):
+    return sendBookmarkRequest({
+        "protocol": BOOKMARK_PROTOCOL,
+        "version": bookmarkVersion,
+        "spell_id": spellId,
+        "json_array": [],
+        "json_object": spell if option != 2 else None,
         "option": option
-    }
-    jsonInput = json.dumps(dict, default=str)
-
-    # send request
-    socket.send_string(jsonInput)
-
-    # receive response
-    message = socket.recv()
+    })
+
+# Send the full bookmarks list so the service's copy matches ours again, streamed from the store in requests
+# of RESYNC_BATCH_SIZE spells: the first replaces the service's list and the rest add to it
+def resyncBookmarks(bookmarks):
+    batch = []
+    append = False
+    for spell in bookmarks.spells():
+        batch.append(spell)
+        if (len(batch) >= RESYNC_BATCH_SIZE):
+            if (not sendResyncBatch(batch, append)):
+                return
+            batch = []
+            append = True
+    if (batch or not append):
+        sendResyncBatch(batch, append)
+
+# Send one part of a resync; returns False (leaving the service to be resynced again) if it wasn't taken
+def sendResyncBatch(batch, append):
+    global bookmarkVersion
+    reply = sendBookmarkRequest({
+        "protocol": BOOKMARK_PROTOCOL,
+        "json_array": batch,
+        "json_object": None,
+        "option": 4,
+        "append": append
+    })
+    if (isinstance(reply, dict) and 'version' in reply):
+        bookmarkVersion = reply['version']
+        return True
+    bookmarkVersion = -1
+    return False
+
+# Send one request to microservice B and return the decoded reply (None if it sent nothing back or is down)
+def sendBookmarkRequest(request):
+    # interact with microservice B
+    global bookmarkVersion
+    try:
+        message = serviceRequest("bookmarks", request)
+    except ServiceUnavailableError:
+        # the change is already saved locally; resync the service once it is back
+        bookmarkVersion = -1
+        return None
     if (len(message) != 0):
-        decoded = message.decode('utf-8')
-        jsonLoaded = json.loads(decoded)
-        return jsonLoaded
-    return bookmarks # return original list if nothing was done
-    
+        try:
+            return decodeMessage(message)
+        except ValueError:
+            return None
+    return None
+
 # Print out name of spells in bookmarks list
 def viewBookmarks(bookmarks):
     if not bookmarks: # check if list is empty
         print("You have no spells saved yet!")
     else:
         print("\nBookmarks")
-        for i, spell in enumerate(bookmarks, start=1):
-            print(f"{i}: {bookmarks[i-1]['name']}")
+        for i, name in enumerate(bookmarks.getNames(), start=1):
+            print(f"{i}: {name}")
     
 # Display and get options for the bookmarks submenu (view a spell's details or delete it)
 def bookmarksSubmenu(bookmarks):
@@ -435,7 +3097,9 @@ def bookmarksSubmenu(bookmarks):
                 print("1: Sort spells by level, ascending or descending")
                 print("0: Return to Bookmarks Options\n")
                 sortChoice = getIntegerInput("Select an option [0, 1, 2, or 3]: ", 0, 3)
-                getSortOption(bookmarks, sortChoice)
+                if (sortChoice > 0):
+                    # 0 returns to the bookmark options (sort option 0 would shut down microservice A)
+                    getSortOption(bookmarks, sortChoice)
                 
         else:
             option = 0
@@ -456,97 +3120,142 @@ def getSpellFields():
     # Collect basic field values as simple key-value pairs
     spellFields = {}
     print("\n") # blank line for formatting
-    
-    # Get basic field values
-    for key in ['name', 'level', 'range', 'casting_time', 'duration', 'attack_type']:
-        value = input(f"Enter a value for the field '{key}': ")
-        spellFields[key] = value
-
-    # Handle description
-    desc = input("Enter the spell description: ")
-    spellFields['desc'] = desc
-
-    # Handle higher level effects
-    higher_level = input("Enter higher level effects (leave empty if none): ")
-    if higher_level:
-        spellFields['higher_level'] = higher_level
-    else:
-        spellFields['higher_level'] = ""
-
-    # Handle concentration
-    concentration = input("Does this spell require concentration? (yes/no): ").lower()
-    spellFields['concentration'] = concentration
-
-    # Handle ritual
-    ritual = input("Is this spell a ritual? (yes/no): ").lower()
-    spellFields['ritual'] = ritual
-
-    # Handle components
-    components_input = input("Enter components (separate with commas, e.g., V,S,M): ")
-    spellFields['components'] = components_input
-
-    # Handle damage type and scaling
-    has_damage = input("Does this spell deal damage? (yes/no): ").lower()
-    spellFields['has_damage'] = has_damage
-    
-    if has_damage == 'yes':
-        damage_type = input("Enter damage type (e.g. Fire, Cold, etc.): ")
-        spellFields['damage_type'] = damage_type
-        
-        # Handle damage scaling
-        scaling_type = input("Does damage scale with slot level or character level? (slot/character): ")
-        spellFields['scaling_type'] = scaling_type
-        
-        if scaling_type in ['slot', 'character']:
-            levels = input(f"Enter {scaling_type} levels to define (comma separated, e.g., 1, 5, 11): ")
-            spellFields['scaling_levels'] = levels
-            
-            # Collect damage values for each level
-            damage_values = {}
-            for level in levels.split(','):
-                level = level.strip()
-                damage = input(f"Enter damage for {scaling_type} level {level}: ")
-                damage_values[level] = damage
-            
-            spellFields['damage_values'] = json.dumps(damage_values)  # Convert to JSON string
-
-    # Handle school of magic
-    school = input("Enter school of magic: ")
-    spellFields['school'] = school
-
-    # Handle classes
-    classes_input = input("Enter classes that can use this spell (comma separated): ")
-    spellFields['classes'] = classes_input
-
+    for key in CUSTOM_SPELL_FIELDS:
+        getSpellFieldInput(key, spellFields)
     return spellFields
 
-def generateSpell(spellFields, option, bookmarks, spellToEdit):
+# Ask for one of the CUSTOM_SPELL_FIELDS and add the answer(s) to spellFields
+def getSpellFieldInput(key, spellFields):
+    if (key == 'name'):
+        # the name is the spell's bookmark key, so it can't be left empty
+        spellFields['name'] = ""
+        while (not spellFields['name'].strip()):
+            spellFields['name'] = input("Enter the spell's name: ")
+    elif (key == 'desc'):
+        # Handle description
+        spellFields['desc'] = input("Enter the spell description: ")
+    elif (key == 'higher_level'):
+        # Handle higher level effects
+        spellFields['higher_level'] = input("Enter higher level effects (leave empty if none): ")
+    elif (key == 'concentration'):
+        spellFields['concentration'] = input("Does this spell require concentration? (yes/no): ").lower()
+    elif (key == 'ritual'):
+        spellFields['ritual'] = input("Is this spell a ritual? (yes/no): ").lower()
+    elif (key == 'components'):
+        spellFields['components'] = input("Enter components (separate with commas, e.g., V,S,M): ")
+    elif (key == 'damage'):
+        # Handle damage type and scaling
+        has_damage = input("Does this spell deal damage? (yes/no): ").lower()
+        spellFields['has_damage'] = has_damage
+        if has_damage == 'yes':
+            spellFields['damage_type'] = input("Enter damage type (e.g. Fire, Cold, etc.): ")
+
+            # Handle damage scaling
+            scaling_type = input("Does damage scale with slot level or character level? (slot/character): ")
+            spellFields['scaling_type'] = scaling_type
+
+            if scaling_type in ['slot', 'character']:
+                levels = input(f"Enter {scaling_type} levels to define (comma separated, e.g., 1, 5, 11): ")
+                spellFields['scaling_levels'] = levels
+
+                # Collect damage values for each level
+                damage_values = {}
+                for level in levels.split(','):
+                    level = level.strip()
+                    damage = input(f"Enter damage for {scaling_type} level {level}: ")
+                    damage_values[level] = damage
+
+                spellFields['damage_values'] = json.dumps(damage_values)  # Convert to JSON string
+    elif (key == 'school'):
+        spellFields['school'] = input("Enter school of magic: ")
+    elif (key == 'classes'):
+        spellFields['classes'] = input("Enter classes that can use this spell (comma separated): ")
+    else:
+        spellFields[key] = input(f"Enter a value for the field '{key}': ")
+
+# Ask which fields of a spell to change, then ask only for those
+# Returns the patch: just the answers for the chosen fields (empty if none were chosen)
+def getSpellPatch(spell):
+    print("\nFIELDS")
+    for i, key in enumerate(CUSTOM_SPELL_FIELDS, start=1):
+        print(f"{i}: {key} ({textwrap.shorten(describeField(spell.get(key)), 50) or 'none'})")
+    choices = input("Enter the numbers of the fields to change, separated by commas (leave empty to cancel): ")
+    patch = {}
+    for choice in choices.split(','):
+        choice = choice.strip()
+        if (choice.isdigit() and 1 <= int(choice) <= len(CUSTOM_SPELL_FIELDS)):
+            getSpellFieldInput(CUSTOM_SPELL_FIELDS[int(choice) - 1], patch)
+        elif (choice):
+            print("Skipping '" + choice + "', which isn't one of the field numbers.")
+    return patch
+
+# A field's value as short readable text (nested API objects by their names)
+def describeField(value):
+    if (isinstance(value, dict)):
+        if ('name' in value):
+            return str(value['name'])
+        return ", ".join(key + ": " + describeField(item) for key, item in value.items())
+    if (isinstance(value, list)):
+        return ", ".join(describeField(item) for item in value)
+    if (isinstance(value, bool)):
+        return "yes" if value else "no"
+    return "" if value is None else str(value)
+
+# Edit a bookmarked spell by sending just the changed fields, then save the result only if nobody changed
+# the spell in the meantime (e.g. another program using the same bookmarks)
+def editSpell(spellToEdit, bookmarks):
+    spellId = getSpellId(spellToEdit)
+    version = bookmarks.getVersion(spellId)
+    patch = getSpellPatch(spellToEdit)
+    if (not patch):
+        print("Nothing was changed.")
+        return
+    editedSpell = generateSpell(patch, 2, spellToEdit, version)
+    if (editedSpell):
+        try:
+            accessBookmarkMods(editedSpell, bookmarks, 3, spellToEdit, version)
+        except StaleEditError as e:
+            print("Your edit was not saved:", e)
+            print("Please select the spell and make your changes again.")
+        except ValueError as e:
+            print("Your edit was not saved:", e)
+
+# Interaction with microservice C: build a new spell, or an edited copy of spellToEdit, from the collected fields
+# (for an edit, just the fields being changed, tagged with the spell's id and the version they were made against)
+# Returns just the resulting spell (as a Spell); the caller updates the bookmarks with it
+# If the microservice is down, the spell is built locally from the same fields instead
+def generateSpell(spellFields, option, spellToEdit, version=None):
     # interact with microservice C
-    context = zmq.Context()
-
-    # socket to talk to server
-    socket = context.socket(zmq.REQ)
-    socket.connect("tcp://localhost:5554")
-
     # form dictionary request
+    # only the spell being edited is sent, never the whole bookmarks list
     dict = {
+        "protocol": BOOKMARK_PROTOCOL,
         "option": option,
-        "json_array": bookmarks,
+        "json_array": [spellToEdit] if spellToEdit else [],
         "json_object": spellToEdit,
         "spell_fields": spellFields  # Send the collected fields directly
     }
-    jsonInput = json.dumps(dict, default=str)
+    if (spellToEdit and version is not None):
+        dict["spell_id"] = getSpellId(spellToEdit)
+        dict["version"] = version
 
-    # send request
-    socket.send_string(jsonInput)
-
-    # receive response
-    message = socket.recv()
+    # send request and receive response
+    try:
+        message = serviceRequest("spells", dict)
+    except ServiceUnavailableError as e:
+        print("Error:", e)
+        print("Building the spell without the microservice instead.")
+        return Spell.fromFields(spellFields, Spell.fromApi(spellToEdit) if spellToEdit else None)
     if (len(message) != 0):
-        decoded = message.decode('utf-8')
-        jsonLoaded = json.loads(decoded)
-        return jsonLoaded # this will be a new set of bookmarks with the edited spell
-    return bookmarks  # Return original bookmarks if no response
+        jsonLoaded = decodeMessage(message)
+        if (isinstance(jsonLoaded, list)):
+            # older services reply with the rebuilt list, which holds only the spell we sent
+            record = jsonLoaded[-1] if jsonLoaded else None
+        else:
+            record = jsonLoaded.get('record')
+        if (record):
+            return Spell.fromApi(record)
+    return None # no spell was generated
 
 def newSpellSubmenu():
     print("\nNEW SPELL OPTIONS")
@@ -563,12 +3272,7 @@ def getSpellToEdit(bookmarks):
 # -------------------------------------------------------------------------------------------------------------
 # MICROSERVICE D ----------------------------------------------------------------------------------------------
 def accessDiceRoller(option, n, m, operator):
-    # interact with microservice C
-    context = zmq.Context()
-
-    # socket to talk to server
-    socket = context.socket(zmq.REQ)
-    socket.connect("tcp://localhost:5552")
+    # interact with microservice D
 
     # form dictionary request
     dict = {
@@ -577,24 +3281,30 @@ def accessDiceRoller(option, n, m, operator):
         "operation": operator,
         "m": m
     }
-    jsonInput = json.dumps(dict, default=str)
-
-    # send request
-    socket.send_string(jsonInput)
 
-    # receive response
-    result = socket.recv()
+    # send request and receive response
+    result = serviceRequest("dice", dict)
+    # a binary frame has a flags byte after CODEC_MAGIC; a plain integer reply may begin with the same two bytes
+    if (result.startswith(CODEC_MAGIC) and len(result) > len(CODEC_MAGIC)):
+        return decodeMessage(result)
+    return decodeDiceResult(result, n, m, operator)
+
+# Decode the dice roller's plain reply: the result as a big-endian integer
+# A result that went negative after a '-' modifier arrives in two's complement, which reads as a large
+# unsigned number; any value above the largest possible roll (n - m) can only be such a negative result.
+def decodeDiceResult(result, n, m, operator):
     dice_roll = int.from_bytes(result, byteorder='big')
-    
+    if (operator == "-" and n is not None and m is not None and dice_roll > n - m):
+        dice_roll = int.from_bytes(result, byteorder='big', signed=True)
     return dice_roll
 
 def getDiceData():
-    n = getIntegerInput("Enter the number of faces on the dice to roll (max number of faces is 10000): ", 0, 10000)
+    n = getIntegerInput("Enter the number of faces on the dice to roll (max number of faces is 10000): ", 1, MAX_FACES)
     isModified = None
+    expression = "1d" + str(n)
     while (isModified != "yes" and isModified != "no"):
         isModified = input("Do you want to add a modifier to this dice roll? (yes/no): ").lower()
         if (isModified == "yes"):
-            option = 2
             invalidOperator = True
             while (invalidOperator):
                 operator = input("Do you want to add/subtract to the dice roll? (+/-): ")
@@ -603,33 +3313,703 @@ def getDiceData():
                 else:
                     print("Invalid input. Please enter + or -")
             m = getIntegerInput("Enter the value of the modifier (max modifier is 10000): ", 0, 10000)
-        elif (isModified == "no"):
-            option = 1
-            m = None
-            operator = None
-        else: 
+            expression += operator + str(m)
+        elif (isModified != "no"):
             print("Invalid input. Please enter \"yes\" or \"no\".")
     
-    return accessDiceRoller(option, n, m, operator)
-    
+    return rollDice(expression)[0]
+
+# Display the dice submenu and run the chosen dice option
+def diceSubmenu():
+    print("\nDICE OPTIONS")
+    print("3: Show the odds of a dice expression")
+    print("2: Roll a dice expression (e.g. 8d6+3, 2d20kh1, 4d6dl1)")
+    print("1: Roll a single dice (with or without modifiers)")
+    print("0: Return to main menu\n")
+    option = getIntegerInput("Select an option [0, 1, 2, or 3]: ", 0, 3)
+    try:
+        if (option == 1):
+            dice_roll = getDiceData()
+            print(f"\nYour dice roll result is: {dice_roll}")
+        elif (option == 2):
+            rollDiceExpression()
+        elif (option == 3):
+            showDiceStatistics(getDiceExpression())
+    except (ValueError, ServiceUnavailableError) as e:
+        # the dice microservice is down, or can't roll this expression
+        print("Error:", e)
+
+# Roll a dice expression many times and show the results
+def rollDiceExpression():
+    expression = getDiceExpression()
+    times = getIntegerInput("How many times do you want to roll it? [1 to " + str(MAX_BATCH_ROLLS) + "]: ", 1, MAX_BATCH_ROLLS)
+    results = rollDice(expression, times)
+    if (times <= 20):
+        print("\nYour dice roll results are:", ", ".join(str(result) for result in results))
+    else:
+        print(f"\nRolled {expression} {times} times.")
+        print(f"Lowest: {min(results)}  Average: {sum(results) / times:.2f}  Highest: {max(results)}")
+
+# Get a valid dice expression from the user
+def getDiceExpression():
+    while True:
+        expression = input("Enter a dice expression (e.g. 8d6+3, 2d20kh1, 4d6dl1): ")
+        try:
+            parseDiceExpression(expression)
+            return expression
+        except ValueError as e:
+            print("Invalid input.", e)
+
+# Print the exact odds of a dice expression
+def showDiceStatistics(expression):
+    try:
+        stats = diceStatistics(expression)
+    except ValueError as e:
+        print("Error:", e)
+        return
+    printLine()
+    print("Odds for", expression)
+    print(f"\nAverage: {stats['mean']:.2f}  Standard deviation: {stats['stddev']:.2f}")
+    print(f"Lowest: {stats['min']}  Highest: {stats['max']}")
+    print("\nPercentiles:")
+    for percentile, total in stats['percentiles'].items():
+        print(f"{percentile}th percentile: {total}")
+    distribution = stats['distribution']
+    if (len(distribution) <= 60):
+        # small enough to chart every total
+        print("\nChance of each total:")
+        mostLikely = max(distribution.values())
+        for total, chance in distribution.items():
+            print(f"{total:>6}  {chance * 100:6.2f}%  " + "#" * round(chance / mostLikely * 40))
+    printLine()
+
+# -------------------------------------------------------------------------------------------------------------
+
+# DICE ENGINE -------------------------------------------------------------------------------------------------
+# A dice expression is terms joined by + and -; a term is a constant or NdM dice with an optional
+# kh/kl (keep highest/lowest) or dh/dl (drop highest/lowest) suffix, e.g. 8d6+3, 2d20kh1, 4d6dl1
+DICE_TERM = r"(?:\d*d\d+(?:(?:kh|kl|dh|dl)\d*)?|\d+)"
+DICE_EXPRESSION_PATTERN = re.compile(r"[+-]?" + DICE_TERM + r"(?:[+-]" + DICE_TERM + r")*")
+DICE_TERM_PATTERN = re.compile(r"([+-]?)(?:(\d*)d(\d+)(?:(kh|kl|dh|dl)(\d*))?|(\d+))")
+
+# Parse a dice expression into terms of (sign, number of dice, faces, dice kept, keep highest?, constant)
+# Constant terms have 0 dice. Raises ValueError for an invalid expression.
+def parseDiceExpression(expression):
+    text = expression.replace(" ", "").lower()
+    if (not DICE_EXPRESSION_PATTERN.fullmatch(text)):
+        raise ValueError("'" + expression + "' is not a dice expression like 8d6+3.")
+    terms = []
+    for match in DICE_TERM_PATTERN.finditer(text):
+        sign = -1 if match.group(1) == "-" else 1
+        if (match.group(6) is not None):
+            terms.append((sign, 0, 0, 0, True, int(match.group(6))))
+            continue
+        count = int(match.group(2) or 1)
+        sides = int(match.group(3))
+        if (count < 1 or count > MAX_DICE):
+            raise ValueError("Roll between 1 and " + str(MAX_DICE) + " dice at a time.")
+        if (sides < 1 or sides > MAX_FACES):
+            raise ValueError("Dice must have between 1 and " + str(MAX_FACES) + " faces.")
+        keep = count
+        highest = True
+        if (match.group(4)):
+            amount = int(match.group(5) or 1)
+            if (match.group(4) == "kh"):
+                keep = amount
+            elif (match.group(4) == "kl"):
+                keep = amount
+                highest = False
+            elif (match.group(4) == "dl"):
+                keep = count - amount
+            else:
+                keep = count - amount
+                highest = False
+            if (keep < 1 or keep > count):
+                raise ValueError("At least one dice must be kept, and no more than were rolled.")
+        terms.append((sign, count, sides, keep, highest, 0))
+    return terms
+
+# Roll a dice expression a number of times, returning the list of totals
+# The local engine rolls every trial of a term in one batch; backend "service" sends each roll of a
+# single die with one modifier to microservice D instead
+def rollDice(expression, times=1, backend=None):
+    terms = parseDiceExpression(expression)
+    if ((backend or DICE_BACKEND) == "service"):
+        return rollWithService(terms, times)
+    if (numpy is not None):
+        totals = numpy.zeros(times, dtype=numpy.int64)
+        for term in terms:
+            totals += rollTermNumpy(term, times)
+        return totals.tolist()
+    totals = [0] * times
+    for term in terms:
+        totals = [total + roll for total, roll in zip(totals, rollTerm(term, times))]
+    return totals
+
+# Roll every trial of one term as an array (with the shared generator unless given another), at most
+# ROLL_CHUNK_DICE dice at a time
+def rollTermNumpy(term, times, generator=None):
+    sign, count, sides, keep, highest, constant = term
+    if (count == 0):
+        return numpy.full(times, sign * constant, dtype=numpy.int64)
+    generator = generator or getRandomGenerator()
+    totals = numpy.empty(times, dtype=numpy.int64)
+    chunk = max(1, ROLL_CHUNK_DICE // count)
+    for start in range(0, times, chunk):
+        rolls = generator.integers(1, sides + 1, size=(min(chunk, times - start), count))
+        if (keep < count):
+            rolls.sort(axis=1)
+            rolls = rolls[:, count - keep:] if highest else rolls[:, :keep]
+        totals[start:start + len(rolls)] = rolls.sum(axis=1)
+    return sign * totals
+
+# Roll every trial of one term without NumPy, at most ROLL_CHUNK_DICE dice at a time
+def rollTerm(term, times):
+    sign, count, sides, keep, highest, constant = term
+    if (count == 0):
+        return [sign * constant] * times
+    faces = range(1, sides + 1)
+    totals = []
+    chunk = max(1, ROLL_CHUNK_DICE // count)
+    for start in range(0, times, chunk):
+        rollCount = min(chunk, times - start) * count
+        rolls = random.choices(faces, k=rollCount)
+        if (keep == count):
+            totals.extend(sign * sum(rolls[i:i + count]) for i in range(0, rollCount, count))
+            continue
+        for i in range(0, rollCount, count):
+            dice = sorted(rolls[i:i + count])
+            totals.append(sign * sum(dice[count - keep:] if highest else dice[:keep]))
+    return totals
+
+# Shared NumPy random generator
+def getRandomGenerator():
+    global randomGenerator
+    if (randomGenerator is None):
+        randomGenerator = numpy.random.default_rng()
+    return randomGenerator
+
+# Roll one die with at most one modifier through microservice D
+def rollWithService(terms, times):
+    dice = [term for term in terms if term[1] > 0]
+    constants = [term for term in terms if term[1] == 0]
+    if (len(dice) != 1 or dice[0][1] != 1 or dice[0][0] < 0 or len(constants) > 1):
+        raise ValueError("Microservice D can only roll a single dice with one modifier.")
+    n = dice[0][2]
+    if (constants):
+        operator = "+" if constants[0][0] > 0 else "-"
+        return [accessDiceRoller(2, n, constants[0][5], operator) for i in range(times)]
+    return [accessDiceRoller(1, n, None, None) for i in range(times)]
+
+# Exact odds of a dice expression: the chance of every total, the mean, standard deviation,
+# lowest and highest totals, and the DICE_PERCENTILES percentiles
+# Raises ValueError if the expression has too many outcomes to work out exactly
+def diceStatistics(expression):
+    terms = parseDiceExpression(expression)
+    if (estimateOddsWork(terms) > DICE_STATES_LIMIT):
+        raise ValueError("Too many possible outcomes to work out the exact odds. Try fewer dice.")
+    distribution = {0: 1.0}
+    for term in terms:
+        distribution = convolveDistributions(distribution, getTermDistribution(term))
+    return summarizeDistribution(distribution)
+
+# The mean, standard deviation, lowest and highest totals and DICE_PERCENTILES percentiles of a
+# {total: chance} distribution, along with the distribution itself in order of total
+def summarizeDistribution(distribution):
+    totals = sorted(distribution)
+    mean = sum(total * distribution[total] for total in totals)
+    variance = sum(distribution[total] * (total - mean) ** 2 for total in totals)
+    percentiles = {}
+    cumulative = 0.0
+    position = 0
+    for percentile in DICE_PERCENTILES:
+        # smallest total whose cumulative chance reaches the percentile (allowing for float rounding)
+        while (cumulative + distribution[totals[position]] < percentile / 100 - 1e-12):
+            cumulative += distribution[totals[position]]
+            position += 1
+        percentiles[percentile] = totals[position]
+    return {
+        "distribution": {total: distribution[total] for total in totals},
+        "mean": mean,
+        "stddev": math.sqrt(variance),
+        "min": totals[0],
+        "max": totals[-1],
+        "percentiles": percentiles
+    }
+
+# How many steps working out the exact odds of terms takes in all: a step for every pair of totals combined,
+# die by die within a term and then term by term, and for every set of kept dice tracked
+def estimateOddsWork(terms):
+    work = 0
+    totals = 1 # possible totals of the terms so far
+    for sign, count, sides, keep, highest, constant in terms:
+        if (count == 0):
+            termTotals = 1
+        elif (keep == count):
+            termTotals = count * (sides - 1) + 1
+            # adding die i + 1 combines the i * (sides - 1) + 1 totals of the first i dice with each face
+            work += sides * (count + (sides - 1) * count * (count - 1) // 2)
+        else:
+            termTotals = keep * (sides - 1) + 1
+            work += math.comb(sides + keep - 1, keep) * sides * count
+        work += totals * termTotals
+        totals += termTotals - 1
+    return work
+
+# Chance of every total of one term
+def getTermDistribution(term):
+    sign, count, sides, keep, highest, constant = term
+    if (count == 0):
+        return {sign * constant: 1.0}
+    if (keep == count):
+        die = {face: 1 / sides for face in range(1, sides + 1)}
+        distribution = {0: 1.0}
+        for i in range(count):
+            distribution = convolveDistributions(distribution, die)
+    else:
+        distribution = getKeptDistribution(count, sides, keep)
+        if (not highest):
+            # keeping the lowest dice mirrors keeping the highest: face f becomes sides + 1 - f
+            distribution = {keep * (sides + 1) - total: chance for total, chance in distribution.items()}
+    if (sign < 0):
+        distribution = {-total: chance for total, chance in distribution.items()}
+    return distribution
+
+# Chance of every total when count dice are rolled and the highest keep of them are added up
+# Works through the dice one at a time, tracking the highest keep faces seen so far
+def getKeptDistribution(count, sides, keep):
+    if (math.comb(sides + keep - 1, keep) * sides * count > DICE_STATES_LIMIT):
+        raise ValueError("Too many possible outcomes to work out the exact odds. Try fewer dice.")
+    states = {(): 1.0}
+    for i in range(count):
+        nextStates = {}
+        for kept, chance in states.items():
+            for face in range(1, sides + 1):
+                newKept = list(kept)
+                bisect.insort(newKept, face)
+                if (len(newKept) > keep):
+                    del newKept[0]
+                newKept = tuple(newKept)
+                nextStates[newKept] = nextStates.get(newKept, 0.0) + chance / sides
+        states = nextStates
+    distribution = {}
+    for kept, chance in states.items():
+        distribution[sum(kept)] = distribution.get(sum(kept), 0.0) + chance
+    return distribution
+
+# Chance of every total of the sum of two independent results
+def convolveDistributions(first, second):
+    if (len(first) * len(second) > DICE_STATES_LIMIT):
+        raise ValueError("Too many possible outcomes to work out the exact odds. Try fewer dice.")
+    distribution = {}
+    for firstTotal, firstChance in first.items():
+        for secondTotal, secondChance in second.items():
+            total = firstTotal + secondTotal
+            distribution[total] = distribution.get(total, 0.0) + firstChance * secondChance
+    return distribution
+
+# WARM-UP -----------------------------------------------------------------------------------------------------
+# While the user reads the menu, do the slow first-time work in the background: import the heavy modules,
+# connect the microservice sockets, open the connection to the API and load the spell names for searches
+def startWarmUp():
+    warmUpThread = threading.Thread(target=warmUp, daemon=True)
+    warmUpThread.start()
+    return warmUpThread
+
+# Each step is only a head start: if one fails (e.g. offline), the feature that needs it reports the error later
+def warmUp():
+    with metrics.measure("startup.warmup"):
+        runOnTransport(connectServiceSockets())
+        for module in [requests, numpy]:
+            if (module is not None):
+                module.load()
+        try:
+            getHttpSession().head(SPELL_API_URL, timeout=SERVICE_TIMEOUT)
+            getSpellNameIndex()
+        except requests.exceptions.RequestException:
+            pass
+
+# Connect every microservice socket ahead of its first request
+async def connectServiceSockets():
+    for service in SERVICE_PORTS:
+        getServiceSocket(service)
+
+# -------------------------------------------------------------------------------------------------------------
+
+# BATCH MODE --------------------------------------------------------------------------------------------------
+# Run commands from a file (or stdin when the path is "-") instead of showing the menu,
+# writing one JSON result per command to stdout
+def runBatchMode(path):
+    bookmarks = Spellbook(BOOKMARKS_PATH)
+    if (path == "-"):
+        runBatch(sys.stdin, sys.stdout, bookmarks)
+    else:
+        with open(path) as commandFile:
+            runBatch(commandFile, sys.stdout, bookmarks)
+    stopPrefetch()
+    closeServiceSockets()
+    # stdout holds the JSON Lines results, so the report goes to stderr
+    finishMetrics(sys.stderr)
+
+# Run batch commands from lines of text, a window of BATCH_WINDOW commands at a time
+def runBatch(lines, out, bookmarks):
+    window = []
+    for lineNumber, line in enumerate(lines, start=1):
+        line = line.strip()
+        if (line and not line.startswith("#")):
+            window.append((lineNumber, line))
+        if (len(window) >= BATCH_WINDOW):
+            runBatchWindow(window, out, bookmarks)
+            window = []
+    if (window):
+        runBatchWindow(window, out, bookmarks)
+
+# Run a window of commands in order, after starting every spell lookup they need at once
+def runBatchWindow(window, out, bookmarks):
+    spellIndices = [getBatchSpellIndex(line) for lineNumber, line in window]
+    prefetched = prefetchSpells([index for index in spellIndices if index and spellCatalog.get(index) is None])
+    for lineNumber, line in window:
+        record = {"line": lineNumber, "command": line, "ok": True}
+        try:
+            record['result'] = runBatchCommand(line, bookmarks, prefetched)
+        except (ValueError, IndexError, requests.exceptions.RequestException, ServiceUnavailableError) as e:
+            record['ok'] = False
+            record['error'] = str(e)
+        out.write(json.dumps(record, default=encodeValue) + "\n")
+    out.flush()
+
+# Spell index a batch command will look up, or None if it doesn't look one up
+def getBatchSpellIndex(line):
+    words = line.split()
+    if (words[0].lower() == "lookup"):
+        return toSpellIndex(" ".join(words[1:]))
+    if (words[0].lower() == "bookmark" and len(words) > 2 and words[1].lower() == "add"):
+        return toSpellIndex(" ".join(words[2:]))
+    return None
+
+# Run one batch command and return its result
+# Commands: lookup <name> | search <key word> | bookmark add <name> | bookmark remove <name> |
+# bookmark list | bookmark get <name> | bookmark edit <name> <version> <JSON object of changed fields> |
+# sort level [asc|desc] | sort name | sort class <class> | roll <expression> [times] |
+# filter catalog|bookmarks <attribute=value ...> | custom <JSON object of spell fields> |
+# damage catalog|bookmarks slot|character <level> [attribute=value ...] |
+# simulate [ac=N] [save=N] [attack=N] [dc=N] [level=N] [trials=N] <spell[@slot], spell[@slot], ...>
+# Raises ValueError for bad commands or failed lookups
+def runBatchCommand(line, bookmarks, prefetched):
+    words = line.split()
+    command = words[0].lower()
+    args = words[1:]
+    if (command == "lookup"):
+        return getBatchSpell(" ".join(args), prefetched)
+    elif (command == "search"):
+        matchedIndices, matchedNames, status = findKeywordMatches(" ".join(args))
+        if (status != 200):
+            raise ValueError("search failed with response code " + str(status))
+        return [{"index": index, "name": name} for index, name in zip(matchedIndices, matchedNames)]
+    elif (command == "bookmark"):
+        action = args[0].lower()
+        name = " ".join(args[1:])
+        if (action == "add"):
+            spell = getBatchSpell(name, prefetched)
+            if (bookmarks.find(getSpellId(spell)) is not None):
+                raise ValueError("'" + name + "' is already in your bookmarks")
+            accessBookmarkMods(spell, bookmarks, 1)
+            return {"added": getSpellId(spell)}
+        elif (action == "remove"):
+            position = bookmarks.find(toSpellIndex(name))
+            if (position is None):
+                raise ValueError("'" + name + "' is not in your bookmarks")
+            accessBookmarkMods(bookmarks[position], bookmarks, 2)
+            return {"removed": toSpellIndex(name)}
+        elif (action == "list"):
+            return bookmarks.getNames()
+        elif (action == "get"):
+            position = bookmarks.find(toSpellIndex(name))
+            if (position is None):
+                raise ValueError("'" + name + "' is not in your bookmarks")
+            return {"spell": bookmarks[position], "version": bookmarks.getVersion(toSpellIndex(name))}
+        elif (action == "edit"):
+            # the patch is the JSON object at the end; the words before it are the name and the version
+            words, brace, patch = line.partition("{")
+            words = words.split()[2:]
+            if (not brace or len(words) < 2 or not words[-1].isdigit()):
+                raise ValueError("bookmark edit needs a spell name, the version it was read at and a JSON object of changed fields")
+            name = " ".join(words[:-1])
+            patch = json.loads(brace + patch)
+            if (not isinstance(patch, dict)):
+                raise ValueError("the changed fields must be a JSON object")
+            patch = toFieldAnswers(patch)
+            if (bookmarks.getVersion(toSpellIndex(name)) is None):
+                raise ValueError("'" + name + "' is not in your bookmarks")
+            spellToEdit = bookmarks.getSpell(toSpellIndex(name))
+            editedSpell = generateSpell(patch, 2, spellToEdit, int(words[-1]))
+            if (editedSpell is None):
+                raise ValueError("the spell service did not return the edited spell")
+            accessBookmarkMods(editedSpell, bookmarks, 3, spellToEdit, int(words[-1]))
+            return {"edited": getSpellId(editedSpell), "version": bookmarks.getVersion(getSpellId(editedSpell))}
+    elif (command == "sort"):
+        sortBy = args[0].lower()
+        if (sortBy in ["level", "name", "class"]):
+            descending = len(args) > 1 and args[1].lower() == "desc"
+            sortedIds = bookmarks.getSortedIds(sortBy, descending, " ".join(args[1:]))
+            return [{"index": spellId, "name": bookmarks.spellNames[spellId]} for spellId in sortedIds]
+    elif (command == "roll"):
+        times = int(args[1]) if len(args) > 1 else 1
+        if (not 1 <= times <= MAX_BATCH_ROLLS):
+            raise ValueError("roll between 1 and " + str(MAX_BATCH_ROLLS) + " times")
+        return rollDice(args[0], times)
+    elif (command == "filter" and args and args[0].lower() in ["catalog", "bookmarks"]):
+        criteria = parseFilterQuery(" ".join(args[1:]))
+        matches = spellCatalog.filter(criteria) if args[0].lower() == "catalog" else bookmarks.filter(criteria)
+        return [{"index": key, "name": name} for key, name in matches]
+    elif (command == "damage" and len(args) >= 3 and args[0].lower() in ["catalog", "bookmarks"] and args[1].lower() in DAMAGE_LEVELS):
+        if (not args[2].isdigit()):
+            raise ValueError("'" + args[2] + "' is not a level")
+        criteria = parseFilterQuery(" ".join(args[3:])) if len(args) > 3 else None
+        return rankSpellDamage(spellCatalog if args[0].lower() == "catalog" else bookmarks, args[1].lower(), int(args[2]), criteria)
+    elif (command == "simulate"):
+        encounter = dict(ENCOUNTER_DEFAULTS)
+        while (args and "=" in args[0]):
+            setting, value = args.pop(0).lower().split("=", 1)
+            if (setting not in encounter or not re.fullmatch(r"[+-]?\d+", value)):
+                raise ValueError("'" + setting + "=" + value + "' is not a simulation setting; use " + ", ".join(key + "=N" for key in ENCOUNTER_DEFAULTS))
+            encounter[setting] = int(value)
+        trials = encounter.pop('trials')
+        if (not 1 <= trials <= ENCOUNTER_MAX_TRIALS):
+            raise ValueError("simulate between 1 and " + str(ENCOUNTER_MAX_TRIALS) + " trials")
+        summary = simulateEncounter(planRotation(" ".join(args), bookmarks, encounter), encounter, trials)
+        del summary['distribution']
+        return summary
+    elif (command == "custom"):
+        spellFields = json.loads(line.split(None, 1)[1]) if args else None
+        if (isinstance(spellFields, dict)):
+            spellFields = toFieldAnswers(spellFields)
+        if (not isinstance(spellFields, dict) or not spellFields.get('name')):
+            raise ValueError("custom needs a JSON object of spell fields with at least a name")
+        spell = generateSpell(spellFields, 1, None)
+        if (spell is None):
+            raise ValueError("the spell service did not return the new spell")
+        if (bookmarks.find(getSpellId(spell)) is not None):
+            raise ValueError("'" + spell['name'] + "' is already in your bookmarks")
+        accessBookmarkMods(spell, bookmarks, 1)
+        return {"added": getSpellId(spell)}
+    raise ValueError("unknown command '" + line + "'")
+
+# Return the spell a batch command names, from the catalog, its prefetch, or the API
+def getBatchSpell(name, prefetched):
+    index = toSpellIndex(name)
+    spell = spellCatalog.get(index)
+    if (spell is not None):
+        return spell
+    if (index in prefetched):
+        status, spell = prefetched[index].result()
+    else:
+        status, spell = fetchSpell(index)
+    if (status != 200):
+        raise ValueError("spell '" + name + "' not found with response code " + str(status))
+    return spell
+
+# -------------------------------------------------------------------------------------------------------------
+
+# SPELLBOOK IMPORT & EXPORT -----------------------------------------------------------------------------------
+# File format for an import or export: the one asked for, else CSV for a ".csv" file and JSON Lines otherwise
+def getFileFormat(path, fileFormat):
+    if (fileFormat):
+        return fileFormat
+    return "csv" if path.lower().endswith(".csv") else "jsonl"
+
+# Save every bookmark to a file (stdout when the path is "-")
+def runExport(path, fileFormat):
+    bookmarks = Spellbook(BOOKMARKS_PATH)
+    fileFormat = getFileFormat(path, fileFormat)
+    with metrics.measure("bookmarks.export"):
+        if (path == "-"):
+            count = bookmarks.exportSpells(sys.stdout, fileFormat)
+        else:
+            with open(path, "w", newline="" if fileFormat == "csv" else None, encoding="utf-8") as out:
+                count = bookmarks.exportSpells(out, fileFormat)
+    print("Exported " + str(count) + " spells.", file=sys.stderr)
+    finishMetrics(sys.stderr)
+
+# Add the spells in a file (stdin when the path is "-") to the bookmarks
+def runImport(path, fileFormat):
+    global bookmarkVersion
+    bookmarks = Spellbook(BOOKMARKS_PATH)
+    fileFormat = getFileFormat(path, fileFormat)
+    with metrics.measure("bookmarks.import"):
+        if (path == "-"):
+            summary = bookmarks.importSpells(sys.stdin, fileFormat)
+        else:
+            with open(path, newline="" if fileFormat == "csv" else None, encoding="utf-8") as lines:
+                summary = bookmarks.importSpells(lines, fileFormat)
+    # nothing is sent to microservice B while importing; its copy is resynced on the next bookmark change
+    bookmarkVersion = -1
+    print(f"Imported {summary['added']} spells ({summary['duplicates']} already bookmarked, {summary['invalid']} invalid).")
+    for error in summary['errors']:
+        print("  " + error)
+    if (summary['invalid'] > len(summary['errors'])):
+        print(f"  ... and {summary['invalid'] - len(summary['errors'])} more invalid records")
+    finishMetrics(sys.stdout)
+
+# -------------------------------------------------------------------------------------------------------------
+
+# SPELLBOOK SERVER --------------------------------------------------------------------------------------------
+# Serves the batch commands to many clients at once. Clients send JSON requests like
+# {"user": "alice", "command": "bookmark add fireball"} to a ROUTER socket and get back the same JSON
+# record batch mode prints. A pool of worker threads answers them, sharing one spell cache, catalog,
+# HTTP connection pool and set of microservice sockets; each user has their own spellbook.
+class SpellbookServer:
+    def __init__(self, endpoint, directory, workers):
+        self.endpoint = endpoint
+        self.directory = directory
+        self.workers = workers
+        self.context = None
+        self.spellbooks = {} # user -> Spellbook, opened on the user's first request
+        self.userLocks = {} # user -> lock held while one of their commands runs
+        self.lock = threading.Lock() # guards the two dictionaries above
+        self.threads = []
+
+    # Bind the client and worker sockets and start the workers
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self.context = zmq.Context()
+        self.frontend = self.context.socket(zmq.ROUTER)
+        self.frontend.bind(self.endpoint)
+        self.backend = self.context.socket(zmq.DEALER)
+        self.backend.bind(SERVER_WORKER_ENDPOINT)
+        self.control = self.context.socket(zmq.PAIR)
+        self.control.bind(SERVER_CONTROL_ENDPOINT)
+        for i in range(self.workers):
+            thread = threading.Thread(target=self.serveWorker, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    # Pass requests from clients to idle workers and replies back, until stop() is called
+    def serve(self):
+        try:
+            zmq.proxy_steerable(self.frontend, self.backend, None, self.control)
+        except zmq.ContextTerminated:
+            pass
+        for socket in [self.frontend, self.backend, self.control]:
+            socket.close(linger=0)
+        self.context.term() # waits for the workers to close their sockets
+        for spellbook in self.spellbooks.values():
+            if (spellbook.db is not None):
+                spellbook.db.close()
+
+    # Ask serve() to finish (safe to call from any thread)
+    def stop(self):
+        control = self.context.socket(zmq.PAIR)
+        control.connect(SERVER_CONTROL_ENDPOINT)
+        control.send(b"TERMINATE")
+        control.close()
+
+    # Answer requests until the server stops; every request gets a reply, even one that fails unexpectedly,
+    # so its client isn't left waiting and the worker stays in the pool
+    def serveWorker(self):
+        socket = self.context.socket(zmq.REP)
+        socket.connect(SERVER_WORKER_ENDPOINT)
+        try:
+            while True:
+                message = socket.recv()
+                with metrics.measure("server.request") as measurement:
+                    try:
+                        reply = json.dumps(self.handle(message), default=encodeValue).encode('utf-8')
+                    except Exception as e:
+                        measurement.error = True
+                        reply = json.dumps({"ok": False, "error": "the server could not send its reply (" + str(e) + ")"}).encode('utf-8')
+                    measurement.bytesIn = len(message)
+                    measurement.bytesOut = len(reply)
+                socket.send(reply)
+        except zmq.ContextTerminated:
+            pass
+        socket.close(linger=0)
+
+    # Run one client request and return its result record
+    def handle(self, message):
+        record = {"ok": True}
+        try:
+            request = json.loads(message)
+            if (not isinstance(request, dict)):
+                raise ValueError("a request must be a JSON object")
+            line = str(request.get('command', "")).strip()
+            record['command'] = line
+            if (not line):
+                raise ValueError("the request has no command")
+            bookmarks, userLock = self.getSpellbook(request.get('user'))
+            # commands on one user's spellbook run one at a time; other users' commands run alongside
+            with userLock:
+                record['result'] = runBatchCommand(line, bookmarks, {})
+        except (ValueError, IndexError, requests.exceptions.RequestException, ServiceUnavailableError) as e:
+            record['ok'] = False
+            record['error'] = str(e)
+        except Exception as e:
+            # a bug one request runs into is reported to that client, not allowed to stop the worker
+            record['ok'] = False
+            record['error'] = "the command failed unexpectedly (" + type(e).__name__ + ": " + str(e) + ")"
+        return record
+
+    # Return a user's spellbook and its lock, opening it on first use
+    # Raises ValueError for a missing or unsafe user name (it becomes a file name)
+    def getSpellbook(self, user):
+        if (not isinstance(user, str) or not re.fullmatch(r"[A-Za-z0-9_-]{1,64}", user)):
+            raise ValueError("the request needs a user name of 1 to 64 letters, digits, '-' or '_'")
+        with self.lock:
+            if (user not in self.spellbooks):
+                self.spellbooks[user] = Spellbook(os.path.join(self.directory, user + ".db"))
+                self.userLocks[user] = threading.Lock()
+            return self.spellbooks[user], self.userLocks[user]
+
+# Run the spellbook server in the foreground until interrupted
+def runServer(endpoint, workers):
+    global mirrorBookmarks
+    mirrorBookmarks = False
+    server = SpellbookServer(endpoint, SERVER_SPELLBOOK_DIRECTORY, workers)
+    server.start()
+    startWarmUp()
+    print("Serving spellbooks on " + endpoint + " with " + str(workers) + " workers (Ctrl+C to stop)")
+    # the proxy runs in its own thread so Ctrl+C reaches this one
+    proxyThread = threading.Thread(target=server.serve)
+    proxyThread.start()
+    try:
+        while proxyThread.is_alive():
+            proxyThread.join(0.5)
+    except KeyboardInterrupt:
+        server.stop()
+        proxyThread.join()
+    stopPrefetch()
+    closeServiceSockets()
+    finishMetrics(sys.stdout)
+
 # -------------------------------------------------------------------------------------------------------------
 # Program Driver
 def main():
     # variables
-    bookmarks = []
+    bookmarks = Spellbook(BOOKMARKS_PATH)
     userInput = -1
     confirmQuit = -1
 
     # Display Title
     printTitle()
+    startWarmUp()
+    warnUnavailableServices()
 
     # User input loop
     while (confirmQuit != 0):
         printMenuOptions()
-        userInput = getIntegerInput("Choose an option [0, 1, 2, 3, 4, 5, 6]: ", 0, 6)
-        if (userInput == 6):
-            dice_roll = getDiceData()
-            print(f"\nYour dice roll result is: {dice_roll}")
+        userInput = getIntegerInput("Choose an option [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10]: ", 0, 10, (METRICS_MENU_OPTION,))
+        if (userInput == METRICS_MENU_OPTION):
+            showMetrics()
+        elif (userInput == 10):
+            encounterMenu(bookmarks)
+        elif (userInput == 9):
+            compareDamageMenu(bookmarks)
+        elif (userInput == 8):
+            filterSpellsMenu(bookmarks)
+        elif (userInput == 7):
+            downloadCatalog()
+        elif (userInput == 6):
+            diceSubmenu()
         elif (userInput == 5):
             option = newSpellSubmenu()
             if (option > 0):
@@ -637,15 +4017,19 @@ def main():
                     # Get user input for spell fields
                     customSpell = getSpellFields()
                     # Send to microservice for processing
-                    bookmarks = generateSpell(customSpell, option, bookmarks, None)
+                    try:
+                        newSpell = generateSpell(customSpell, option, None)
+                    except ValueError as e:
+                        print("Your spell was not saved:", e)
+                        newSpell = None
+                    if (newSpell):
+                        accessBookmarkMods(newSpell, bookmarks, 1)
                 elif (option == 2):
                     # select some spell to edit
                     if (len(bookmarks) > 0):
                         spellToEdit = getSpellToEdit(bookmarks)
-                        # Get user input for updated fields
-                        spellEdits = getSpellFields()
-                        # Send to microservice for processing
-                        bookmarks = generateSpell(spellEdits, option, bookmarks, spellToEdit)
+                        # Ask for just the fields to change and send them to the microservice
+                        editSpell(spellToEdit, bookmarks)
                     else:
                         print("No spells are in your bookmarks to edit.")
         elif (userInput == 4):
@@ -672,7 +4056,32 @@ def main():
                 confirmQuit = -1
             if (confirmQuit == 0):
                 exitMicroservices()
+                stopPrefetch()
+                finishMetrics(sys.stdout)
                 print("\nProgram closed.")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Search DND5e spells and manage a spellbook.")
+    parser.add_argument("--batch", metavar="FILE", help="run commands from FILE ('-' for stdin) and print JSON Lines results instead of showing the menu")
+    parser.add_argument("--transport", choices=["tcp", "ipc", "inproc"], default=SERVICE_TRANSPORT, help="how to reach the microservices: tcp, ipc (Unix domain sockets in " + IPC_DIRECTORY + ") or inproc (built-in versions, no separate services needed)")
+    parser.add_argument("--profile", action="store_true", help="print how long each kind of external call took when the program closes")
+    parser.add_argument("--metrics-out", metavar="FILE", help="save the call timings to FILE when the program closes (JSON if FILE ends in .json, Prometheus text otherwise)")
+    parser.add_argument("--serve", metavar="ENDPOINT", nargs="?", const=SERVER_ENDPOINT, help="serve the batch commands to many clients at once over ZMQ (default endpoint " + SERVER_ENDPOINT + "), keeping a spellbook per user in " + SERVER_SPELLBOOK_DIRECTORY + "/")
+    parser.add_argument("--workers", type=int, default=SERVER_WORKERS, help="requests handled at the same time in server mode (default " + str(SERVER_WORKERS) + ")")
+    parser.add_argument("--export", metavar="FILE", help="save all bookmarks to FILE ('-' for stdout) and exit")
+    parser.add_argument("--import", dest="import_path", metavar="FILE", help="add the spells in FILE ('-' for stdin) to the bookmarks and exit; spells already bookmarked are skipped")
+    parser.add_argument("--format", choices=["jsonl", "csv"], help="file format for --export and --import (default: csv for .csv files, JSON Lines otherwise)")
+    args = parser.parse_args()
+    profileOnExit = args.profile
+    SERVICE_TRANSPORT = args.transport
+    metricsExportPath = args.metrics_out
+    if (args.export):
+        runExport(args.export, args.format)
+    elif (args.import_path):
+        runImport(args.import_path, args.format)
+    elif (args.serve):
+        runServer(args.serve, max(1, args.workers))
+    elif (args.batch):
+        runBatchMode(args.batch)
+    else:
+        main()
\ No newline at end of file
@@ -0,0 +1,821 @@
+import io
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+
+import benchmark
+import main
+
+# Regression tests for the spellbook; run with python -m unittest
+
+# Close a spellbook's store, if it was opened
+def closeSpellbook(spellbook):
+    if (spellbook.db is not None):
+        spellbook.db.close()
+
+class CustomSpellTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.bookmarks = main.Spellbook(os.path.join(self.directory.name, "spellbook.db"))
+
+    def tearDown(self):
+        closeSpellbook(self.bookmarks)
+        self.directory.cleanup()
+
+    # A custom spell with every field but the name left blank is saved and shown without crashing
+    def testBlankCustomSpellRenders(self):
+        fields = {key: "" for key in main.SPELL_FIELD_ANSWERS}
+        fields['name'] = "Blank Spell"
+        self.bookmarks.append(main.Spell.fromFields(fields))
+        reopened = main.Spellbook(self.bookmarks.path)
+        reopened.load()
+        card = main.formatSpell(reopened.getSpell("blank-spell"))
+        closeSpellbook(reopened)
+        self.assertIn("Name:  Blank Spell", card)
+        self.assertIn("No description.", card)
+        self.assertIn("School of Magic:  Unknown", card)
+
+    # A custom spell needs a name: the prompt asks again, and fields without one are rejected before bookmarking
+    def testCustomSpellNeedsName(self):
+        with self.assertRaisesRegex(ValueError, "'name'"):
+            main.Spell.fromFields({key: "" for key in main.SPELL_FIELD_ANSWERS})
+        self.assertEqual(main.EmbeddedServices().handleSpells({"option": 1, "json_object": None, "spell_fields": {"level": "1"}}), {})
+        answers = iter(["", "  ", "Frost Lance"])
+        main.input = lambda prompt: next(answers)
+        try:
+            fields = {}
+            main.getSpellFieldInput('name', fields)
+        finally:
+            del main.input
+        self.assertEqual(fields['name'], "Frost Lance")
+
+# A custom spell request the spell service can't build is answered with an error, not a crash
+class CustomCommandTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.serviceRequest = main.serviceRequest
+        main.serviceRequest = lambda service, request: b"" # the service replies without a spell
+
+    def tearDown(self):
+        main.serviceRequest = self.serviceRequest
+        self.directory.cleanup()
+
+    def testBatchCommandRaisesValueError(self):
+        bookmarks = main.Spellbook(os.path.join(self.directory.name, "spellbook.db"))
+        with self.assertRaises(ValueError):
+            main.runBatchCommand('custom {"name": "Broken Spell"}', bookmarks, {})
+        closeSpellbook(bookmarks)
+
+    def testServerRepliesWithError(self):
+        server = main.SpellbookServer(main.SERVER_ENDPOINT, self.directory.name, 1)
+        reply = server.handle(b'{"user": "alice", "command": "custom {\\"name\\": \\"Broken Spell\\"}"}')
+        for spellbook in server.spellbooks.values():
+            closeSpellbook(spellbook)
+        self.assertFalse(reply['ok'])
+        self.assertIn("did not return", reply['error'])
+
+# Spell cache hits, misses and evictions are counted in the metrics every report and export reads
+class SpellCacheMetricsTest(unittest.TestCase):
+    def testCacheEventsReachMetrics(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = main.SpellCache(os.path.join(directory, "cache.db"), 1, 2**20, 60, 60)
+            before = main.metrics.snapshot()["counters"]
+            cache.get("fireball")
+            cache.put("fireball", 200, {"index": "fireball"})
+            cache.get("fireball")
+            cache.put("shield", 200, {"index": "shield"}) # the memory tier holds one entry
+            cache.get("fireball")
+            cache.db.close()
+        after = main.metrics.snapshot()["counters"]
+        counted = {event: after.get(event, 0) - before.get(event, 0) for event in ["cache.hit", "cache.miss", "cache.disk_hit", "cache.eviction"]}
+        self.assertEqual(counted, {"cache.hit": 2, "cache.miss": 1, "cache.disk_hit": 1, "cache.eviction": 2})
+        self.assertIn('spellbook_events_total{event="cache.hit"}', main.metrics.toPrometheus())
+
+# A request that fails in a way the server didn't expect still gets a reply, and the worker keeps serving
+class ServerWorkerTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.runBatchCommand = main.runBatchCommand
+        self.server = main.SpellbookServer("tcp://127.0.0.1:5597", self.directory.name, 1)
+        self.server.start()
+        self.proxy = threading.Thread(target=self.server.serve)
+        self.proxy.start()
+
+    def tearDown(self):
+        main.runBatchCommand = self.runBatchCommand
+        self.server.stop()
+        self.proxy.join()
+        self.directory.cleanup()
+
+    def testWorkerSurvivesUnexpectedError(self):
+        def runBatchCommand(line, bookmarks, prefetched):
+            if (line == "crash"):
+                raise TypeError("unsupported operand")
+            return "fine"
+        main.runBatchCommand = runBatchCommand
+        context = main.zmq.Context()
+        client = context.socket(main.zmq.REQ)
+        client.setsockopt(main.zmq.RCVTIMEO, 5000)
+        client.setsockopt(main.zmq.LINGER, 0)
+        client.connect("tcp://127.0.0.1:5597")
+        try:
+            client.send(b'{"user": "alice", "command": "crash"}')
+            reply = json.loads(client.recv())
+            self.assertFalse(reply['ok'])
+            self.assertIn("TypeError", reply['error'])
+            # the only worker answers the next request too
+            client.send(b'{"user": "alice", "command": "lookup"}')
+            self.assertEqual(json.loads(client.recv())['result'], "fine")
+        finally:
+            client.close()
+            context.term()
+
+# An edit the bookmarks service hands back a copy of is saved once, moving the spell's version up by one
+class BookmarkEditTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.bookmarks = main.Spellbook(os.path.join(self.directory.name, "spellbook.db"))
+        self.sendBookmarkRequest = main.sendBookmarkRequest
+        main.bookmarkVersion = 0
+        # the service accepts every change and returns the spell it stored
+        main.sendBookmarkRequest = lambda request: {"version": main.bookmarkVersion + 1, "record": request['json_object']}
+
+    def tearDown(self):
+        main.sendBookmarkRequest = self.sendBookmarkRequest
+        main.bookmarkVersion = -1
+        closeSpellbook(self.bookmarks)
+        self.directory.cleanup()
+
+    def testEditBumpsVersionOnce(self):
+        spell = main.Spell.fromFields({"name": "Frost Lance", "level": "3"})
+        main.accessBookmarkMods(spell, self.bookmarks, 1)
+        self.assertEqual(self.bookmarks.getVersion("frost-lance"), 0)
+        edited = main.Spell.fromFields({"level": "4"}, spell)
+        main.accessBookmarkMods(edited, self.bookmarks, 3, spell, 0)
+        self.assertEqual(self.bookmarks.getVersion("frost-lance"), 1)
+        self.assertEqual(self.bookmarks.getSpell("frost-lance")['level'], 4)
+        # another session's edit made against version 1 is still accepted
+        main.accessBookmarkMods(main.Spell.fromFields({"level": "5"}, spell), self.bookmarks, 3, spell, 1)
+        self.assertEqual(self.bookmarks.getVersion("frost-lance"), 2)
+        with self.assertRaises(main.StaleEditError):
+            main.accessBookmarkMods(main.Spell.fromFields({"level": "6"}, spell), self.bookmarks, 3, spell, 1)
+
+# Spell fields given as JSON numbers, booleans or lists are used, and values that can't be are rejected by name
+class SpellFieldsTest(unittest.TestCase):
+    def testNonTextValuesAreConverted(self):
+        spell = main.Spell.fromFields({"name": "Frost Lance", "level": 4, "ritual": True, "desc": ["First.", "Second."], "classes": ["Wizard", "Sorcerer"]})
+        self.assertEqual(spell['level'], 4)
+        self.assertTrue(spell['ritual'])
+        self.assertEqual(spell['desc'], ["First.", "Second."])
+        self.assertEqual(spell['classes'][1]['name'], "Sorcerer")
+
+    def testUnusableValuesAreRejected(self):
+        with self.assertRaisesRegex(ValueError, "'level'"):
+            main.toFieldAnswers({"level": 4.5})
+        with self.assertRaisesRegex(ValueError, "'lvl'"):
+            main.toFieldAnswers({"lvl": "4"})
+
+    # damage_values that isn't a table of level -> damage is rejected before it reaches the spell model
+    def testDamageValuesMustBeATable(self):
+        fields = {"name": "X", "has_damage": "yes", "scaling_type": "slot"}
+        for damageValues in ["[1]", [1], "7", '{"3": 8}']:
+            with self.assertRaisesRegex(ValueError, "'damage_values'"):
+                main.toFieldAnswers(dict(fields, damage_values=damageValues))
+        self.assertEqual(main.EmbeddedServices().handleSpells({"option": 1, "json_object": None, "spell_fields": dict(fields, damage_values="[1]")}), {})
+        spell = main.Spell.fromFields(dict(fields, damage_values={"3": "8d6"}))
+        self.assertEqual(spell['damage']['damage_at_slot_level'], {"3": "8d6"})
+
+    def testBatchCustomWithBadDamageValuesFails(self):
+        transport = main.SERVICE_TRANSPORT
+        main.SERVICE_TRANSPORT = "inproc"
+        try:
+            with self.assertRaisesRegex(ValueError, "'damage_values'"):
+                main.runBatchCommand('custom {"name": "X", "has_damage": "yes", "scaling_type": "slot", "damage_values": "[1]"}', None, {})
+        finally:
+            main.closeServiceSockets()
+            main.SERVICE_TRANSPORT = transport
+
+    def testBatchEditAppliesNumbers(self):
+        with tempfile.TemporaryDirectory() as directory:
+            bookmarks = main.Spellbook(os.path.join(directory, "spellbook.db"))
+            mirrorBookmarks = main.mirrorBookmarks
+            main.mirrorBookmarks = False
+            try:
+                main.accessBookmarkMods(main.Spell.fromFields({"name": "Frost Lance", "level": "3"}), bookmarks, 1)
+                main.generateSpell = self.buildLocally(main.generateSpell)
+                main.runBatchCommand('bookmark edit frost lance 0 {"level": 4}', bookmarks, {})
+                self.assertEqual(bookmarks.getSpell("frost-lance")['level'], 4)
+                with self.assertRaises(ValueError):
+                    main.runBatchCommand('bookmark edit frost lance 1 {"level": [4]}', bookmarks, {})
+            finally:
+                main.generateSpell = main.generateSpell.original
+                main.mirrorBookmarks = mirrorBookmarks
+                closeSpellbook(bookmarks)
+
+    # generateSpell that builds the spell here rather than asking the spell service
+    def buildLocally(self, generateSpell):
+        def build(spellFields, option, spellToEdit, version=None):
+            return main.Spell.fromFields(spellFields, main.Spell.fromApi(spellToEdit) if spellToEdit else None)
+        build.original = generateSpell
+        return build
+
+# A plain integer dice reply that happens to start like a binary frame is still read as the integer
+class DiceReplyTest(unittest.TestCase):
+    def setUp(self):
+        self.serviceRequest = main.serviceRequest
+
+    def tearDown(self):
+        main.serviceRequest = self.serviceRequest
+
+    def testTwoByteReplyIsAnInteger(self):
+        main.serviceRequest = lambda service, request: main.CODEC_MAGIC # 83 as a two-byte integer
+        self.assertEqual(main.accessDiceRoller(1, 100, None, None), 83)
+        with self.assertRaises(ValueError):
+            main.decodeMessage(main.CODEC_MAGIC)
+
+# Large rolls are bounded, and NumPy rolls them a chunk at a time
+class DiceTest(unittest.TestCase):
+    def testBatchRollIsBounded(self):
+        with self.assertRaises(ValueError):
+            main.runBatchCommand("roll 1d6 " + str(main.MAX_BATCH_ROLLS + 1), None, {})
+        self.assertEqual(len(main.runBatchCommand("roll 1d6 " + str(main.MAX_BATCH_ROLLS), None, {})), main.MAX_BATCH_ROLLS)
+
+    @unittest.skipIf(main.numpy is None, "needs NumPy")
+    def testTermIsRolledInChunks(self):
+        chunkDice = main.ROLL_CHUNK_DICE
+        main.ROLL_CHUNK_DICE = 100
+        try:
+            totals = main.rollTermNumpy(main.parseDiceExpression("40d6kh3")[0], 1001)
+        finally:
+            main.ROLL_CHUNK_DICE = chunkDice
+        self.assertEqual(len(totals), 1001)
+        self.assertTrue(((totals >= 3) & (totals <= 18)).all())
+
+    def testPythonTermIsRolledInChunks(self):
+        chunkDice = main.ROLL_CHUNK_DICE
+        main.ROLL_CHUNK_DICE = 100
+        try:
+            totals = main.rollTerm(main.parseDiceExpression("40d6kl3")[0], 1001)
+            plain = main.rollTerm(main.parseDiceExpression("30d6")[0], 1001)
+        finally:
+            main.ROLL_CHUNK_DICE = chunkDice
+        self.assertEqual((len(totals), len(plain)), (1001, 1001))
+        self.assertTrue(all(3 <= total <= 18 for total in totals))
+        self.assertTrue(all(30 <= total <= 180 for total in plain))
+
+    # Exact odds that would take too long are refused before any work is done
+    def testExactOddsWorkIsBounded(self):
+        start = time.monotonic()
+        for expression in ["100d100", "200d100", "1000d6"]:
+            with self.assertRaises(ValueError):
+                main.diceStatistics(expression)
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(main.diceStatistics("100d20")['min'], 100)
+
+# Threads that all need the transport loop at once, like the warm-up and the start-up check, share one loop
+class TransportLoopTest(unittest.TestCase):
+    def tearDown(self):
+        main.closeServiceSockets()
+
+    def testConcurrentStartMakesOneLoop(self):
+        main.closeServiceSockets()
+        barrier = threading.Barrier(8)
+        loops = []
+        def start():
+            barrier.wait()
+            loops.append(main.getTransportLoop())
+        threads = [threading.Thread(target=start) for i in range(8)]
+        before = threading.active_count()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len({id(loop) for loop in loops}), 1)
+        self.assertEqual(threading.active_count(), before + 1)
+
+# A microservice that just gave no reply is reported down at once, until SERVICE_DOWN_COOLDOWN passes
+class UnavailableServiceTest(unittest.TestCase):
+    def setUp(self):
+        self.settings = (dict(main.SERVICE_ENDPOINTS), main.SERVICE_TIMEOUT, main.SERVICE_DOWN_COOLDOWN)
+        main.SERVICE_ENDPOINTS['dice'] = "tcp://127.0.0.1:5599" # nothing listens here
+        main.SERVICE_TIMEOUT = 0.2
+
+    def tearDown(self):
+        main.closeServiceSockets()
+        main.SERVICE_ENDPOINTS.clear()
+        main.SERVICE_ENDPOINTS.update(self.settings[0])
+        main.SERVICE_TIMEOUT, main.SERVICE_DOWN_COOLDOWN = self.settings[1:]
+
+    def request(self):
+        start = time.monotonic()
+        with self.assertRaises(main.ServiceUnavailableError):
+            main.serviceRequest("dice", {"option": 1, "n": 20, "operation": None, "m": None})
+        return time.monotonic() - start
+
+    def testLaterRequestsFailFast(self):
+        self.assertGreaterEqual(self.request(), main.SERVICE_TIMEOUT * (main.SERVICE_RETRIES + 1))
+        self.assertLess(self.request(), main.SERVICE_TIMEOUT)
+
+    def testServiceIsTriedAgainAfterCooldown(self):
+        main.SERVICE_DOWN_COOLDOWN = 0
+        self.request()
+        self.assertGreaterEqual(self.request(), main.SERVICE_TIMEOUT * (main.SERVICE_RETRIES + 1))
+
+# Imports index only the spells they saved, and resyncs stream the bookmarks to the service in parts
+class BulkTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "spellbook.db")
+        self.bookmarks = main.Spellbook(self.path)
+        self.bookmarks.load()
+
+    def tearDown(self):
+        closeSpellbook(self.bookmarks)
+        self.directory.cleanup()
+
+    def record(self, name):
+        return json.dumps(main.Spell.fromFields({"name": name, "level": "1"}).toDict())
+
+    def testExportImportRoundTrip(self):
+        self.bookmarks.append(main.Spell.fromFields(main.toFieldAnswers({"name": "Frost Lance", "level": 3, "ritual": True, "desc": ["First.", "Second, with a comma."],
+                                                                         "classes": ["Wizard", "Sorcerer"], "damage_values": '{"3": "8d6", "4": "9d6"}'})))
+        self.bookmarks.append(main.Spell.fromFields({"name": "Shield", "level": "1", "school": "Abjuration"}))
+        for fileFormat in ["jsonl", "csv"]:
+            out = io.StringIO(newline="")
+            self.assertEqual(self.bookmarks.exportSpells(out, fileFormat), 2)
+            copy = main.Spellbook(os.path.join(self.directory.name, fileFormat + ".db"))
+            summary = copy.importSpells(io.StringIO(out.getvalue(), newline=""), fileFormat)
+            self.assertEqual((summary['added'], summary['duplicates'], summary['invalid']), (2, 0, 0), fileFormat)
+            self.assertEqual([spell.toDict() for spell in copy], [spell.toDict() for spell in self.bookmarks], fileFormat)
+            closeSpellbook(copy)
+
+    def testImportChecksAndDeduplicates(self):
+        batchSize = main.IMPORT_BATCH_SIZE
+        main.IMPORT_BATCH_SIZE = 2
+        try:
+            lines = [self.record("Spell " + str(i)) for i in range(5)] + ["{not json", "", self.record("Spell 1"), json.dumps({"level": 2})]
+            summary = self.bookmarks.importSpells(lines, "jsonl")
+        finally:
+            main.IMPORT_BATCH_SIZE = batchSize
+        self.assertEqual((summary['added'], summary['duplicates'], summary['invalid']), (5, 1, 2))
+        self.assertTrue(summary['errors'][0].startswith("line 6:"))
+        self.assertTrue(summary['errors'][1].startswith("line 9:"))
+        self.assertEqual(self.bookmarks.getNames(), ["Spell " + str(i) for i in range(5)])
+        summary = self.bookmarks.importSpells([self.record("Spell 4"), self.record("Spell 5")], "jsonl")
+        self.assertEqual((summary['added'], summary['duplicates']), (1, 1))
+        reopened = main.Spellbook(self.path)
+        self.assertEqual(reopened.getNames()[-1], "Spell 5")
+        closeSpellbook(reopened)
+
+    def testSpellSavedElsewhereIsNotIndexed(self):
+        other = main.Spellbook(self.path)
+        other.append(main.Spell.fromFields({"name": "Frost Lance", "level": "2"}))
+        closeSpellbook(other)
+        summary = self.bookmarks.importSpells([self.record("Frost Lance"), self.record("Ember Dart")], "jsonl")
+        self.assertEqual((summary['added'], summary['duplicates']), (1, 1))
+        self.assertEqual(self.bookmarks.getNames(), ["Ember Dart"])
+
+    def testResyncIsSentInParts(self):
+        self.bookmarks.importSpells([self.record("Spell " + str(i)) for i in range(5)], "jsonl")
+        requests = []
+        def sendBookmarkRequest(request):
+            requests.append(request)
+            return {"version": len(requests)}
+        settings = (main.sendBookmarkRequest, main.RESYNC_BATCH_SIZE)
+        main.sendBookmarkRequest = sendBookmarkRequest
+        main.RESYNC_BATCH_SIZE = 2
+        try:
+            main.resyncBookmarks(self.bookmarks)
+        finally:
+            main.sendBookmarkRequest, main.RESYNC_BATCH_SIZE = settings
+            main.bookmarkVersion = -1
+        self.assertEqual([len(request['json_array']) for request in requests], [2, 2, 1])
+        self.assertEqual([request['append'] for request in requests], [False, True, True])
+        self.assertEqual(self.bookmarks.bodies, {}) # nothing was kept in memory
+
+# Encounter simulations are rolled in chunks, and spells bookmarked before their save DC was kept get it from the API
+class EncounterTest(unittest.TestCase):
+    FIREBALL = {"index": "fireball", "name": "Fireball", "level": 3, "url": "/api/spells/fireball", "school": {"name": "Evocation"},
+                "damage": {"damage_type": {"name": "Fire"}, "damage_at_slot_level": {"3": "8d6"}},
+                "dc": {"dc_type": {"index": "dex", "name": "DEX"}, "dc_success": "half"}}
+    MAGIC_MISSILE = {"index": "magic-missile", "name": "Magic Missile", "level": 1, "url": "/api/spells/magic-missile",
+                     "damage": {"damage_type": {"name": "Force"}, "damage_at_slot_level": {"1": "3d4+3"}}}
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "spellbook.db")
+        # a store saved before spells kept their save DC: no save_known column, and rows one field short
+        db = sqlite3.connect(self.path)
+        db.execute("CREATE TABLE bookmarks (spell_id TEXT PRIMARY KEY, seq INTEGER, name TEXT, body TEXT, level INTEGER, classes TEXT, version INTEGER NOT NULL DEFAULT 0)")
+        row = main.Spell.fromApi(self.FIREBALL).toRow()[:-1]
+        db.execute("INSERT INTO bookmarks VALUES ('fireball', 0, 'Fireball', ?, 3, '[]', 0)", (json.dumps(row),))
+        db.commit()
+        db.close()
+        self.bookmarks = main.Spellbook(self.path)
+        self.fetchSpell = main.fetchSpell
+        main.fetchSpell = self.offline
+
+    def tearDown(self):
+        main.fetchSpell = self.fetchSpell
+        closeSpellbook(self.bookmarks)
+        self.directory.cleanup()
+
+    def offline(self, index):
+        raise main.requests.exceptions.ConnectionError()
+
+    def testMissingSaveIsLookedUpOnce(self):
+        main.fetchSpell = lambda index: (200, self.FIREBALL)
+        casts = main.planRotation("fireball", self.bookmarks, main.ENCOUNTER_DEFAULTS)
+        self.assertEqual(casts[0][4:], ("save", True))
+        # the saving throw was saved with the bookmark, so planning again needs no API
+        main.fetchSpell = self.offline
+        reopened = main.Spellbook(self.path)
+        self.assertEqual(main.planRotation("fireball", reopened, main.ENCOUNTER_DEFAULTS)[0][4:], ("save", True))
+        closeSpellbook(reopened)
+
+    def testMissingSaveIsReportedOffline(self):
+        with self.assertRaisesRegex(ValueError, "saving throw"):
+            main.planRotation("fireball", self.bookmarks, main.ENCOUNTER_DEFAULTS)
+
+    # a spell bookmarked now without a saving throw has none, so it is planned offline without asking the API
+    def testSpellWithoutSaveNeedsNoLookup(self):
+        self.bookmarks.append(main.Spell.fromApi(self.MAGIC_MISSILE))
+        self.assertEqual(main.planRotation("magic missile", self.bookmarks, main.ENCOUNTER_DEFAULTS)[0][4], "hit")
+
+    def testTrialsAreRolledInChunks(self):
+        main.fetchSpell = lambda index: (200, self.FIREBALL)
+        casts = main.planRotation("fireball", self.bookmarks, main.ENCOUNTER_DEFAULTS)
+        chunkTrials = main.ENCOUNTER_CHUNK_TRIALS
+        main.ENCOUNTER_CHUNK_TRIALS = 1000
+        try:
+            simulations = [main.simulateTrialsPython] + ([main.simulateTrials] if main.numpy is not None else [])
+            for simulate in simulations:
+                counts, castDamage, castHits = simulate(casts, main.ENCOUNTER_DEFAULTS, 2500)
+                self.assertEqual(sum(counts.values()), 2500)
+                self.assertEqual(sum(total * count for total, count in counts.items()), castDamage[0])
+                self.assertLess(castHits[0], 2500)
+        finally:
+            main.ENCOUNTER_CHUNK_TRIALS = chunkTrials
+
+# Search results are fetched in the background, several at once, and batch lookups use those fetches
+class PrefetchTest(unittest.TestCase):
+    def setUp(self):
+        self.fetchSpell = main.fetchSpell
+        self.fetched = []
+        def fetchSpell(index):
+            self.fetched.append(index)
+            time.sleep(0.2)
+            return (200, {"index": index, "name": index.title()}) if index != "missing" else (404, None)
+        main.fetchSpell = fetchSpell
+
+    def tearDown(self):
+        main.fetchSpell = self.fetchSpell
+        main.stopPrefetch()
+
+    def testSpellsAreFetchedConcurrentlyOnce(self):
+        start = time.monotonic()
+        futures = main.prefetchSpells(["fireball", "shield", "fireball", "light"])
+        results = {index: future.result() for index, future in futures.items()}
+        self.assertLess(time.monotonic() - start, 0.5) # three 0.2 s fetches side by side
+        self.assertEqual(sorted(self.fetched), ["fireball", "light", "shield"])
+        self.assertEqual(results['shield'], (200, {"index": "shield", "name": "Shield"}))
+
+    def testBatchLookupUsesPrefetch(self):
+        prefetched = main.prefetchSpells(["fireball", "missing"])
+        catalog = main.spellCatalog
+        with tempfile.TemporaryDirectory() as directory:
+            main.spellCatalog = main.SpellCatalog(os.path.join(directory, "catalog.db")) # nothing downloaded
+            try:
+                self.assertEqual(main.getBatchSpell("Fireball", prefetched)['name'], "Fireball")
+                with self.assertRaisesRegex(ValueError, "404"):
+                    main.getBatchSpell("missing", prefetched)
+            finally:
+                main.spellCatalog = catalog
+        self.assertEqual(sorted(self.fetched), ["fireball", "missing"])
+
+# Microservice messages read back the same in every format, compressed or not
+class CodecTest(unittest.TestCase):
+    def testRoundTrip(self):
+        spell = main.Spell.fromFields({"name": "Frost Lance", "level": "3", "classes": "Wizard"})
+        small = {"option": 1, "json_object": spell, "json_array": []}
+        large = {"option": 4, "json_array": [spell] * 200}
+        for codec in [None, 'json'] + (['msgpack'] if main.msgpack is not None else []):
+            for message in [small, large]:
+                encoded = main.encodeMessage(message, codec)
+                self.assertEqual(encoded.startswith(main.CODEC_MAGIC), codec is not None)
+                decoded = main.decodeMessage(encoded)
+                self.assertEqual(decoded['option'], message['option'])
+                self.assertEqual(len(decoded['json_array']), len(message['json_array']))
+        self.assertEqual(main.decodeMessage(main.encodeMessage(small, 'json'))['json_object'], spell.toDict())
+
+    def testLargeBodiesAreCompressed(self):
+        encoded = main.encodeMessage({"desc": "x" * (main.COMPRESS_THRESHOLD * 2)}, 'json')
+        self.assertTrue(encoded[len(main.CODEC_MAGIC)] & main.CODEC_ZLIB)
+        self.assertLess(len(encoded), main.COMPRESS_THRESHOLD)
+
+    def testCorruptFrameIsValueError(self):
+        with self.assertRaises(ValueError):
+            main.decodeMessage(main.CODEC_MAGIC + bytes([main.CODEC_ZLIB]) + b"not zlib")
+
+# The sorted views of the bookmarks follow every add, change and removal, and are rebuilt from the store
+class SortIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "spellbook.db")
+        self.bookmarks = main.Spellbook(self.path)
+        for name, level, classes in [("Shield", "1", "Wizard, Sorcerer"), ("Fireball", "3", "Wizard"), ("Cure Wounds", "1", "Cleric")]:
+            self.bookmarks.append(main.Spell.fromFields({"name": name, "level": level, "classes": classes}))
+
+    def tearDown(self):
+        closeSpellbook(self.bookmarks)
+        self.directory.cleanup()
+
+    def testViewsFollowChanges(self):
+        self.assertEqual(self.bookmarks.getSortedIds("level"), ["cure-wounds", "shield", "fireball"])
+        self.assertEqual(self.bookmarks.getSortedIds("level", True), ["fireball", "cure-wounds", "shield"])
+        self.assertEqual(self.bookmarks.getSortedIds("name"), ["cure-wounds", "fireball", "shield"])
+        self.assertEqual(self.bookmarks.getSortedIds("class", className=" wizard "), ["fireball", "shield"])
+        shield = self.bookmarks.getSpell("shield")
+        self.bookmarks.patch("shield", 0, main.Spell.fromFields({"name": "Arcane Shield", "level": "5"}, shield))
+        del self.bookmarks[self.bookmarks.find("cure-wounds")]
+        self.assertEqual(self.bookmarks.getSortedIds("level"), ["fireball", "arcane-shield"])
+        self.assertEqual(self.bookmarks.getSortedIds("name"), ["arcane-shield", "fireball"])
+        self.assertEqual(self.bookmarks.getSortedIds("class", className="Cleric"), [])
+        reopened = main.Spellbook(self.path)
+        self.assertEqual(reopened.getSortedIds("level"), ["fireball", "arcane-shield"])
+        self.assertEqual(reopened.getSortedIds("class", className="sorcerer"), ["arcane-shield"])
+        closeSpellbook(reopened)
+
+# Dice expressions are parsed into terms, and their exact odds are worked out
+class DiceExpressionTest(unittest.TestCase):
+    def testParse(self):
+        self.assertEqual(main.parseDiceExpression("2d6 + 3"), [(1, 2, 6, 2, True, 0), (1, 0, 0, 0, True, 3)])
+        self.assertEqual(main.parseDiceExpression("4d6dl-D8"), [(1, 4, 6, 3, True, 0), (-1, 1, 8, 1, True, 0)])
+        self.assertEqual(main.parseDiceExpression("2d20kl1"), [(1, 2, 20, 1, False, 0)])
+        for expression in ["", "d", "2d6+", "3x4", "0d6", "1d0", "2d6kh3", "2d6dl2"]:
+            with self.assertRaises(ValueError):
+                main.parseDiceExpression(expression)
+
+    def testExactOdds(self):
+        statistics = main.diceStatistics("2d6")
+        self.assertAlmostEqual(statistics["distribution"][7], 6 / 36)
+        self.assertAlmostEqual(statistics["mean"], 7)
+        self.assertEqual((statistics["min"], statistics["max"]), (2, 12))
+        self.assertEqual(statistics["percentiles"], {5: 3, 25: 5, 50: 7, 75: 9, 95: 11})
+        self.assertAlmostEqual(main.diceStatistics("1d6-1")["mean"], 2.5)
+        advantage = main.diceStatistics("2d20kh1")["distribution"]
+        self.assertAlmostEqual(advantage[20], 39 / 400)
+        self.assertAlmostEqual(advantage[1], 1 / 400)
+        self.assertEqual(main.diceStatistics("2d6dl1")["distribution"], main.diceStatistics("2d6kh1")["distribution"])
+        self.assertAlmostEqual(sum(main.diceStatistics("4d6dl1")["distribution"].values()), 1)
+
+# The benchmark's stand-in bookmarks service keeps a versioned copy like the real one, and its limits scale with size
+class BenchmarkStandInTest(unittest.TestCase):
+    def setUp(self):
+        self.services = benchmark.FakeMicroservices({})
+
+    def tearDown(self):
+        self.services.context.term()
+
+    def testBookmarksAreVersioned(self):
+        fireball, shield = benchmark.makeSpell(1), benchmark.makeSpell(2)
+        self.assertEqual(self.services.handleBookmarks({"option": 4, "json_array": [fireball]}), {"version": 1})
+        self.assertEqual(self.services.handleBookmarks({"option": 4, "append": True, "json_array": [shield]}), {"version": 2})
+        self.assertEqual(set(self.services.bookmarks), {main.getSpellId(fireball), main.getSpellId(shield)})
+        stale = {"option": 2, "version": 1, "spell_id": main.getSpellId(fireball)}
+        self.assertEqual(self.services.handleBookmarks(stale), {"version": 2, "resync": True})
+        self.assertEqual(len(self.services.bookmarks), 2)
+        self.assertEqual(self.services.handleBookmarks(dict(stale, version=2)), {"version": 3})
+        self.assertEqual(list(self.services.bookmarks), [main.getSpellId(shield)])
+        self.assertEqual(self.services.handleBookmarks({"option": 4, "json_array": [fireball]}), {"version": 4})
+        self.assertEqual(list(self.services.bookmarks), [main.getSpellId(fireball)])
+        self.assertIsNone(self.services.handleBookmarks({"option": 0}))
+
+    def testThresholds(self):
+        self.assertEqual(benchmark.getThresholds("lookup (cold)"), benchmark.REGRESSION_THRESHOLDS["lookup (cold)"])
+        limits = benchmark.SPELLBOOK_THRESHOLDS["load {size}"]
+        self.assertEqual(benchmark.getThresholds("load 10000"), {measure: limit * 10 for measure, limit in limits.items()})
+        self.assertEqual(benchmark.getThresholds("unknown"), {})
+        self.assertEqual(benchmark.percentile(list(range(1, 101)), 99), 99)
+        self.assertEqual(benchmark.percentile([5], 50), 5)
+
+# Mistyped or partial spell names are matched to the closest known names
+class SpellNameIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.index = main.SpellNameIndex({"fireball": "Fireball", "fire-bolt": "Fire Bolt", "shield": "Shield", "tashas-hideous-laughter": "Tasha's Hideous Laughter"})
+
+    def testSuggest(self):
+        self.assertEqual(main.normalizeSpellName("Tasha's Hideous-Laughter"), "tashas hideous laughter")
+        self.assertEqual(self.index.suggest("Firebal")[0], ("fireball", "Fireball"))
+        self.assertEqual(self.index.suggest("sheild")[0], ("shield", "Shield"))
+        self.assertEqual(self.index.suggest("tasha hideous laughter")[0][0], "tashas-hideous-laughter")
+        self.assertEqual([index for index, name in self.index.suggest("fire")], ["fire-bolt", "fireball"])
+        self.assertEqual(len(self.index.suggest("fire", limit=1)), 1)
+        self.assertEqual(self.index.suggest("xyzzy"), [])
+        self.assertEqual(self.index.suggest("  "), [])
+        self.assertIn("shield", self.index)
+        self.assertEqual(len(self.index), 4)
+
+# Spells are filtered by several criteria at once, through bitsets kept up to date on every change
+class SpellFilterTest(unittest.TestCase):
+    def makeSpell(self, name, level, school, classes, concentration=False, damage=None, components=("V", "S")):
+        spell = {"name": name, "level": level, "school": {"name": school}, "classes": [{"name": className} for className in classes],
+                 "concentration": concentration, "ritual": False, "components": list(components)}
+        if (damage):
+            spell["damage"] = {"damage_type": {"name": damage}}
+        return spell
+
+    def setUp(self):
+        self.filter = main.SpellFilter()
+        self.filter.addAll([
+            ("fireball", self.makeSpell("Fireball", 3, "Evocation", ["Wizard", "Sorcerer"], damage="Fire", components=("V", "S", "M"))),
+            ("fly", self.makeSpell("Fly", 3, "Transmutation", ["Wizard"], concentration=True)),
+            ("cure-wounds", self.makeSpell("Cure Wounds", 1, "Evocation", ["Cleric"]))
+        ])
+
+    def testParse(self):
+        self.assertEqual(main.parseFilterQuery("Level=1,3 classes=Blood_Hunter components=!m"), {"level": ["1", "3"], "class": ["blood hunter"], "components": ["!m"]})
+        for text in ["", "level", "level=", "colour=red"]:
+            with self.assertRaises(ValueError):
+                main.parseFilterQuery(text)
+
+    def testQuery(self):
+        query = lambda text: [key for key, name in self.filter.query(main.parseFilterQuery(text))]
+        self.assertEqual(query("level=3"), ["fireball", "fly"])
+        self.assertEqual(query("level=3 school=evocation"), ["fireball"])
+        self.assertEqual(query("level=1,3 concentration=no"), ["cure-wounds", "fireball"])
+        self.assertEqual(query("class=sorcerer,cleric"), ["cure-wounds", "fireball"])
+        self.assertEqual(query("components=!m"), ["cure-wounds", "fly"])
+        self.assertEqual(query("damage=fire"), ["fireball"])
+        self.assertEqual(query("damage=none level=3"), ["fly"])
+        self.assertEqual(query("school=necromancy"), [])
+
+    def testChanges(self):
+        self.filter.remove("fireball")
+        self.assertEqual(self.filter.query({"level": ["3"]}), [("fly", "Fly")])
+        self.filter.add("haste", self.makeSpell("Haste", 3, "Transmutation", ["Wizard"], concentration=True))
+        self.filter.add("fly", self.makeSpell("Fly", 4, "Transmutation", ["Wizard"]))
+        self.assertEqual(self.filter.query({"level": ["3"]}), [("haste", "Haste")])
+        self.assertEqual(self.filter.query({"concentration": ["no"]}), [("cure-wounds", "Cure Wounds"), ("fly", "Fly")])
+        self.assertEqual(len(self.filter), 3)
+
+    def testBookmarks(self):
+        with tempfile.TemporaryDirectory() as directory:
+            bookmarks = main.Spellbook(os.path.join(directory, "spellbook.db"))
+            bookmarks.append(main.Spell.fromFields({"name": "Shield", "level": "1", "classes": "Wizard"}))
+            self.assertEqual(bookmarks.filter({"class": ["wizard"]}), [("shield", "Shield")])
+            bookmarks.append(main.Spell.fromFields({"name": "Bless", "level": "1", "classes": "Cleric"}))
+            del bookmarks[bookmarks.find("shield")]
+            self.assertEqual(bookmarks.filter({"level": ["1"]}), [("bless", "Bless")])
+            closeSpellbook(bookmarks)
+
+# Server requests are checked and run against the spellbook of the user who sent them
+class ServerRoutingTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.runBatchCommand = main.runBatchCommand
+        self.server = main.SpellbookServer("tcp://127.0.0.1:5597", self.directory.name, 1)
+
+    def tearDown(self):
+        main.runBatchCommand = self.runBatchCommand
+        for spellbook in self.server.spellbooks.values():
+            closeSpellbook(spellbook)
+        self.directory.cleanup()
+
+    def testBadRequests(self):
+        for message in [b"not json", b"[1, 2]", b'{"user": "alice"}', b'{"user": "alice", "command": "  "}',
+                        b'{"command": "bookmark list"}', b'{"user": "../alice", "command": "bookmark list"}', b'{"user": 7, "command": "bookmark list"}']:
+            reply = self.server.handle(message)
+            self.assertFalse(reply['ok'], message)
+            self.assertIn("error", reply)
+        self.assertEqual(self.server.spellbooks, {})
+
+    def testUsersHaveTheirOwnSpellbook(self):
+        calls = []
+        def runBatchCommand(line, bookmarks, prefetched):
+            calls.append((line, bookmarks))
+            return len(calls)
+        main.runBatchCommand = runBatchCommand
+        self.assertEqual(self.server.handle(b'{"user": "alice", "command": " bookmark list "}'), {"ok": True, "command": "bookmark list", "result": 1})
+        self.server.handle(b'{"user": "bob", "command": "bookmark list"}')
+        self.server.handle(b'{"user": "alice", "command": "lookup fireball"}')
+        self.assertEqual([line for line, bookmarks in calls], ["bookmark list", "bookmark list", "lookup fireball"])
+        self.assertIs(calls[0][1], calls[2][1])
+        self.assertIsNot(calls[0][1], calls[1][1])
+        self.assertEqual(calls[0][1].path, os.path.join(self.directory.name, "alice.db"))
+
+    def testCommandErrorsAreReported(self):
+        reply = self.server.handle(b'{"user": "alice", "command": "bookmark remove fireball"}')
+        self.assertEqual(reply, {"ok": False, "command": "bookmark remove fireball", "error": "'fireball' is not in your bookmarks"})
+        self.assertEqual(self.server.handle(b'{"user": "alice", "command": "bookmark list"}')['result'], [])
+
+# A field patch is merged over the saved spell, and is only saved against the version it was made from
+class SpellPatchTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "spellbook.db")
+        self.bookmarks = main.Spellbook(self.path)
+        self.bookmarks.append(main.Spell.fromFields({"name": "Frost Lance", "level": "3", "school": "Evocation", "classes": "Wizard"}))
+        self.bookmarks.append(main.Spell.fromFields({"name": "Shield", "level": "1"}))
+
+    def tearDown(self):
+        closeSpellbook(self.bookmarks)
+        self.directory.cleanup()
+
+    def testPatchKeepsOtherFields(self):
+        spell = self.bookmarks.getSpell("frost-lance")
+        patched = main.Spell.fromFields(main.toFieldAnswers({"level": 4, "desc": "A lance of ice."}), spell)
+        self.assertEqual(self.bookmarks.patch("frost-lance", 0, patched), 1)
+        saved = self.bookmarks.getSpell("frost-lance")
+        self.assertEqual((saved['level'], saved['desc'], saved['school']['name'], saved['classes'][0]['name']), (4, ["A lance of ice."], "Evocation", "Wizard"))
+        self.assertEqual(self.bookmarks.getVersion("frost-lance"), 1)
+
+    def testStaleEditIsRejected(self):
+        other = main.Spellbook(self.path) # another program with the same store
+        spell = other[other.find("frost-lance")]
+        other.patch("frost-lance", 0, main.Spell.fromFields({"level": "5"}, spell))
+        closeSpellbook(other)
+        with self.assertRaises(main.StaleEditError):
+            self.bookmarks.patch("frost-lance", 0, main.Spell.fromFields({"level": "6"}, spell))
+        self.assertEqual(self.bookmarks.getVersion("frost-lance"), 1)
+        self.assertEqual(self.bookmarks.getSpell("frost-lance")['level'], 5)
+        self.assertEqual(self.bookmarks.patch("frost-lance", 1, main.Spell.fromFields({"level": "6"}, spell)), 2)
+
+    def testRename(self):
+        spell = self.bookmarks.getSpell("frost-lance")
+        with self.assertRaises(ValueError):
+            self.bookmarks.patch("frost-lance", 0, main.Spell.fromFields({"name": "Shield"}, spell))
+        self.bookmarks.patch("frost-lance", 0, main.Spell.fromFields({"name": "Ice Lance"}, spell))
+        self.assertIsNone(self.bookmarks.find("frost-lance"))
+        self.assertEqual(self.bookmarks.getVersion("ice-lance"), 1)
+        self.assertEqual(self.bookmarks.getNames(), ["Ice Lance", "Shield"])
+
+# Spells are ranked by their expected damage at a level, carrying damage up from the nearest listed level
+class DamageTableTest(unittest.TestCase):
+    def makeSpells(self):
+        return [
+            ("fireball", {"name": "Fireball", "damage": {"damage_at_slot_level": {"3": "8d6", "4": "9d6"}}}),
+            ("magic-missile", {"name": "Magic Missile", "damage": {"damage_at_slot_level": {"1": "3d4 + 3", "2": "4d4 + 4"}}}),
+            ("fire-bolt", {"name": "Fire Bolt", "damage": {"damage_at_character_level": {"1": "1d10", "5": "2d10"}}}),
+            ("chaos", {"name": "Chaos", "damage": {"damage_at_slot_level": {"1": "1d4 + MOD", "2": "d"}}}),
+            ("shield", {"name": "Shield"})
+        ]
+
+    def checkRanking(self):
+        table = main.DamageTable(self.makeSpells())
+        self.assertEqual(len(table), 4)
+        self.assertEqual(table.invalid, 1)
+        ranked = table.rank("slot", 5)
+        self.assertEqual([result['index'] for result in ranked], ["fireball", "magic-missile", "chaos"])
+        self.assertEqual(ranked[0]['damage'], "9d6")
+        self.assertAlmostEqual(ranked[0]['mean'], 31.5)
+        self.assertAlmostEqual(ranked[0]['stddev'], (9 * 35 / 12) ** 0.5)
+        self.assertEqual((ranked[0]['min'], ranked[0]['max']), (9, 54))
+        self.assertEqual(ranked[2]['damage'], "1d4 + MOD")
+        self.assertEqual((ranked[2]['min'], ranked[2]['max']), (1 + main.DAMAGE_MODIFIER, 4 + main.DAMAGE_MODIFIER))
+        self.assertEqual([result['index'] for result in table.rank("slot", 2)], ["magic-missile", "chaos"])
+        self.assertEqual([result['index'] for result in table.rank("slot", 5, keys=["chaos", "fire-bolt"])], ["chaos"])
+        self.assertEqual(len(table.rank("slot", 5, limit=1)), 1)
+        self.assertEqual([result['damage'] for result in table.rank("character", 4)], ["1d10"])
+        self.assertEqual([result['damage'] for result in table.rank("character", 20)], ["2d10"])
+        for scaling, level in [("slot", 0), ("slot", 10), ("character", 21), ("ring", 1)]:
+            with self.assertRaises(ValueError):
+                table.rank(scaling, level)
+
+    @unittest.skipIf(main.numpy is None, "needs NumPy")
+    def testRankWithNumpy(self):
+        self.checkRanking()
+
+    def testRankWithoutNumpy(self):
+        numpy = main.numpy
+        main.numpy = None
+        try:
+            self.checkRanking()
+        finally:
+            main.numpy = numpy
+
+    def testKeptDiceStatistics(self):
+        mean, variance, lowest, highest = main.getDamageStatistics(main.parseDamageExpression("2d20kh1 - 1"))
+        self.assertAlmostEqual(mean, 13.825 - 1)
+        self.assertEqual((lowest, highest), (0, 19))
+        self.assertAlmostEqual(variance, main.diceStatistics("2d20kh1")["stddev"] ** 2)
+
+    def testBookmarksRankedByFilter(self):
+        with tempfile.TemporaryDirectory() as directory:
+            bookmarks = main.Spellbook(os.path.join(directory, "spellbook.db"))
+            bookmarks.append(main.Spell.fromFields(main.toFieldAnswers({"name": "Frost Lance", "level": 3, "classes": "Wizard", "has_damage": "yes", "damage_type": "Cold", "scaling_type": "slot",
+                                                                   "damage_values": '{"3": "6d8"}'})))
+            bookmarks.append(main.Spell.fromFields(main.toFieldAnswers({"name": "Ember Dart", "level": 1, "classes": "Sorcerer", "has_damage": "yes", "damage_type": "Fire", "scaling_type": "slot",
+                                                                   "damage_values": '{"1": "2d6"}'})))
+            self.assertEqual([result['name'] for result in main.rankSpellDamage(bookmarks, "slot", 3)], ["Frost Lance", "Ember Dart"])
+            self.assertEqual([result['name'] for result in main.rankSpellDamage(bookmarks, "slot", 3, {"class": ["sorcerer"]})], ["Ember Dart"])
+            del bookmarks[bookmarks.find("ember-dart")]
+            self.assertEqual([result['name'] for result in main.rankSpellDamage(bookmarks, "slot", 3)], ["Frost Lance"])
+            closeSpellbook(bookmarks)
+
+if __name__ == "__main__":
+    unittest.main()